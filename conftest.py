@@ -12,3 +12,4 @@ def lang(request):
     print(f"setting language: {lang}")
     findpaths.set_language(lang)
     return lang
+
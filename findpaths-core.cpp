@@ -4,6 +4,11 @@
 #include <pybind11/stl.h>
 #include <pybind11/stl_bind.h>
 #include <pybind11/numpy.h>
+#include <tbb/blocked_range.h>
+#include <tbb/enumerable_thread_specific.h>
+#include <tbb/global_control.h>
+#include <tbb/parallel_for.h>
+#include <tbb/parallel_invoke.h>
 #include <iostream>
 #include <unordered_map>
 #include <vector>
@@ -16,15 +21,30 @@
 #include <functional>
 #include <sstream>
 #include <utility>
+#include <memory>
+#include <algorithm>
+#include <atomic>
+#include <mutex>
+#include <numeric>
+#include <cstdint>
+#include <chrono>
+#include <optional>
+#include <filesystem>
+#include <fstream>
 
 namespace py = pybind11;
 
+// Everything but the module definition has internal linkage: the classes that
+// hold py::object members would otherwise have greater visibility than those
+// members (which pybind11 declares hidden), and the globals below are private
+// to this module.
+namespace {
+
 using Graph = std::vector<std::set<int>>;
 using Path = std::vector<int>;
 using NodeSet = std::set<int>;
 using PathSet = std::set<Path>;
 using PathVec = std::vector<Path>;
-using NodeToPathVec = std::unordered_map<int, PathVec>;
 
 // maybe this could be used if we wanted to make PathSet a std::unordered_set
 struct VectorHash {
@@ -39,120 +59,835 @@ struct VectorHash {
 };
 
 
-std::pair<NodeToPathVec, NodeSet> bfs_limited_paths_internal(
-    const Graph& g,
-    const Graph& g_inv,
+// The neighbors of a node, as a range over the CSR indices array
+struct Neighbors {
+  const int32_t* first;
+  const int32_t* last;
+  const int32_t* begin() const { return first; }
+  const int32_t* end() const { return last; }
+  size_t size() const { return last - first; }
+};
+
+// A graph in compressed sparse row (CSR) form: the neighbors of node v are
+// indices[indptr[v]] ... indices[indptr[v + 1] - 1], in ascending order. The
+// arrays are either owned by the CSRGraph, or borrowed from numpy arrays (for
+// example, arrays that are memory-mapped from a graph store), which the
+// CSRGraph then keeps alive; so a CSRGraph holding numpy arrays must only be
+// destroyed while the GIL is held.
+class CSRGraph {
+ public:
+  using IndptrArray = py::array_t<int64_t, py::array::c_style | py::array::forcecast>;
+  using IndicesArray = py::array_t<int32_t, py::array::c_style | py::array::forcecast>;
+
+  explicit CSRGraph(const Graph& g) {
+    m_indptr_owned.reserve(g.size() + 1);
+    m_indptr_owned.push_back(0);
+    for (const auto& neighbors : g) {
+      m_indices_owned.insert(m_indices_owned.end(), neighbors.begin(), neighbors.end());
+      m_indptr_owned.push_back(m_indices_owned.size());
+    }
+    point_to(m_indptr_owned.data(), m_indices_owned.data(), g.size());
+  }
+
+  CSRGraph(std::vector<int64_t> indptr, std::vector<int32_t> indices)
+    : m_indptr_owned(std::move(indptr)), m_indices_owned(std::move(indices)) {
+    point_to(m_indptr_owned.data(), m_indices_owned.data(), m_indptr_owned.size() - 1);
+  }
+
+  CSRGraph(const IndptrArray& indptr, const IndicesArray& indices)
+    : m_indptr_array(indptr), m_indices_array(indices) {
+    if (indptr.ndim() != 1 || indices.ndim() != 1 || indptr.shape(0) < 1 ||
+        indptr.at(indptr.shape(0) - 1) != indices.shape(0)) {
+      throw std::invalid_argument("invalid CSR arrays");
+    }
+    point_to(indptr.data(), indices.data(), indptr.shape(0) - 1);
+  }
+
+  CSRGraph(const CSRGraph&) = delete;
+  CSRGraph& operator=(const CSRGraph&) = delete;
+
+  size_t size() const { return m_num_nodes; }
+  int64_t num_edges() const { return m_indptr[m_num_nodes]; }
+  const int64_t* indptr() const { return m_indptr; }
+  const int32_t* indices() const { return m_indices; }
+
+  Neighbors operator[](int v) const {
+    return {m_indices + m_indptr[v], m_indices + m_indptr[v + 1]};
+  }
+
+ private:
+  void point_to(const int64_t* indptr, const int32_t* indices, size_t num_nodes) {
+    m_indptr = indptr;
+    m_indices = indices;
+    m_num_nodes = num_nodes;
+  }
+
+  std::vector<int64_t> m_indptr_owned;
+  std::vector<int32_t> m_indices_owned;
+  py::object m_indptr_array;
+  py::object m_indices_array;
+  const int64_t* m_indptr = nullptr;
+  const int32_t* m_indices = nullptr;
+  size_t m_num_nodes = 0;
+};
+
+// Builds the undirected graph, whose neighbors of node v are the union of the
+// (sorted) neighbors of v in g and g_inv; the nodes are merged in parallel,
+// in a pass that counts the neighbors and a pass that fills them in.
+std::shared_ptr<const CSRGraph> make_undirected_graph(const CSRGraph& g,
+                                                      const CSRGraph& g_inv) {
+  size_t N = g.size();
+  std::vector<int64_t> indptr(N + 1, 0);
+  tbb::parallel_for(tbb::blocked_range<size_t>(0, N),
+                    [&](const tbb::blocked_range<size_t>& r) {
+    for (size_t v = r.begin(); v != r.end(); ++v) {
+      Neighbors a = g[v], b = g_inv[v];
+      const int32_t *i = a.begin(), *j = b.begin();
+      int64_t count = 0;
+      while (i != a.end() && j != b.end()) {
+        if (*i < *j) { ++i; } else if (*j < *i) { ++j; } else { ++i; ++j; }
+        ++count;
+      }
+      indptr[v + 1] = count + (a.end() - i) + (b.end() - j);
+    }
+  });
+  std::partial_sum(indptr.begin(), indptr.end(), indptr.begin());
+  std::vector<int32_t> indices(indptr[N]);
+  tbb::parallel_for(tbb::blocked_range<size_t>(0, N),
+                    [&](const tbb::blocked_range<size_t>& r) {
+    for (size_t v = r.begin(); v != r.end(); ++v) {
+      Neighbors a = g[v], b = g_inv[v];
+      std::set_union(a.begin(), a.end(), b.begin(), b.end(), indices.begin() + indptr[v]);
+    }
+  });
+  return std::make_shared<const CSRGraph>(std::move(indptr), std::move(indices));
+}
+
+// Builds a graph from the edges (sources[i], targets[i]); the edges are
+// sorted and deduplicated in parallel, as 64-bit (source, target) keys.
+std::shared_ptr<const CSRGraph> make_graph_from_edges(const int32_t* sources,
+                                                      const int32_t* targets,
+                                                      size_t num_edges,
+                                                      int num_nodes) {
+  std::vector<uint64_t> keys(num_edges);
+  tbb::parallel_for(tbb::blocked_range<size_t>(0, num_edges),
+                    [&](const tbb::blocked_range<size_t>& r) {
+    for (size_t i = r.begin(); i != r.end(); ++i) {
+      keys[i] = (static_cast<uint64_t>(sources[i]) << 32) | static_cast<uint32_t>(targets[i]);
+    }
+  });
+  std::sort(std::execution::par, keys.begin(), keys.end());
+  keys.erase(std::unique(std::execution::par, keys.begin(), keys.end()), keys.end());
+  std::vector<int64_t> indptr(num_nodes + 1);
+  tbb::parallel_for(tbb::blocked_range<int>(0, num_nodes + 1),
+                    [&](const tbb::blocked_range<int>& r) {
+    for (int v = r.begin(); v != r.end(); ++v) {
+      indptr[v] = std::lower_bound(keys.begin(), keys.end(),
+                                   static_cast<uint64_t>(v) << 32) - keys.begin();
+    }
+  });
+  std::vector<int32_t> indices(keys.size());
+  tbb::parallel_for(tbb::blocked_range<size_t>(0, keys.size()),
+                    [&](const tbb::blocked_range<size_t>& r) {
+    for (size_t i = r.begin(); i != r.end(); ++i) {
+      indices[i] = static_cast<int32_t>(keys[i] & 0xffffffff);
+    }
+  });
+  return std::make_shared<const CSRGraph>(std::move(indptr), std::move(indices));
+}
+
+// Writes a one-dimensional array as a (version 1.0) .npy file, as np.save
+// would; `descr` is the little-endian numpy type of T
+template <typename T>
+void write_npy(const std::filesystem::path& file_name, const char* descr,
+               const T* data, size_t size) {
+  std::string header = std::string("{'descr': '") + descr + "', 'fortran_order': False, 'shape': (" + \
+    std::to_string(size) + ",), }";
+  // the magic string, version, header length and header take up a multiple
+  // of 64 bytes, with the header padded with spaces and ending in a newline
+  header.append(63 - (10 + header.size()) % 64, ' ');
+  header.push_back('\n');
+  uint16_t header_len = header.size();
+  std::ofstream out(file_name, std::ios::binary);
+  out.write("\x93NUMPY\x01\x00", 8);
+  char header_len_bytes[2] = {static_cast<char>(header_len & 0xff), static_cast<char>(header_len >> 8)};
+  out.write(header_len_bytes, 2);
+  out.write(header.data(), header.size());
+  out.write(reinterpret_cast<const char*>(data), size * sizeof(T));
+  if (! out) {
+    throw std::runtime_error("unable to write " + file_name.string());
+  }
+}
+
+// Writes the forward, inverse and undirected graphs of a graph store (see
+// write_graph_store in findpaths.py) from its edges, given as arrays of the
+// subject and object node indices
+void build_graph_store(const CSRGraph::IndicesArray& subjects,
+                       const CSRGraph::IndicesArray& objects,
+                       int num_nodes,
+                       const std::string& path) {
+  if (subjects.ndim() != 1 || objects.ndim() != 1 || subjects.shape(0) != objects.shape(0)) {
+    throw std::invalid_argument("the subject and object arrays must be one-dimensional, "
+                                "and the same size");
+  }
+  if (num_nodes < 0) {
+    throw std::invalid_argument("invalid number of nodes: " + std::to_string(num_nodes));
+  }
+  const int32_t* sources = subjects.data();
+  const int32_t* targets = objects.data();
+  size_t num_edges = subjects.shape(0);
+  py::gil_scoped_release release;
+  auto out_of_range = [num_nodes](int32_t v) { return v < 0 || v >= num_nodes; };
+  if (std::any_of(std::execution::par, sources, sources + num_edges, out_of_range) ||
+      std::any_of(std::execution::par, targets, targets + num_edges, out_of_range)) {
+    throw std::invalid_argument("edge has a node index that is out of range");
+  }
+  std::shared_ptr<const CSRGraph> g, g_inv;
+  tbb::parallel_invoke(
+    [&]() { g = make_graph_from_edges(sources, targets, num_edges, num_nodes); },
+    [&]() { g_inv = make_graph_from_edges(targets, sources, num_edges, num_nodes); });
+  auto g_undirected = make_undirected_graph(*g, *g_inv);
+  std::filesystem::create_directories(path);
+  for (const auto& [key, graph] : {std::make_pair("g", g.get()),
+                                   std::make_pair("g_inv", g_inv.get()),
+                                   std::make_pair("g_undirected", g_undirected.get())}) {
+    write_npy(std::filesystem::path(path) / (std::string(key) + "-indptr.npy"), "<i8",
+              graph->indptr(), graph->size() + 1);
+    write_npy(std::filesystem::path(path) / (std::string(key) + "-indices.npy"), "<i4",
+              graph->indices(), graph->num_edges());
+  }
+}
+
+
+// A flag that a running query checks periodically, so that the query can be
+// cancelled from another thread
+class CancelToken {
+ public:
+  void cancel() {
+    cancelled.store(true);
+  }
+  bool is_cancelled() const {
+    return cancelled.load(std::memory_order_relaxed);
+  }
+ private:
+  std::atomic<bool> cancelled{false};
+};
+
+struct QueryCancelled : public std::runtime_error {
+  QueryCancelled() : std::runtime_error("query was cancelled") {}
+};
+
+inline void check_cancelled(const CancelToken* cancel_token) {
+  if (cancel_token != nullptr && cancel_token->is_cancelled()) {
+    throw QueryCancelled();
+  }
+}
+
+// number of frontier paths handled by a TBB task, when a layer of the BFS is
+// expanded in parallel
+const size_t FRONTIER_GRAIN_SIZE = 256;
+
+// Per-phase statistics for a query (see make_query_stats in findpaths.py);
+// they are only collected if a query is given somewhere to put them
+struct QueryStats {
+  double forward_bfs_seconds = 0.0;
+  double reverse_bfs_seconds = 0.0;
+  double join_seconds = 0.0;
+  double sort_seconds = 0.0;
+  double convert_seconds = 0.0;
+  std::vector<size_t> forward_frontier_sizes;
+  std::vector<size_t> reverse_frontier_sizes;
+  size_t border_nodes = 0;
+  size_t candidate_paths = 0;
+  size_t paths = 0;
+  size_t bytes_allocated = 0;
+  size_t arena_blocks = 0;
+};
+
+using Clock = std::chrono::steady_clock;
+
+inline double seconds_since(Clock::time_point start) {
+  return std::chrono::duration<double>(Clock::now() - start).count();
+}
+
+// the bytes held by all of the node scratch arrays in the process, in use or
+// pooled (see get_arena_stats)
+std::atomic<size_t> m_node_scratch_bytes{0};
+
+// Dense per-node scratch arrays for a BFS, sized to the node count: `slot[v]`
+// is the index of node v in the list of nodes that the BFS has reached, and
+// only counts if `stamp[v]` is the current epoch, so that a new BFS just
+// takes the next epoch instead of clearing the arrays.
+struct NodeScratch {
+  std::vector<uint32_t> stamp;
+  std::vector<int32_t> slot;
+  uint32_t epoch = 0;
+
+  ~NodeScratch() {
+    m_node_scratch_bytes -= num_bytes();
+  }
+
+  size_t num_bytes() const {
+    return stamp.capacity() * sizeof(uint32_t) + slot.capacity() * sizeof(int32_t);
+  }
+
+  void begin(size_t num_nodes) {
+    if (stamp.size() < num_nodes) {
+      size_t old_bytes = num_bytes();
+      stamp.resize(num_nodes, 0);
+      slot.resize(num_nodes);
+      m_node_scratch_bytes += num_bytes() - old_bytes;
+    }
+    if (++epoch == 0) {
+      std::fill(stamp.begin(), stamp.end(), 0);
+      epoch = 1;
+    }
+  }
+};
+
+// The scratch arrays are kept for reuse by the next BFS (on any thread), so
+// a query usually allocates nothing proportional to the size of the graph.
+// At most NODE_SCRATCH_POOL_MAX_FREE_PER_THREAD per TBB thread are kept, so
+// that a burst of concurrent queries doesn't leave its peak number of them
+// allocated; the rest are freed when they are released, and set_graph frees
+// them all (they are sized for the old graph). (They aren't thread_local
+// because TBB may run another BFS task on a thread that is waiting inside a
+// BFS.)
+const size_t NODE_SCRATCH_POOL_MAX_FREE_PER_THREAD = 2;
+
+class NodeScratchPool {
+ public:
+  std::unique_ptr<NodeScratch> acquire() {
+    std::lock_guard<std::mutex> lock(m_mutex);
+    if (m_free.empty()) {
+      return std::make_unique<NodeScratch>();
+    }
+    auto scratch = std::move(m_free.back());
+    m_free.pop_back();
+    m_pooled_bytes -= scratch->num_bytes();
+    return scratch;
+  }
+
+  void release(std::unique_ptr<NodeScratch> scratch) {
+    size_t max_free = NODE_SCRATCH_POOL_MAX_FREE_PER_THREAD *
+      tbb::global_control::active_value(tbb::global_control::max_allowed_parallelism);
+    std::lock_guard<std::mutex> lock(m_mutex);
+    if (m_free.size() < max_free) {
+      m_pooled_bytes += scratch->num_bytes();
+      m_free.push_back(std::move(scratch));
+    }
+  }
+
+  void clear() {
+    std::vector<std::unique_ptr<NodeScratch>> free;
+    {
+      std::lock_guard<std::mutex> lock(m_mutex);
+      free.swap(m_free);
+      m_pooled_bytes = 0;
+    }
+    // (the scratch arrays are freed here, outside the lock)
+  }
+
+  size_t pooled_bytes() {
+    std::lock_guard<std::mutex> lock(m_mutex);
+    return m_pooled_bytes;
+  }
+
+ private:
+  std::mutex m_mutex;
+  std::vector<std::unique_ptr<NodeScratch>> m_free;
+  size_t m_pooled_bytes = 0;
+};
+
+NodeScratchPool m_node_scratch_pool;
+
+// Paths are stored as rows of `stride` node indices, padded with -1, in
+// arenas: a bump allocator that hands out rows from blocks that are never
+// moved (so pointers to rows stay valid), and only frees them, all at once,
+// when the arena is destroyed at the end of the query. The blocks double in
+// size, from PATH_ARENA_MIN_BLOCK_ROWS up to PATH_ARENA_MAX_BLOCK_ROWS rows.
+const size_t PATH_ARENA_MIN_BLOCK_ROWS = 64;
+const size_t PATH_ARENA_MAX_BLOCK_ROWS = 65536;
+
+// totals for all of the path arenas in the process (see get_arena_stats)
+std::atomic<size_t> m_arena_blocks_allocated{0};
+std::atomic<size_t> m_arena_bytes_allocated{0};
+std::atomic<size_t> m_arena_live_bytes{0};
+std::atomic<size_t> m_arena_peak_live_bytes{0};
+
+class PathArena {
+ public:
+  explicit PathArena(int stride) : m_stride(stride) {}
+  PathArena(PathArena&& other) noexcept
+    : m_stride(other.m_stride),
+      m_blocks(std::move(other.m_blocks)),
+      m_capacity(std::exchange(other.m_capacity, 0)),
+      m_used(std::exchange(other.m_used, 0)),
+      m_num_bytes(std::exchange(other.m_num_bytes, 0)) {}
+  PathArena& operator=(PathArena&&) = delete;
+  ~PathArena() {
+    m_arena_live_bytes -= m_num_bytes;
+  }
+
+  int stride() const { return m_stride; }
+  size_t num_blocks() const { return m_blocks.size(); }
+  size_t num_bytes() const { return m_num_bytes; }
+
+  // a new row, filled with -1
+  int32_t* new_row() {
+    if (m_used == m_capacity) {
+      add_block();
+    }
+    int32_t* row = m_blocks.back().get() + m_used++ * m_stride;
+    std::fill(row, row + m_stride, -1);
+    return row;
+  }
+
+ private:
+  void add_block() {
+    m_capacity = m_blocks.empty() ? PATH_ARENA_MIN_BLOCK_ROWS :
+      std::min(2 * m_capacity, PATH_ARENA_MAX_BLOCK_ROWS);
+    m_blocks.emplace_back(new int32_t[m_capacity * m_stride]);
+    m_used = 0;
+    size_t block_bytes = m_capacity * m_stride * sizeof(int32_t);
+    m_num_bytes += block_bytes;
+    m_arena_blocks_allocated += 1;
+    m_arena_bytes_allocated += block_bytes;
+    size_t live_bytes = m_arena_live_bytes += block_bytes;
+    size_t peak = m_arena_peak_live_bytes.load();
+    while (live_bytes > peak && ! m_arena_peak_live_bytes.compare_exchange_weak(peak, live_bytes)) {
+    }
+  }
+
+  int m_stride;
+  std::vector<std::unique_ptr<int32_t[]>> m_blocks;
+  size_t m_capacity = 0;
+  size_t m_used = 0;
+  size_t m_num_bytes = 0;
+};
+
+// the number of nodes in a path row
+inline int row_length(const int32_t* row, int stride) {
+  return std::find(row, row + stride, -1) - row;
+}
+
+// A range of pointers to path rows
+struct Rows {
+  int32_t* const* first;
+  int32_t* const* last;
+  int32_t* const* begin() const { return first; }
+  int32_t* const* end() const { return last; }
+  size_t size() const { return last - first; }
+};
+
+// The paths found by a query, as pointers to rows in the arenas that own them
+struct PathRows {
+  explicit PathRows(int stride) : stride(stride) {}
+
+  size_t num_blocks() const {
+    size_t num_blocks = 0;
+    for (const auto& arena : arenas) {
+      num_blocks += arena.num_blocks();
+    }
+    return num_blocks;
+  }
+
+  size_t num_bytes() const {
+    size_t num_bytes = 0;
+    for (const auto& arena : arenas) {
+      num_bytes += arena.num_bytes();
+    }
+    return num_bytes;
+  }
+
+  int stride;
+  std::vector<PathArena> arenas;
+  std::vector<int32_t*> rows;
+};
+
+// A path arena and the rows taken from it, for a TBB thread
+struct ThreadPaths {
+  explicit ThreadPaths(int stride) : arena(stride) {}
+  PathArena arena;
+  std::vector<int32_t*> rows;
+};
+
+// The simple paths found by a BFS, grouped by their end node (their start
+// node, for a reverse BFS): `at(v)` gives the rows for node v, which is in
+// `nodes` if the BFS reached it.
+class BFSPaths {
+ public:
+  BFSPaths(size_t num_nodes, int stride)
+    : paths(stride), m_scratch(m_node_scratch_pool.acquire()) {
+    m_scratch->begin(num_nodes);
+  }
+  BFSPaths(BFSPaths&&) = default;
+  BFSPaths& operator=(BFSPaths&&) = default;
+  ~BFSPaths() {
+    if (m_scratch) {
+      m_node_scratch_pool.release(std::move(m_scratch));
+    }
+  }
+
+  bool contains(int v) const {
+    return m_scratch->stamp[v] == m_scratch->epoch;
+  }
+
+  Rows at(int v) const {
+    int slot = m_scratch->slot[v];
+    return {m_grouped_rows.data() + m_offsets[slot],
+            m_grouped_rows.data() + m_offsets[slot + 1]};
+  }
+
+  void add(int32_t* row, int v) {
+    if (! contains(v)) {
+      m_scratch->stamp[v] = m_scratch->epoch;
+      m_scratch->slot[v] = nodes.size();
+      nodes.push_back(v);
+    }
+    paths.rows.push_back(row);
+    m_row_slots.push_back(m_scratch->slot[v]);
+  }
+
+  // Groups the rows by node, once they have all been added (a counting sort,
+  // so that no memory is allocated per node)
+  void group() {
+    m_offsets.assign(nodes.size() + 1, 0);
+    for (int32_t slot : m_row_slots) {
+      ++m_offsets[slot + 1];
+    }
+    std::partial_sum(m_offsets.begin(), m_offsets.end(), m_offsets.begin());
+    std::vector<size_t> next(m_offsets.begin(), m_offsets.end() - 1);
+    m_grouped_rows.resize(paths.rows.size());
+    for (size_t i = 0; i < paths.rows.size(); ++i) {
+      m_grouped_rows[next[m_row_slots[i]]++] = paths.rows[i];
+    }
+    m_row_slots = std::vector<int32_t>();
+  }
+
+  std::vector<int> nodes;
+  PathRows paths;
+
+ private:
+  std::unique_ptr<NodeScratch> m_scratch;
+  std::vector<int32_t> m_row_slots;
+  std::vector<size_t> m_offsets;
+  std::vector<int32_t*> m_grouped_rows;
+};
+
+// The node categories allowed at each position of a path (a metapath): the
+// category code of node v is categories[v], and code c is allowed at position
+// i if positions[i][c] is nonzero.
+struct Metapath {
+  const int32_t* categories;
+  std::vector<const uint8_t*> positions;
+
+  bool allows(size_t position, int v) const {
+    return positions[position][categories[v]] != 0;
+  }
+
+  // the first `length` positions
+  Metapath prefix(size_t length) const {
+    return {categories, std::vector<const uint8_t*>(positions.begin(), positions.begin() + length)};
+  }
+
+  // the metapath for the path read from its other end
+  Metapath reversed() const {
+    return {categories, std::vector<const uint8_t*>(positions.rbegin(), positions.rend())};
+  }
+};
+
+// A metapath as a numpy array, with a row of category flags for each position
+using MetapathArray = py::array_t<uint8_t, py::array::c_style | py::array::forcecast>;
+
+// The nodes that the paths must not go through, sorted (there are only ever a
+// few of them, so they are looked up by binary search)
+struct ExcludedNodes {
+  std::vector<int32_t> nodes;
+
+  bool contains(int v) const {
+    return std::binary_search(nodes.begin(), nodes.end(), v);
+  }
+};
+
+std::optional<ExcludedNodes> make_excluded_nodes(const std::optional<CSRGraph::IndicesArray>& exclude_array) {
+  std::optional<ExcludedNodes> excluded;
+  if (exclude_array) {
+    excluded.emplace();
+    excluded->nodes.assign(exclude_array->data(), exclude_array->data() + exclude_array->size());
+    std::sort(excluded->nodes.begin(), excluded->nodes.end());
+  }
+  return excluded;
+}
+
+BFSPaths bfs_limited_paths_internal(
+    const CSRGraph& g,
+    const CSRGraph& g_inv,
     int v_start,
     int cutoff,
-    bool reverse) {
+    bool reverse,
+    const CancelToken* cancel_token = nullptr,
+    std::vector<size_t>* frontier_sizes = nullptr,
+    const Metapath* metapath = nullptr,
+    const ExcludedNodes* excluded = nullptr) {
     
     if (cutoff < 0) {
         throw std::invalid_argument("invalid distance cutoff: " + std::to_string(cutoff));
     }
-    if (cutoff == 0) {
-        return {};
+    int stride = cutoff + 1;
+    BFSPaths backpaths(g.size(), stride);
+    if (cutoff == 0 || (metapath != nullptr && ! metapath->allows(0, v_start)) ||
+        (excluded != nullptr && excluded->contains(v_start))) {
+        backpaths.group();
+        return backpaths;
     }
-    const Graph& g_use = (reverse ? g_inv : g);
-
-    std::queue<int> queue;
-    std::unordered_map<int, int> distances;
-    NodeToPathVec backpaths;
+    const CSRGraph& g_use = (reverse ? g_inv : g);
 
-    queue.push(v_start);
-    distances[v_start] = 0;
-    backpaths[v_start].push_back({v_start});
+    backpaths.paths.arenas.emplace_back(stride);
+    int32_t* start_row = backpaths.paths.arenas.back().new_row();
+    start_row[0] = v_start;
+    // (with a metapath, whose positions are in the order of the BFS layers,
+    // the branches that leave it are never expanded, and only the paths of
+    // exactly `cutoff` hops are kept, since the shorter ones can't be joined
+    // into a path that fits it)
+    if (metapath == nullptr) {
+      backpaths.add(start_row, v_start);
+    }
 
-    while (!queue.empty()) {
-        int v = queue.front();
-        queue.pop();
-        int v_dist = distances[v];
-        if (v_dist > cutoff) {
-            break;
-        }
-        for (int v_neighb : g_use[v]) {
-            if (distances.find(v_neighb) == distances.end()) {
-                distances[v_neighb] = v_dist + 1;
-                queue.push(v_neighb);
+    // The simple paths from v_start are expanded one hop (layer) at a time, so
+    // that every simple path of up to `cutoff` hops is found regardless of the
+    // order in which the nodes are visited; the paths in the frontier (i.e.,
+    // the paths of d hops found in the previous layer) are expanded in
+    // parallel, in chunks, each thread taking rows from its own arena.
+    std::vector<int32_t*> frontier = {start_row};
+    for (int d = 0; d < cutoff && ! frontier.empty(); ++d) {
+      tbb::enumerable_thread_specific<ThreadPaths> next_frontiers(
+        [stride]() { return ThreadPaths(stride); });
+      tbb::parallel_for(tbb::blocked_range<size_t>(0, frontier.size(), FRONTIER_GRAIN_SIZE),
+                        [&](const tbb::blocked_range<size_t>& r) {
+        check_cancelled(cancel_token);
+        ThreadPaths& next_frontier = next_frontiers.local();
+        for (size_t i = r.begin(); i != r.end(); ++i) {
+          const int32_t* p = frontier[i];
+          for (int v_neighb : g_use[p[d]]) {
+            if ((metapath != nullptr && ! metapath->allows(d + 1, v_neighb)) ||
+                (excluded != nullptr && excluded->contains(v_neighb))) {
+              continue;
             }
-            for (const auto& p : backpaths[v]) {
-                if (p.size() < cutoff + 1) {
-                    Path new_path(p);
-                    new_path.push_back(v_neighb);
-                    backpaths[v_neighb].push_back(new_path);
-                }
+            if (std::find(p, p + d + 1, v_neighb) == p + d + 1) {
+              int32_t* new_path = next_frontier.arena.new_row();
+              std::copy(p, p + d + 1, new_path);
+              new_path[d + 1] = v_neighb;
+              next_frontier.rows.push_back(new_path);
             }
+          }
         }
+      });
+      frontier.clear();
+      bool keep = metapath == nullptr || d + 1 == cutoff;
+      for (auto& next_frontier : next_frontiers) {
+        if (keep) {
+          for (int32_t* p : next_frontier.rows) {
+            backpaths.add(p, p[d + 1]);
+          }
+        }
+        frontier.insert(frontier.end(), next_frontier.rows.begin(), next_frontier.rows.end());
+        backpaths.paths.arenas.push_back(std::move(next_frontier.arena));
+      }
+      if (frontier_sizes != nullptr) {
+        frontier_sizes->push_back(frontier.size());
+      }
     }
     if ( reverse ) {
-      for (auto& pair : backpaths) {
-        for (auto& path : pair.second) {
-          std::reverse(path.begin(), path.end());
-        }
+      for (int32_t* path : backpaths.paths.rows) {
+        std::reverse(path, path + row_length(path, stride));
       }
     }
+    backpaths.group();
+    return backpaths;
+}
 
-    NodeSet nodes;
-    for (const auto& pair: backpaths) {
-      nodes.insert(pair.first);
+// Adds to `result` the simple paths obtained by joining each s-half of
+// exactly n1 hops (ending at the border node) with each t-half (starting at the
+// border node).
+void combine_paths(Rows s_paths,
+                   Rows t_paths,
+                   int n1,
+                   int t_stride,
+                   ThreadPaths& result) {
+    for (const int32_t* sp : s_paths) {
+        // (the s-halves have at most n1 hops)
+        if (sp[n1] == -1) {
+            continue;
+        }
+        for (const int32_t* tp : t_paths) {
+            int t_length = row_length(tp, t_stride);
+            // both halves are simple paths, so the combined path is simple as
+            // long as the halves don't share a node other than the border node:
+            bool simple = std::none_of(tp + 1, tp + t_length, [sp, n1](int v) {
+                return std::find(sp, sp + n1 + 1, v) != sp + n1 + 1;
+            });
+            if (! simple) {
+                continue;
+            }
+            int32_t* combined = result.arena.new_row();
+            std::copy(sp, sp + n1 + 1, combined);
+            std::copy(tp + 1, tp + t_length, combined + n1 + 1);
+            result.rows.push_back(combined);
+        }
     }
-    return std::pair<NodeToPathVec, NodeSet>(backpaths, nodes);
 }
 
-PathSet combine_paths(const PathVec& s_paths,
-                      const PathVec& t_paths) {
-    PathSet result;
-    for (const auto& sp : s_paths) {
-        for (const auto& tp : t_paths) {
-            Path combined;
-            combined.reserve(sp.size() + tp.size());  // Reserve space upfront
-            combined.insert(combined.end(), sp.begin(), sp.end());
-            combined.insert(combined.end(), tp.begin(), tp.end());
-            result.emplace(std::move(combined));  // Use emplace with move semantics
-        }
+// The undirected graph is only built (once) if an undirected query is run,
+// unless it was given to set_graph_csr
+struct StoredGraph {
+  std::shared_ptr<const CSRGraph> g;
+  std::shared_ptr<const CSRGraph> g_inv;
+  mutable std::shared_ptr<const CSRGraph> undirected;
+  mutable std::once_flag undirected_built;
+  // the category code of each node (a numpy array, or None), for metapaths
+  py::object categories_array;
+  const int32_t* categories = nullptr;
+
+  const CSRGraph& get_undirected() const {
+    std::call_once(undirected_built, [this]() {
+      if (! undirected) {
+        undirected = (g == g_inv) ? g : make_undirected_graph(*g, *g_inv);
+      }
+    });
+    return *undirected;
+  }
+};
+
+// set_graph swaps in a new version of the stored graph atomically; a query
+// that is already running holds on to the version that it started with
+std::shared_ptr<const StoredGraph> m_graph;
+
+void store_graph(std::shared_ptr<const CSRGraph> g,
+                 std::shared_ptr<const CSRGraph> g_inv,
+                 std::shared_ptr<const CSRGraph> undirected,
+                 py::object node_categories) {
+  auto graph = std::make_shared<StoredGraph>();
+  if (! node_categories.is_none()) {
+    auto categories = node_categories.cast<CSRGraph::IndicesArray>();
+    if (categories.ndim() != 1 || static_cast<size_t>(categories.shape(0)) != g->size()) {
+      throw std::invalid_argument("the node categories are for a different graph");
     }
-    return result;
+    graph->categories = categories.data();
+    graph->categories_array = std::move(categories);
+  }
+  graph->g = std::move(g);
+  graph->g_inv = std::move(g_inv);
+  graph->undirected = std::move(undirected);
+  std::atomic_store(&m_graph, std::shared_ptr<const StoredGraph>(std::move(graph)));
+  m_node_scratch_pool.clear();
 }
 
-Graph m_initializer = *(new std::vector<std::set<int>> {{-1}});
-Graph m_g = m_initializer;
-Graph m_g_inv = m_initializer;
+// If g_inv is the same python object as g (an undirected graph), only one copy
+// of it is stored
+void set_graph(py::object g,
+               py::object g_inv,
+               py::object node_categories) {
+  auto g_csr = std::make_shared<const CSRGraph>(g.cast<Graph>());
+  auto g_inv_csr = g.is(g_inv) ? g_csr : std::make_shared<const CSRGraph>(g_inv.cast<Graph>());
+  store_graph(g_csr, g_inv_csr, nullptr, node_categories);
+}
 
-void set_graph(const Graph& g,
-               const Graph& g_inv) {
-  m_g = g;
-  m_g_inv = g_inv;
+// Stores a graph given as CSR arrays (for example, memory-mapped from a graph
+// store) without copying them
+void set_graph_csr(const CSRGraph::IndptrArray& g_indptr,
+                   const CSRGraph::IndicesArray& g_indices,
+                   const CSRGraph::IndptrArray& g_inv_indptr,
+                   const CSRGraph::IndicesArray& g_inv_indices,
+                   py::object undirected_indptr,
+                   py::object undirected_indices,
+                   py::object node_categories) {
+  auto g_csr = std::make_shared<const CSRGraph>(g_indptr, g_indices);
+  auto g_inv_csr = std::make_shared<const CSRGraph>(g_inv_indptr, g_inv_indices);
+  if (g_csr->size() != g_inv_csr->size()) {
+    throw std::invalid_argument("the graph and the inverse graph have different numbers of nodes");
+  }
+  std::shared_ptr<const CSRGraph> undirected_csr;
+  if (! undirected_indptr.is_none()) {
+    undirected_csr = std::make_shared<const CSRGraph>(undirected_indptr.cast<CSRGraph::IndptrArray>(),
+                                                      undirected_indices.cast<CSRGraph::IndicesArray>());
+  }
+  store_graph(g_csr, g_inv_csr, undirected_csr, node_categories);
 }
 
-// what if this function just returned a PathVec ?
-PathSet get_all_paths_internal(
-    const Graph& g,
-    const Graph& g_inv,
+std::shared_ptr<const StoredGraph> get_stored_graph() {
+  auto graph = std::atomic_load(&m_graph);
+  if (!graph) {
+    throw std::domain_error("Must first call set_graph to store the graph, before you can call get_all_paths_np_cached_graph");
+  }
+  return graph;
+}
+
+// Limits the number of TBB threads used by the path-finding functions
+std::unique_ptr<tbb::global_control> m_thread_limit;
+
+void set_num_threads(int num_threads) {
+  if (num_threads < 1) {
+    throw std::invalid_argument("invalid number of threads: " + std::to_string(num_threads));
+  }
+  m_thread_limit.reset();
+  m_thread_limit = std::make_unique<tbb::global_control>(tbb::global_control::max_allowed_parallelism,
+                                                         num_threads);
+}
+
+// Sorts the rows of paths in place, padded with -1 (so that a path sorts
+// before the paths that it is a prefix of)
+void sort_path_rows(PathRows& paths) {
+  int stride = paths.stride;
+  std::sort(std::execution::par, paths.rows.begin(), paths.rows.end(),
+            [stride](const int32_t* a, const int32_t* b) {
+              return std::lexicographical_compare(a, a + stride, b, b + stride);
+            });
+}
+
+// The two halves of the meet-in-the-middle search for the paths from s to t:
+// the paths from the search's start node of up to n1 hops, and the paths to
+// its end node of up to n2 hops, with the border nodes where they can be
+// joined (this worker's share of them, when a single heavy pair is split
+// across workers). If `reversed`, the search was run from t on the inverse
+// graph (since there are fewer paths to expand from t), so `s` and `t` are
+// swapped and the halves read backwards. `direct` is whether the paths to the
+// end node found by the first BFS alone count.
+struct PathHalves {
+  std::optional<BFSPaths> s_paths;
+  std::optional<BFSPaths> t_paths;
+  std::vector<int> border_nodes;
+  int s = 0;
+  int t = 0;
+  int n1 = 0;
+  int n2 = 0;
+  bool reversed = false;
+  bool direct = false;
+  std::vector<size_t> frontier_sizes[2];
+  double bfs_seconds[2] = {0.0, 0.0};
+};
+
+PathHalves search_halves(
+    const CSRGraph& g,
+    const CSRGraph& g_inv,
     int s,
     int t,
     int n,
-    bool debug) {
+    bool debug,
+    int part = 0,
+    int num_parts = 1,
+    const CancelToken* cancel_token = nullptr,
+    bool collect_stats = false,
+    const Metapath* metapath = nullptr,
+    const ExcludedNodes* excluded = nullptr) {
   if (n <= 0) {
     throw std::invalid_argument("invalid value for n: " + std::to_string(n));
   }
-  int n1 = (n + 1) / 2;
-  int n2 = n / 2;
-  if (n2 < n1) {
-    int k_s = g[s].size();
-    int k_t = g_inv[t].size();
-    if (debug) {
-      std::cout << "k_s: " + std::to_string(k_s) + " k_t: " + std::to_string(k_t) << std::endl;
-    }
-    if (k_s > k_t) {
-      PathSet paths = get_all_paths_internal(g_inv, g, t, s, n, debug);
-      PathSet paths_rev;
-      for (auto i: paths) {
-        std::reverse(i.begin(), i.end());
-        paths_rev.insert(i);
-      }
-      return paths_rev;
-    }
+  if (num_parts < 1 || part < 0 || part >= num_parts) {
+    throw std::invalid_argument("invalid partition " + std::to_string(part) + \
+                                " of " + std::to_string(num_parts));
   }
-  std::size_t N = g.size();
+  int N = g.size();
   if (s > N - 1 || s < 0) {
     throw std::invalid_argument("source vertex is invalid: " + std::to_string(s));
   }
@@ -163,95 +898,463 @@ PathSet get_all_paths_internal(
     throw std::invalid_argument("this function won\'t find a path between a node and itself; value: " + \
                                 std::to_string(s));
   }
+  PathHalves halves;
+  int n1 = halves.n1 = (n + 1) / 2;
+  int n2 = halves.n2 = n / 2;
+  const CSRGraph* g_search = &g;
+  const CSRGraph* g_inv_search = &g_inv;
+  std::optional<Metapath> reversed_metapath;
+  if (n2 < n1) {
+    int k_s = g[s].size();
+    int k_t = g_inv[t].size();
+    if (debug) {
+      std::cout << "k_s: " + std::to_string(k_s) + " k_t: " + std::to_string(k_t) << std::endl;
+    }
+    if (k_s > k_t) {
+      halves.reversed = true;
+      std::swap(g_search, g_inv_search);
+      std::swap(s, t);
+      if (metapath != nullptr) {
+        reversed_metapath.emplace(metapath->reversed());
+        metapath = &*reversed_metapath;
+      }
+    }
+  }
+  halves.s = s;
+  halves.t = t;
   if (debug) {
     std::cout << "running bfs on node s with cutoff " + std::to_string(n1) << std::endl;
   }
 
-  std::vector<std::pair<NodeToPathVec, NodeSet>> results(2);
+  std::optional<Metapath> bfs_metapaths[2];
+  if (metapath != nullptr) {
+    bfs_metapaths[0].emplace(metapath->prefix(n1 + 1));
+    bfs_metapaths[1].emplace(metapath->reversed().prefix(n2 + 1));
+  }
 
-  std::vector<std::function<void()>> tasks = {
-    [&results, &g, &g_inv, &s, &n1]() {
-      results[0] = bfs_limited_paths_internal(g, g_inv, s, n1, false);
+  // Run the two BFS expansions in parallel (unlike std::for_each with
+  // std::execution::par, tbb::parallel_invoke passes exceptions such as a
+  // cancellation on to the caller, rather than calling std::terminate):
+  tbb::parallel_invoke(
+    [&, cancel_token]() {
+      auto start = Clock::now();
+      halves.s_paths.emplace(bfs_limited_paths_internal(*g_search, *g_inv_search, s, n1, false, cancel_token,
+                                                        collect_stats ? &halves.frontier_sizes[0] : nullptr,
+                                                        bfs_metapaths[0] ? &*bfs_metapaths[0] : nullptr,
+                                                        excluded));
+      halves.bfs_seconds[0] = seconds_since(start);
     },
-    [&results, &g, &g_inv, &t, &n2]() {
-      results[1] = bfs_limited_paths_internal(g, g_inv, t, n2, true);
-    }
-  };
+    [&, cancel_token]() {
+      auto start = Clock::now();
+      halves.t_paths.emplace(bfs_limited_paths_internal(*g_search, *g_inv_search, t, n2, true, cancel_token,
+                                                        collect_stats ? &halves.frontier_sizes[1] : nullptr,
+                                                        bfs_metapaths[1] ? &*bfs_metapaths[1] : nullptr,
+                                                        excluded));
+      halves.bfs_seconds[1] = seconds_since(start);
+    });
 
-  NodeToPathVec s_paths, t_paths;
-  NodeSet s_nodes, t_nodes;
-
-  // This is the old sequential code (for some reason, std::execution::seq does not work):
-  // std::tie(s_paths, s_nodes) = bfs_limited_paths_internal(g, g_inv, s, n1, false);
-  // std::tie(t_paths, t_nodes) = bfs_limited_paths_internal(g, g_inv, t, n1, true);
-  
-  // Execute the tasks in parallel using std::for_each with std::execution::par
-  std::for_each(std::execution::par, tasks.begin(), tasks.end(), [](auto& task) {
-    task();
-  });
-
-  std::tie(s_paths, s_nodes) = results[0];
+  const BFSPaths& s_paths = *halves.s_paths;
 
   if (debug) {
     std::cout << "number of nodes found in paths of length " + std::to_string(n1) + \
-      " from starting vertex: " + std::to_string(s_nodes.size()) << std::endl;
+      " from starting vertex: " + std::to_string(s_paths.nodes.size()) << std::endl;
     std::cout << "running bfs on node t with cutoff " + std::to_string(n2) << std::endl;
   }
   
-  std::tie(t_paths, t_nodes) = results[1];
+  const BFSPaths& t_paths = *halves.t_paths;
 
   if (debug) {
     std::cout << "number of nodes found in paths of length " + std::to_string(n2) + \
-      " from ending vertex: " + std::to_string(t_nodes.size()) << std::endl;
+      " from ending vertex: " + std::to_string(t_paths.nodes.size()) << std::endl;
   }
 
-  NodeSet border_nodes;
-  std::set_intersection(s_nodes.begin(), s_nodes.end(),
-                        t_nodes.begin(), t_nodes.end(),
-                        std::inserter(border_nodes, border_nodes.begin()));
+  // (with a metapath, a path to t from the forward BFS alone only fits it if
+  // the metapath is for paths of n1 hops)
+  halves.direct = s_paths.contains(t) && part == 0 && (metapath == nullptr || n1 == n);
 
-  PathSet res_set; // assume initialized to empty
-  if (s_nodes.find(t) != s_nodes.end()) {
-    PathVec paths_to_add = s_paths[t];
-    res_set.insert(paths_to_add.begin(), paths_to_add.end());
-    border_nodes.erase(t);
-  }
+  // The border nodes are the nodes reached by both BFS expansions, other than
+  // t; when a single heavy pair is split across workers, each worker only
+  // does the join for its own share of them:
+  std::copy_if(t_paths.nodes.begin(), t_paths.nodes.end(),
+               std::back_inserter(halves.border_nodes),
+               [&s_paths, t, part, num_parts](int b) {
+                 return b != t && b % num_parts == part && s_paths.contains(b);
+               });
 
   if (debug) {
-    std::cout << "number of border nodes: " + std::to_string(border_nodes.size()) << std::endl;
+    std::cout << "number of border nodes: " + std::to_string(halves.border_nodes.size()) << std::endl;
   }
+  return halves;
+}
 
-  for (int b : border_nodes) {
-    for (auto& path: s_paths[b]) {
-      if (! path.empty()) {
-        path.pop_back();
-      }
+// The statistics for the search itself (the join, if there is one, adds its
+// own)
+void add_halves_stats(QueryStats* stats, PathHalves& halves) {
+  const BFSPaths& s_paths = *halves.s_paths;
+  const BFSPaths& t_paths = *halves.t_paths;
+  int n1 = halves.n1;
+  stats->forward_bfs_seconds += halves.bfs_seconds[0];
+  stats->reverse_bfs_seconds += halves.bfs_seconds[1];
+  stats->forward_frontier_sizes = std::move(halves.frontier_sizes[0]);
+  stats->reverse_frontier_sizes = std::move(halves.frontier_sizes[1]);
+  stats->border_nodes += halves.border_nodes.size();
+  for (int b : halves.border_nodes) {
+    Rows s_halves = s_paths.at(b);
+    stats->candidate_paths += t_paths.at(b).size() * \
+      std::count_if(s_halves.begin(), s_halves.end(),
+                    [n1](const int32_t* p) { return p[n1] != -1; });
+  }
+  for (const PathRows* paths : {&s_paths.paths, &t_paths.paths}) {
+    stats->arena_blocks += paths->num_blocks();
+    stats->bytes_allocated += paths->num_bytes();
+  }
+}
+
+// Returns the paths sorted, and without duplicates, as rows of n + 1 node
+// indices
+PathRows get_all_paths_internal(
+    const CSRGraph& g,
+    const CSRGraph& g_inv,
+    int s,
+    int t,
+    int n,
+    bool debug,
+    int part = 0,
+    int num_parts = 1,
+    const CancelToken* cancel_token = nullptr,
+    QueryStats* stats = nullptr,
+    const Metapath* metapath = nullptr,
+    const ExcludedNodes* excluded = nullptr) {
+  PathHalves halves = search_halves(g, g_inv, s, t, n, debug, part, num_parts, cancel_token,
+                                    stats != nullptr, metapath, excluded);
+  const BFSPaths& s_paths = *halves.s_paths;
+  const BFSPaths& t_paths = *halves.t_paths;
+  int n1 = halves.n1;
+  int n2 = halves.n2;
+
+  PathRows res_paths(n + 1);
+  if (halves.direct) {
+    PathArena& arena = res_paths.arenas.emplace_back(n + 1);
+    for (const int32_t* path : s_paths.at(halves.t)) {
+      int32_t* row = arena.new_row();
+      std::copy(path, path + row_length(path, n1 + 1), row);
+      res_paths.rows.push_back(row);
     }
-    PathSet new_paths = combine_paths(s_paths[b], t_paths[b]);
-    res_set.insert(new_paths.begin(), new_paths.end());
   }
 
+  // Every simple path of more than n1 hops passes through exactly one border
+  // node at position n1, so the results for different border nodes can't
+  // overlap, and the border nodes can be joined in parallel:
+  auto join_start = Clock::now();
+  const std::vector<int>& border_nodes_vec = halves.border_nodes;
+  tbb::enumerable_thread_specific<ThreadPaths> joined_paths(
+    [n]() { return ThreadPaths(n + 1); });
+  tbb::parallel_for(tbb::blocked_range<size_t>(0, border_nodes_vec.size()),
+                    [&](const tbb::blocked_range<size_t>& r) {
+    ThreadPaths& joined = joined_paths.local();
+    for (size_t i = r.begin(); i != r.end(); ++i) {
+      check_cancelled(cancel_token);
+      int b = border_nodes_vec[i];
+      combine_paths(s_paths.at(b), t_paths.at(b), n1, n2 + 1, joined);
+    }
+  });
+  for (auto& joined : joined_paths) {
+    res_paths.rows.insert(res_paths.rows.end(), joined.rows.begin(), joined.rows.end());
+    res_paths.arenas.push_back(std::move(joined.arena));
+  }
+  double join_seconds = seconds_since(join_start);
+
   if (debug) {
-    std::cout << "filtering paths for appropriate length" << std::endl;
+    std::cout << "sorting " << std::to_string(res_paths.rows.size()) << " paths" << std::endl;
   }
 
-  for (auto it = res_set.begin(); it != res_set.end(); /* no increment here */) {
-    if ( std::unordered_set<int>((*it).begin(), (*it).end()).size() != (*it).size() ) {
-      it = res_set.erase(it);
-    } else {
-      ++it;
+  auto sort_start = Clock::now();
+  if (halves.reversed) {
+    for (int32_t* path : res_paths.rows) {
+      std::reverse(path, path + row_length(path, res_paths.stride));
     }
   }
+  sort_path_rows(res_paths);
+
   if (debug) {
-    std::cout << "filtering complete; returning paths" << std::endl;
+    std::cout << "sorting complete; returning paths" << std::endl;
+  }
+
+  if (stats != nullptr) {
+    stats->sort_seconds += seconds_since(sort_start);
+    stats->join_seconds += join_seconds;
+    add_halves_stats(stats, halves);
+    stats->paths += res_paths.rows.size();
+    stats->arena_blocks += res_paths.num_blocks();
+    stats->bytes_allocated += res_paths.num_bytes();
   }
   
-  return res_set;
+  return res_paths;
+}
+
+void check_query_nodes(size_t num_nodes, int s, int t, int n) {
+  if (n <= 0) {
+    throw std::invalid_argument("invalid value for n: " + std::to_string(n));
+  }
+  if (s < 0 || static_cast<size_t>(s) >= num_nodes) {
+    throw std::invalid_argument("source vertex is invalid: " + std::to_string(s));
+  }
+  if (t < 0 || static_cast<size_t>(t) >= num_nodes) {
+    throw std::invalid_argument("target vertex is invalid: " + std::to_string(t));
+  }
+  if (s == t) {
+    throw std::invalid_argument("this function won\'t find a path between a node and itself; value: " + \
+                                std::to_string(s));
+  }
+}
+
+// The nodes on the shortest paths of up to `max_n` hops from s to t, by
+// position along the paths, as found by `find` (the C++ version of
+// _shortest_path_layers in findpaths.py): a bidirectional BFS expands a whole
+// layer of whichever side has the smaller frontier, until the two sides meet,
+// and the nodes on the shortest paths are then found by walking back from the
+// meeting nodes on each side. The BFS distances and the positions are kept in
+// pooled dense scratch arrays, so a search costs nothing proportional to the
+// size of the graph.
+class ShortestPathLayers {
+ public:
+  ShortestPathLayers()
+    : m_dist{m_node_scratch_pool.acquire(), m_node_scratch_pool.acquire()},
+      m_position(m_node_scratch_pool.acquire()) {}
+  ShortestPathLayers(const ShortestPathLayers&) = delete;
+  ShortestPathLayers& operator=(const ShortestPathLayers&) = delete;
+  ~ShortestPathLayers() {
+    for (auto& dist : m_dist) {
+      m_node_scratch_pool.release(std::move(dist));
+    }
+    m_node_scratch_pool.release(std::move(m_position));
+  }
+
+  // Returns false if there is no path; the nodes in `banned` are never
+  // entered, nor are the edges from s to the nodes in `banned_first_hops`
+  bool find(const CSRGraph& g,
+            const CSRGraph& g_inv,
+            int s,
+            int t,
+            int max_n,
+            const std::vector<int>& banned = {},
+            const std::vector<int>& banned_first_hops = {},
+            const CancelToken* cancel_token = nullptr) {
+    for (auto& dist : m_dist) {
+      dist->begin(g.size());
+    }
+    m_position->begin(g.size());
+    layers.clear();
+    auto edge_allowed = [s, &banned_first_hops](int u, int v) {
+      return u != s || std::find(banned_first_hops.begin(), banned_first_hops.end(), v) ==
+        banned_first_hops.end();
+    };
+    const CSRGraph* adjs[2] = {&g, &g_inv};
+    std::vector<int> frontiers[2] = {{s}, {t}};
+    int radius[2] = {0, 0};
+    set(*m_dist[0], s, 0);
+    set(*m_dist[1], t, 0);
+    std::vector<int> meeting;
+    while (meeting.empty()) {
+      if (radius[0] + radius[1] >= max_n || frontiers[0].empty() || frontiers[1].empty()) {
+        return false;
+      }
+      int side = frontiers[0].size() <= frontiers[1].size() ? 0 : 1;
+      NodeScratch& seen = *m_dist[side];
+      const NodeScratch& other = *m_dist[1 - side];
+      ++radius[side];
+      std::vector<int> next_frontier;
+      for (int u : frontiers[side]) {
+        check_cancelled(cancel_token);
+        for (int v : (*adjs[side])[u]) {
+          if (get(seen, v) >= 0 || std::find(banned.begin(), banned.end(), v) != banned.end() ||
+              ! (side == 0 ? edge_allowed(u, v) : edge_allowed(v, u))) {
+            continue;
+          }
+          set(seen, v, radius[side]);
+          next_frontier.push_back(v);
+          if (get(other, v) >= 0) {
+            meeting.push_back(v);
+          }
+        }
+      }
+      frontiers[side] = std::move(next_frontier);
+    }
+    int n = radius[0] + radius[1];
+    int k = radius[0];
+    layers.assign(n + 1, {});
+    for (int v : meeting) {
+      add(k, v);
+    }
+    for (int i = k - 1; i >= 0; --i) {
+      for (int v : layers[i + 1]) {
+        for (int u : g_inv[v]) {
+          if (get(*m_dist[0], u) == i && edge_allowed(u, v) && ! contains(i, u)) {
+            add(i, u);
+          }
+        }
+      }
+    }
+    for (int i = k + 1; i <= n; ++i) {
+      for (int u : layers[i - 1]) {
+        for (int v : g[u]) {
+          if (get(*m_dist[1], v) == n - i && edge_allowed(u, v) && ! contains(i, v)) {
+            add(i, v);
+          }
+        }
+      }
+    }
+    return true;
+  }
+
+  bool contains(int position, int v) const {
+    return get(*m_position, v) == position;
+  }
+
+  std::vector<std::vector<int>> layers;
+
+ private:
+  static int get(const NodeScratch& scratch, int v) {
+    return scratch.stamp[v] == scratch.epoch ? scratch.slot[v] : -1;
+  }
+
+  static void set(NodeScratch& scratch, int v, int value) {
+    scratch.stamp[v] = scratch.epoch;
+    scratch.slot[v] = value;
+  }
+
+  void add(int position, int v) {
+    set(*m_position, v, position);
+    layers[position].push_back(v);
+  }
+
+  std::unique_ptr<NodeScratch> m_dist[2];
+  std::unique_ptr<NodeScratch> m_position;
+};
+
+// All of the shortest paths from s to t of up to max_n hops, sorted, as rows
+// of max_n + 1 node indices; every node in a layer is on a shortest path, so
+// the depth-first walk over the layers has no dead ends.
+PathRows get_shortest_paths_internal(const CSRGraph& g,
+                                     const CSRGraph& g_inv,
+                                     int s,
+                                     int t,
+                                     int max_n,
+                                     const CancelToken* cancel_token = nullptr) {
+  check_query_nodes(g.size(), s, t, max_n);
+  PathRows paths(max_n + 1);
+  ShortestPathLayers spl;
+  if (! spl.find(g, g_inv, s, t, max_n, {}, {}, cancel_token)) {
+    return paths;
+  }
+  int n = spl.layers.size() - 1;
+  PathArena& arena = paths.arenas.emplace_back(max_n + 1);
+  std::vector<int32_t> path = {s};
+  std::function<void()> extend = [&]() {
+    int i = path.size();
+    if (i == n + 1) {
+      int32_t* row = arena.new_row();
+      std::copy(path.begin(), path.end(), row);
+      paths.rows.push_back(row);
+      return;
+    }
+    check_cancelled(cancel_token);
+    for (int v : g[path.back()]) {
+      if (spl.contains(i, v)) {
+        path.push_back(v);
+        extend();
+        path.pop_back();
+      }
+    }
+  };
+  extend();
+  sort_path_rows(paths);
+  return paths;
+}
+
+// Yen's algorithm, for the k simple paths of up to max_n hops that come first
+// in order of length, then node by node (see _get_k_shortest_simple_paths in
+// findpaths.py)
+PathVec get_k_shortest_simple_paths_internal(const CSRGraph& g,
+                                             const CSRGraph& g_inv,
+                                             int s,
+                                             int t,
+                                             int k,
+                                             int max_n,
+                                             const CancelToken* cancel_token = nullptr) {
+  check_query_nodes(g.size(), s, t, max_n);
+  if (k < 1) {
+    throw std::invalid_argument("invalid value for k: " + std::to_string(k));
+  }
+  ShortestPathLayers spl;
+  auto first_shortest_path = [&](int spur,
+                                 int max_hops,
+                                 const std::vector<int>& banned,
+                                 const std::vector<int>& banned_first_hops) -> std::optional<Path> {
+    if (! spl.find(g, g_inv, spur, t, max_hops, banned, banned_first_hops, cancel_token)) {
+      return std::nullopt;
+    }
+    // (the neighbors are in ascending order, so the first one in the next
+    // layer is the smallest; the layers leave out the banned edges)
+    Path path = {spur};
+    for (size_t i = 1; i < spl.layers.size(); ++i) {
+      for (int v : g[path.back()]) {
+        if (spl.contains(i, v)) {
+          path.push_back(v);
+          break;
+        }
+      }
+    }
+    return path;
+  };
+  PathVec found;
+  auto first = first_shortest_path(s, max_n, {}, {});
+  if (! first) {
+    return found;
+  }
+  found.push_back(*first);
+  std::set<std::pair<size_t, Path>> candidates;
+  PathSet seen = {*first};
+  while (found.size() < static_cast<size_t>(k)) {
+    const Path previous = found.back();
+    for (size_t i = 0; i + 1 < previous.size(); ++i) {
+      std::vector<int> banned(previous.begin(), previous.begin() + i);
+      std::vector<int> banned_first_hops;
+      for (const Path& p : found) {
+        if (p.size() > i + 1 && std::equal(previous.begin(), previous.begin() + i + 1, p.begin())) {
+          banned_first_hops.push_back(p[i + 1]);
+        }
+      }
+      auto spur_path = first_shortest_path(previous[i], max_n - i, banned, banned_first_hops);
+      if (spur_path) {
+        Path candidate(banned);
+        candidate.insert(candidate.end(), spur_path->begin(), spur_path->end());
+        if (seen.insert(candidate).second) {
+          candidates.emplace(candidate.size(), std::move(candidate));
+        }
+      }
+    }
+    if (candidates.empty()) {
+      break;
+    }
+    found.push_back(candidates.begin()->second);
+    candidates.erase(candidates.begin());
+  }
+  return found;
+}
+
+PathVec convert_paths_from_rows_to_pathvec(const PathRows& paths) {
+  PathVec res_vec;
+  res_vec.reserve(paths.rows.size());
+  for (const int32_t* row : paths.rows) {
+    res_vec.emplace_back(row, row + row_length(row, paths.stride));
+  }
+  return res_vec;
 }
 
 PathVec get_all_paths(
-    const Graph& g,
-    const Graph& g_inv,
+    const CSRGraph& g,
+    const CSRGraph& g_inv,
     int s,
     int t,
     int n,
@@ -262,23 +1365,29 @@ PathVec get_all_paths(
       std::to_string(n) << std::endl;
   }
   
-  PathSet res_set_filtered = get_all_paths_internal(g, g_inv, s, t, n, debug);
-
-  if (debug) {
-    std::cout << "converting " << std::to_string(res_set_filtered.size()) << \
-      " paths to PathVec format" << std::endl;
-  }
- 
-  PathVec res_vec(res_set_filtered.begin(),
-                  res_set_filtered.end());
+  PathVec res_vec = convert_paths_from_rows_to_pathvec(
+    get_all_paths_internal(g, g_inv, s, t, n, debug));
 
   if (debug) {
-    std::cout << "returning PathVec paths" << std::endl;
+    std::cout << "returning " << std::to_string(res_vec.size()) << \
+      " PathVec paths" << std::endl;
   }
    
   return res_vec;
 }
 
+// The rows already have the n + 1 columns of the numpy array, so each one is
+// copied in whole
+py::array_t<int> convert_paths_from_rows_to_np(const PathRows& paths, int n) {
+  auto shape = std::vector<size_t>({paths.rows.size(), static_cast<size_t>(n + 1)});
+  auto res_paths = py::array_t<int>(shape);
+  int* res_data = res_paths.mutable_data();
+  for (size_t i = 0; i < paths.rows.size(); ++i) {
+    std::copy(paths.rows[i], paths.rows[i] + n + 1, res_data + i * (n + 1));
+  }
+  return res_paths;
+}
+
 py::array_t<int> convert_paths_from_pathvec_to_np(const PathVec &paths,
                                                   int n) {
   size_t paths_size = paths.size();
@@ -316,39 +1425,347 @@ py::array_t<int> convert_paths_from_pathvec_to_np(const PathVec &paths,
 }
 
 py::array_t<int> get_all_paths_np(
-    const Graph& g,
-    const Graph& g_inv,
+    const CSRGraph& g,
+    const CSRGraph& g_inv,
     int s,
     int t,
     int n,
-    bool debug) {
+    bool debug,
+    int part = 0,
+    int num_parts = 1,
+    std::shared_ptr<CancelToken> cancel_token = nullptr,
+    QueryStats* stats = nullptr,
+    const Metapath* metapath = nullptr,
+    const ExcludedNodes* excluded = nullptr) {
 
   if (debug) {
     std::cout << "running get_all_paths with cutoff: " << n << std::endl;
   }
 
-  PathSet res_set_filtered = get_all_paths_internal(g, g_inv, s, t, n, debug);
+  std::optional<PathRows> res_paths;
+  {
+    // the GIL is only needed for building the numpy array, so other python
+    // threads can run while the paths are being found:
+    py::gil_scoped_release release;
+    res_paths.emplace(get_all_paths_internal(g, g_inv, s, t, n, debug, part, num_parts,
+                                             cancel_token.get(), stats, metapath, excluded));
+  }
 
   if (debug) {
-    std::cout << "converting " << res_set_filtered.size() << " paths to PathVec format" << std::endl;
+    std::cout << "converting " << res_paths->rows.size() << " paths to numpy format" << std::endl;
+  }
+
+  auto convert_start = Clock::now();
+  auto paths_np = convert_paths_from_rows_to_np(*res_paths, n);
+  if (stats != nullptr) {
+    stats->convert_seconds += seconds_since(convert_start);
+    stats->bytes_allocated += paths_np.nbytes();
   }
+  return paths_np;
+}
 
-  size_t rsf_size = res_set_filtered.size();
-  std::vector<std::vector<int>> res_vec_filtered(res_set_filtered.begin(), res_set_filtered.end());
+// Adds the statistics for a query to a python dict made by make_query_stats,
+// which might already hold the totals for other queries
+void add_query_stats(py::dict stats_dict, const QueryStats& stats, int num_queries) {
+  auto sum = [](py::handle a, py::handle b) {
+    PyObject* res = PyNumber_Add(a.ptr(), b.ptr());
+    if (res == nullptr) {
+      throw py::error_already_set();
+    }
+    return py::reinterpret_steal<py::object>(res);
+  };
+  auto add = [&stats_dict, &sum](const char* key, auto value) {
+    stats_dict[key] = stats_dict.contains(key) ? sum(stats_dict[key], py::cast(value)) :
+      py::cast(value);
+  };
+  auto add_sizes = [&stats_dict, &sum](const char* key, const std::vector<size_t>& sizes) {
+    if (! stats_dict.contains(key)) {
+      stats_dict[key] = py::list();
+    }
+    py::list total = stats_dict[key];
+    for (size_t i = 0; i < sizes.size(); ++i) {
+      if (i < total.size()) {
+        total[i] = sum(total[i], py::cast(sizes[i]));
+      } else {
+        total.append(sizes[i]);
+      }
+    }
+  };
+  add("num_queries", num_queries);
+  add("forward_bfs_seconds", stats.forward_bfs_seconds);
+  add("reverse_bfs_seconds", stats.reverse_bfs_seconds);
+  add("join_seconds", stats.join_seconds);
+  add("sort_seconds", stats.sort_seconds);
+  add("convert_seconds", stats.convert_seconds);
+  add_sizes("forward_frontier_sizes", stats.forward_frontier_sizes);
+  add_sizes("reverse_frontier_sizes", stats.reverse_frontier_sizes);
+  add("border_nodes", stats.border_nodes);
+  add("candidate_paths", stats.candidate_paths);
+  add("paths", stats.paths);
+  add("bytes_allocated", stats.bytes_allocated);
+  add("arena_blocks", stats.arena_blocks);
+}
 
-  return convert_paths_from_pathvec_to_np(res_vec_filtered, n);
+// (the metapath array has a row of category flags for each position, made by
+// _make_metapath_masks for the categories given to set_graph)
+std::optional<Metapath> make_metapath(const StoredGraph& graph,
+                                      const std::optional<MetapathArray>& metapath_array,
+                                      int n) {
+  std::optional<Metapath> metapath;
+  if (metapath_array) {
+    if (graph.categories == nullptr) {
+      throw std::invalid_argument("the graph has no node categories");
+    }
+    if (metapath_array->ndim() != 2 || metapath_array->shape(0) != n + 1) {
+      throw std::invalid_argument("invalid metapath array");
+    }
+    metapath.emplace(Metapath{graph.categories, {}});
+    for (int i = 0; i <= n; ++i) {
+      metapath->positions.push_back(metapath_array->data(i, 0));
+    }
+  }
+  return metapath;
 }
 
 py::array_t<int> get_all_paths_np_cached_graph(int s,
                                                int t,
                                                int n,
-                                               bool debug) {
-  if (m_g == m_initializer &&
-      m_g_inv == m_initializer) {
-    throw std::domain_error("Must first call set_graph to store the graph, before you can call get_all_paths_np_cached_graph");
+                                               bool debug,
+                                               int part,
+                                               int num_parts,
+                                               std::shared_ptr<CancelToken> cancel_token,
+                                               bool undirected,
+                                               std::optional<py::dict> stats_dict,
+                                               std::optional<MetapathArray> metapath_array,
+                                               std::optional<CSRGraph::IndicesArray> exclude_array) {
+  auto graph = get_stored_graph();
+  const CSRGraph* g = graph->g.get();
+  const CSRGraph* g_inv = graph->g_inv.get();
+  std::optional<Metapath> metapath = make_metapath(*graph, metapath_array, n);
+  std::optional<ExcludedNodes> excluded = make_excluded_nodes(exclude_array);
+  if (undirected) {
+    py::gil_scoped_release release;
+    g = g_inv = &graph->get_undirected();
   }
-  
-  return get_all_paths_np(m_g, m_g_inv, s, t, n, debug);
+  QueryStats stats;
+  auto paths_np = get_all_paths_np(*g, *g_inv, s, t, n, debug, part, num_parts, cancel_token,
+                                   stats_dict ? &stats : nullptr,
+                                   metapath ? &*metapath : nullptr,
+                                   excluded ? &*excluded : nullptr);
+  if (stats_dict) {
+    // (a query whose border nodes are partitioned is only counted once)
+    add_query_stats(*stats_dict, stats, part == 0 ? 1 : 0);
+  }
+  return paths_np;
+}
+
+// Appends the rows to `out` as rows of `width` node indices padded with -1,
+// sorted, and reversed first if `reverse`
+void append_sorted_rows(const std::vector<const int32_t*>& rows,
+                        int stride,
+                        int width,
+                        bool reverse,
+                        std::vector<int32_t>& out) {
+  std::vector<int32_t> block(rows.size() * width, -1);
+  for (size_t i = 0; i < rows.size(); ++i) {
+    int length = row_length(rows[i], stride);
+    int32_t* row = block.data() + i * width;
+    std::copy(rows[i], rows[i] + length, row);
+    if (reverse) {
+      std::reverse(row, row + length);
+    }
+  }
+  std::vector<size_t> order(rows.size());
+  std::iota(order.begin(), order.end(), 0);
+  const int32_t* data = block.data();
+  std::sort(order.begin(), order.end(), [data, width](size_t a, size_t b) {
+    return std::lexicographical_compare(data + a * width, data + (a + 1) * width,
+                                        data + b * width, data + (b + 1) * width);
+  });
+  for (size_t i : order) {
+    out.insert(out.end(), data + i * width, data + (i + 1) * width);
+  }
+}
+
+template <typename T>
+py::array_t<T> vector_to_np(const std::vector<T>& values, size_t width = 0) {
+  std::vector<size_t> shape = {width == 0 ? values.size() : values.size() / width};
+  if (width != 0) {
+    shape.push_back(width);
+  }
+  py::array_t<T> res(shape);
+  std::copy(values.begin(), values.end(), res.mutable_data());
+  return res;
+}
+
+// The paths in the factored form of get_all_paths_factored in findpaths.py:
+// the halves are put in the orientation of the paths, so that the heads run
+// from s to a border node, and the tails from the border node to t.
+py::dict convert_halves_to_factored_np(const PathHalves& halves, int n) {
+  const BFSPaths& s_paths = *halves.s_paths;
+  const BFSPaths& t_paths = *halves.t_paths;
+  int n1 = halves.n1;
+  int n2 = halves.n2;
+  bool reverse = halves.reversed;
+  int head_width = (reverse ? n2 : n1) + 1;
+  int tail_width = (reverse ? n1 : n2) + 1;
+  std::vector<int32_t> border_nodes(halves.border_nodes.begin(), halves.border_nodes.end());
+  std::sort(border_nodes.begin(), border_nodes.end());
+  std::vector<int32_t> kept_border_nodes;
+  std::vector<int32_t> heads;
+  std::vector<int32_t> tails;
+  std::vector<int64_t> head_offsets = {0};
+  std::vector<int64_t> tail_offsets = {0};
+  for (int b : border_nodes) {
+    std::vector<const int32_t*> s_halves;
+    for (const int32_t* p : s_paths.at(b)) {
+      // (only the s-halves of exactly n1 hops can be joined)
+      if (p[n1] != -1) {
+        s_halves.push_back(p);
+      }
+    }
+    if (s_halves.empty()) {
+      continue;
+    }
+    Rows t_rows = t_paths.at(b);
+    std::vector<const int32_t*> t_halves(t_rows.begin(), t_rows.end());
+    kept_border_nodes.push_back(b);
+    if (reverse) {
+      append_sorted_rows(t_halves, n2 + 1, head_width, true, heads);
+      append_sorted_rows(s_halves, n1 + 1, tail_width, true, tails);
+    } else {
+      append_sorted_rows(s_halves, n1 + 1, head_width, false, heads);
+      append_sorted_rows(t_halves, n2 + 1, tail_width, false, tails);
+    }
+    head_offsets.push_back(heads.size() / head_width);
+    tail_offsets.push_back(tails.size() / tail_width);
+  }
+  std::vector<int32_t> direct;
+  if (halves.direct) {
+    Rows direct_rows = s_paths.at(halves.t);
+    append_sorted_rows(std::vector<const int32_t*>(direct_rows.begin(), direct_rows.end()),
+                       n1 + 1, n + 1, reverse, direct);
+  }
+  py::dict factored;
+  factored["n"] = n;
+  factored["direct"] = vector_to_np(direct, n + 1);
+  factored["border_nodes"] = vector_to_np(kept_border_nodes);
+  factored["heads"] = vector_to_np(heads, head_width);
+  factored["head_offsets"] = vector_to_np(head_offsets);
+  factored["tails"] = vector_to_np(tails, tail_width);
+  factored["tail_offsets"] = vector_to_np(tail_offsets);
+  return factored;
+}
+
+py::dict get_all_paths_factored_cached_graph(int s,
+                                             int t,
+                                             int n,
+                                             bool debug,
+                                             int part,
+                                             int num_parts,
+                                             std::shared_ptr<CancelToken> cancel_token,
+                                             bool undirected,
+                                             std::optional<py::dict> stats_dict,
+                                             std::optional<MetapathArray> metapath_array,
+                                             std::optional<CSRGraph::IndicesArray> exclude_array) {
+  auto graph = get_stored_graph();
+  const CSRGraph* g = graph->g.get();
+  const CSRGraph* g_inv = graph->g_inv.get();
+  std::optional<Metapath> metapath = make_metapath(*graph, metapath_array, n);
+  std::optional<ExcludedNodes> excluded = make_excluded_nodes(exclude_array);
+  std::optional<PathHalves> halves;
+  {
+    py::gil_scoped_release release;
+    if (undirected) {
+      g = g_inv = &graph->get_undirected();
+    }
+    halves.emplace(search_halves(*g, *g_inv, s, t, n, debug, part, num_parts, cancel_token.get(),
+                                 stats_dict.has_value(), metapath ? &*metapath : nullptr,
+                                 excluded ? &*excluded : nullptr));
+  }
+  auto convert_start = Clock::now();
+  py::dict factored = convert_halves_to_factored_np(*halves, n);
+  if (stats_dict) {
+    QueryStats stats;
+    add_halves_stats(&stats, *halves);
+    stats.convert_seconds = seconds_since(convert_start);
+    for (auto item : factored) {
+      if (py::isinstance<py::array>(item.second)) {
+        stats.bytes_allocated += item.second.cast<py::array>().nbytes();
+      }
+    }
+    // (a query whose border nodes are partitioned is only counted once)
+    add_query_stats(*stats_dict, stats, part == 0 ? 1 : 0);
+  }
+  return factored;
+}
+
+py::array_t<int> get_shortest_paths_np_cached_graph(int s,
+                                                    int t,
+                                                    int max_n,
+                                                    bool debug,
+                                                    std::shared_ptr<CancelToken> cancel_token,
+                                                    bool undirected) {
+  auto graph = get_stored_graph();
+  std::optional<PathRows> paths;
+  {
+    py::gil_scoped_release release;
+    const CSRGraph* g = graph->g.get();
+    const CSRGraph* g_inv = graph->g_inv.get();
+    if (undirected) {
+      g = g_inv = &graph->get_undirected();
+    }
+    paths.emplace(get_shortest_paths_internal(*g, *g_inv, s, t, max_n, cancel_token.get()));
+  }
+  if (debug) {
+    std::cout << "found " << paths->rows.size() << " shortest paths" << std::endl;
+  }
+  return convert_paths_from_rows_to_np(*paths, max_n);
+}
+
+py::array_t<int> get_k_shortest_simple_paths_np_cached_graph(int s,
+                                                             int t,
+                                                             int k,
+                                                             int max_n,
+                                                             bool debug,
+                                                             std::shared_ptr<CancelToken> cancel_token,
+                                                             bool undirected) {
+  auto graph = get_stored_graph();
+  PathVec paths;
+  {
+    py::gil_scoped_release release;
+    const CSRGraph* g = graph->g.get();
+    const CSRGraph* g_inv = graph->g_inv.get();
+    if (undirected) {
+      g = g_inv = &graph->get_undirected();
+    }
+    paths = get_k_shortest_simple_paths_internal(*g, *g_inv, s, t, k, max_n, cancel_token.get());
+  }
+  if (debug) {
+    std::cout << "found " << paths.size() << " of the " << k << " shortest simple paths" << std::endl;
+  }
+  return convert_paths_from_pathvec_to_np(paths, max_n);
+}
+
+// Allocation statistics for the path arenas in this process: the number of
+// blocks and bytes allocated so far, and the bytes held by the arenas of the
+// queries that are running (now, and at most); and the bytes held by the
+// node scratch arrays of the BFS expansions, in all and in the pool
+py::dict get_arena_stats() {
+  py::dict arena_stats;
+  arena_stats["blocks_allocated"] = m_arena_blocks_allocated.load();
+  arena_stats["bytes_allocated"] = m_arena_bytes_allocated.load();
+  arena_stats["live_bytes"] = m_arena_live_bytes.load();
+  arena_stats["peak_live_bytes"] = m_arena_peak_live_bytes.load();
+  arena_stats["node_scratch_bytes"] = m_node_scratch_bytes.load();
+  arena_stats["node_scratch_pooled_bytes"] = m_node_scratch_pool.pooled_bytes();
+  return arena_stats;
+}
+
+void prepare_undirected_graph() {
+  auto graph = get_stored_graph();
+  py::gil_scoped_release release;
+  graph->get_undirected();
 }
 
 
@@ -356,12 +1773,8 @@ PathVec get_all_paths_cached_graph(int s,
                                    int t,
                                    int n,
                                    bool debug) {
-  if (m_g == m_initializer &&
-      m_g_inv == m_initializer) {
-    throw std::domain_error("Must first call set_graph to store the graph, before you can call get_all_paths_np_cached_graph");
-  }
-
-  return get_all_paths(m_g, m_g_inv, s, t, n, debug);
+  auto graph = get_stored_graph();
+  return get_all_paths(*graph->g, *graph->g_inv, s, t, n, debug);
 }
 
 
@@ -401,49 +1814,123 @@ std::unordered_map<int, std::set<py::tuple>> bfs_limited_paths(
     int cutoff,
     bool reverse) {
 
-    NodeToPathVec backpaths;
-
-    backpaths = bfs_limited_paths_internal(g, g_inv, v_start, cutoff, reverse).first;
+    BFSPaths backpaths = bfs_limited_paths_internal(CSRGraph(g), CSRGraph(g_inv), v_start, cutoff, reverse);
     
     std::unordered_map<int, std::set<py::tuple>> python_result;
-    for (const auto& pair : backpaths) {
+    for (int v : backpaths.nodes) {
         std::set<py::tuple> tuple_set;
-        for (const auto& vec : pair.second) {
-            tuple_set.insert(py::cast(vec)); // Convert vector to tuple
+        for (const int32_t* row : backpaths.at(v)) {
+            // Convert the row to a tuple
+            tuple_set.insert(py::cast(Path(row, row + row_length(row, cutoff + 1))));
         }
-        python_result[pair.first] = std::move(tuple_set);
+        python_result[v] = std::move(tuple_set);
     }    
     return python_result;
 }
 
+}  // namespace
+
 PYBIND11_MODULE(findpaths_core, m) {
     m.doc() = "Pybind11 example plugin"; // optional module docstring
     
     m.def("_set_graph",
           &set_graph,
           "Store the graph (and the inverse graph) so it can be accessed efficiently",
-          py::arg("g"), py::arg("g_inv"));
+          py::arg("g"), py::arg("g_inv"), py::arg("node_categories") = py::none());
+
+    m.def("_set_graph_csr",
+          &set_graph_csr,
+          "Store the graph (and the inverse graph) given as CSR arrays, without copying them",
+          py::arg("g_indptr"), py::arg("g_indices"), py::arg("g_inv_indptr"), py::arg("g_inv_indices"),
+          py::arg("undirected_indptr") = py::none(), py::arg("undirected_indices") = py::none(),
+          py::arg("node_categories") = py::none());
+
+    m.def("build_graph_store",
+          &build_graph_store,
+          "Write the CSR arrays of a graph store, from the graph's edges as arrays of subject and object node indices",
+          py::arg("subjects"), py::arg("objects"), py::arg("num_nodes"), py::arg("path"));
+
+    m.def("get_arena_stats",
+          &get_arena_stats,
+          "Allocation statistics for the arenas that hold the paths found by queries");
+
+    m.def("_prepare_undirected_graph",
+          &prepare_undirected_graph,
+          "Build the undirected version of the stored graph, if it has not been built yet");
+
+    // the stored graph can hold numpy arrays, so it has to be released before
+    // the interpreter shuts down:
+    py::module_::import("atexit").attr("register")(py::cpp_function([]() {
+      std::atomic_store(&m_graph, std::shared_ptr<const StoredGraph>());
+    }));
     
+    py::class_<CancelToken, std::shared_ptr<CancelToken>>(m, "CancelToken")
+        .def(py::init<>())
+        .def("cancel", &CancelToken::cancel)
+        .def("is_cancelled", &CancelToken::is_cancelled);
+
+    py::register_exception<QueryCancelled>(m, "QueryCancelledError");
+
+    m.def("_set_num_threads",
+          &set_num_threads,
+          "Limit the number of threads used for path-finding",
+          py::arg("num_threads"));
+
     m.def("_bfs_limited_paths",
           &bfs_limited_paths,
           "A function which calculates BFS paths with limited length",
           py::arg("g"), py::arg("g_inv"), py::arg("v_start"), py::arg("cutoff"), py::arg("reverse"));
 
     m.def("get_all_paths",
-          &get_all_paths,
+          [](const Graph& g, const Graph& g_inv, int s, int t, int n, bool debug) {
+            return get_all_paths(CSRGraph(g), CSRGraph(g_inv), s, t, n, debug);
+          },
           "A function which obtains all paths between two given nodes",
           py::arg("g"), py::arg("g_inv"), py::arg("s"), py::arg("t"), py::arg("n"), py::arg("debug"));
 
     m.def("_get_all_paths_np",
-          &get_all_paths_np,
+          [](const Graph& g, const Graph& g_inv, int s, int t, int n, bool debug,
+             int part, int num_parts, std::shared_ptr<CancelToken> cancel_token) {
+            return get_all_paths_np(CSRGraph(g), CSRGraph(g_inv), s, t, n, debug, part, num_parts,
+                                    cancel_token);
+          },
           "A function which obtains all paths between two given nodes",
           py::arg("g"), py::arg("g_inv"), py::arg("s"), py::arg("t"), py::arg("n"), py::arg("debug"),
+          py::arg("part") = 0, py::arg("num_parts") = 1,
+          py::arg("cancel_token") = nullptr,
           py::return_value_policy::take_ownership);
 
     m.def("_get_all_paths_np_cached_graph",
           &get_all_paths_np_cached_graph,
           "A function which obtains all paths between two given nodes",
           py::arg("s"), py::arg("t"), py::arg("n"), py::arg("debug"),
+          py::arg("part") = 0, py::arg("num_parts") = 1,
+          py::arg("cancel_token") = nullptr, py::arg("undirected") = false,
+          py::arg("stats") = py::none(), py::arg("metapath") = py::none(),
+          py::arg("exclude") = py::none(),
+          py::return_value_policy::take_ownership);
+
+    m.def("_get_all_paths_factored_cached_graph",
+          &get_all_paths_factored_cached_graph,
+          "A function which obtains all paths between two given nodes, as the halves to be joined at each border node",
+          py::arg("s"), py::arg("t"), py::arg("n"), py::arg("debug"),
+          py::arg("part") = 0, py::arg("num_parts") = 1,
+          py::arg("cancel_token") = nullptr, py::arg("undirected") = false,
+          py::arg("stats") = py::none(), py::arg("metapath") = py::none(),
+          py::arg("exclude") = py::none());
+
+    m.def("_get_shortest_paths_np_cached_graph",
+          &get_shortest_paths_np_cached_graph,
+          "A function which obtains all shortest paths between two given nodes",
+          py::arg("s"), py::arg("t"), py::arg("max_n"), py::arg("debug") = false,
+          py::arg("cancel_token") = nullptr, py::arg("undirected") = false,
+          py::return_value_policy::take_ownership);
+
+    m.def("_get_k_shortest_simple_paths_np_cached_graph",
+          &get_k_shortest_simple_paths_np_cached_graph,
+          "A function which obtains the k shortest simple paths between two given nodes",
+          py::arg("s"), py::arg("t"), py::arg("k"), py::arg("max_n"), py::arg("debug") = false,
+          py::arg("cancel_token") = nullptr, py::arg("undirected") = false,
           py::return_value_policy::take_ownership);
 
     m.def("_get_all_paths_batch",
@@ -5,30 +5,45 @@
 # Stephen Ramsey
 # Oregon State University
 
+from __future__ import annotations
 from collections.abc import Iterator
-from collections import deque, defaultdict
+import collections.abc
+from collections import defaultdict
 import timeit
-import pytest
+import time
 import pickle
-import argparse
-from toolz import pipe
-import toolz.curried as tc
-import toolz.sandbox.core as tsc
 import gzip
-import jsonlines
+import json
 import os
 import sys
+import asyncio
 import multiprocess
 import numpy as np
-import pandas as pd
 import itertools as it
+import contextlib
+import threading
+import math
+import resource
 import typing
 import types
 from typing import Iterable
 
+
+# Worker processes that only run queries don't need the graph loaders, so
+# toolz, jsonlines and csv (for loading the graph and the batch job file) and
+# argparse are imported inside the functions that use them. (The annotations
+# aren't evaluated at import time, so argparse and concurrent.futures are only
+# imported for type checking here.)
+if typing.TYPE_CHECKING:
+    import argparse
+    import concurrent.futures
+
+# The neighbors of each node, indexed by integer node ID: a tuple of sets, or
+# a CSR view (see `_CSRAdjacency`)
+Adjacency = typing.Sequence[typing.Collection[int]]
+
 # Optional imports used during debugging:
 # import pprint   # uncomment this for pprint debugging
-# import profile  # uncomment this if you want to do profiling
 
 
 # This needs to be consistent with m_initializer in
@@ -41,11 +56,89 @@ g_default_start_node = None
 g_default_end_node = None
 g_default_cutoff = 3
 g_default_multi_node_file_name = None
+g_default_serve_host = '127.0.0.1'
+g_default_serve_port = 8765
 g_language = None
 g_module = sys.modules[__name__]
-g_g = None
-g_g_inv = None
+# the stored graph and its inverse, as one tuple, so that `set_graph` can
+# replace both of them at once:
+g_graph: typing.Optional[tuple] = None
+# the adjacencies in a graph store (see `write_graph_store`):
+g_graph_store_adjacencies = ('g', 'g_inv', 'g_undirected')
+# the ways that a graph store's nodes can be renumbered (see
+# `make_node_order`):
+g_node_orders = ('degree', 'bfs')
+# the landmark distance index for the stored graph, if there is one (see
+# `build_landmark_index`); distances are stored as uint8, with 255 meaning
+# unreachable, and 254 meaning 254 or more hops:
+g_landmark_index: typing.Optional[dict[str, np.ndarray]] = None
+g_landmark_unreachable = 255
+g_landmark_max_distance = 254
+# the node categories of the stored graph, if it has them (see
+# `make_node_categories`), for translating metapaths to category codes:
+g_node_categories: typing.Optional[dict] = None
 g_min_nodes_for_multiproc = 1000
+# maximum number of threads used within a single query by the C++
+# implementation; None means use all of the CPUs:
+g_num_threads = None
+g_async_cancel_flags = None
+g_out_degree = None
+g_in_degree = None
+g_mean_degree = 1.0
+# When chunking cheap batch jobs together, aim for about this many chunks per
+# worker process, so that workers that finish early can pick up more work:
+g_batch_chunks_per_worker = 4
+# Compact the stored graph deltas into the pickled graph once they add up to
+# more than this fraction of the number of edges:
+g_delta_compaction_fraction = 0.1
+# the values allowed for the 'direction' and 'output' fields of a batch job
+# (see `iter_batch_jobs`), and the number of jobs from a batch job file that
+# are read and run together:
+g_batch_job_directions = ('directed', 'undirected')
+g_batch_job_outputs = ('paths', 'count')
+g_batch_job_chunk_size = 100000
+# For distributed batches (see `BatchCoordinator`): the number of jobs per
+# shard, how long (in seconds) a worker has to send back the result for a
+# shard before it is handed out again, how often a worker that has been told
+# to wait asks again, how long a worker keeps trying to connect to the
+# coordinator, the bytes read at a time from a result, and the name of the
+# file, in the output directory, that records the shard size and the summary
+g_batch_shard_size = 1000
+g_batch_lease_seconds = 3600.0
+g_batch_worker_poll_seconds = 1.0
+g_batch_worker_connect_seconds = 60.0
+g_batch_transfer_bytes = 1 << 20
+g_batch_manifest_file_name = "manifest.json"
+# how often (in seconds) the progress of a batch run is printed:
+g_progress_interval_seconds = 10.0
+# the ways in which `get_path_edges` can report parallel edges, and the
+# arrays of an edge table (see `make_edge_table`) that a graph store holds:
+g_parallel_edges_modes = ('count', 'expand')
+g_edge_table_arrays = ('indptr', 'object', 'edge_id', 'predicate')
+# the memory limit, in bytes, if one has been set (see `set_memory_limit`):
+g_max_memory_bytes: typing.Optional[int] = None
+# the sampling interval (in seconds) and the number of functions listed in the
+# summary, for the `--profile` mode:
+g_profile_sample_interval = 0.001
+g_profile_top_n = 20
+# request lines that start with these are handled as HTTP by the server:
+g_http_methods = (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ')
+# The header and the per-job index entries of a batch paths file (see
+# `PathsBatchWriter`); 'compression' is an index into
+# g_paths_file_compressions:
+g_paths_file_magic = b'FINDPTHS'
+g_paths_file_version = 1
+g_paths_file_compressions = (None, 'zstd', 'lz4')
+g_paths_file_header_dtype = np.dtype([('magic', 'S8'),
+                                      ('version', '<u4'),
+                                      ('compression', '<u4'),
+                                      ('num_jobs', '<u8'),
+                                      ('index_offset', '<u8')])
+g_paths_file_index_dtype = np.dtype([('offset', '<u8'),
+                                     ('nbytes', '<u8'),
+                                     ('num_paths', '<u8'),
+                                     ('path_len', '<u4'),
+                                     ('written', '<u4')], align=True)
 
 
 def set_language(lang: str) -> types.ModuleType:
@@ -60,12 +153,13 @@ def set_language(lang: str) -> types.ModuleType:
         import findpaths_core as fpc
         g_module = fpc
     elif lang == 'python':
-        pass
+        g_module = sys.modules[__name__]
     assert g_module is not None
     return g_module
 
 
 def _stream_gz_jsonl(gz_jl_file_name: str) -> Iterator[dict]:
+    import jsonlines
     with gzip.open(gz_jl_file_name) as input_file:
         reader = jsonlines.Reader(input_file)
         for obj in reader:
@@ -82,6 +176,9 @@ def _clean_up_node(n: dict) -> dict:
 
 
 def _load_graph(gz_jl_base_file_name: str) -> tuple[tuple, tuple]:
+    from toolz import pipe
+    import toolz.curried as tc
+    import toolz.sandbox.core as tsc
 
     node_ids, nodes = \
         pipe(gz_jl_base_file_name +
@@ -108,7 +205,7 @@ def _make_curie_to_index_map(nodes: tuple[dict, ...]) -> dict[str, int]:
 
 def _make_graph_edgelist(nodes: tuple[dict, ...],
                          edges: tuple[dict, ...]) -> dict:
-    g_dict = dict()
+    g_dict: dict = dict()
     g_dict['ids'] = tuple(node['id'] for node in nodes)
     curie_to_index_map = dict()
     N = len(nodes)
@@ -122,10 +219,766 @@ def _make_graph_edgelist(nodes: tuple[dict, ...],
         g_inv[t].add(s)
     g_dict['g'] = g
     g_dict['g_inv'] = g_inv
+    g_dict['node_table'] = make_node_table(g_dict['ids'], nodes)
+    g_dict['node_categories'] = make_node_categories(g_dict['node_table'])
+    g_dict['edge_table'] = make_edge_table(*_make_edge_arrays(nodes, edges),
+                                           *_make_predicate_codes(edges), N)
+    return g_dict
+
+
+# The subject and object node indices of the edges, as int32 arrays (see
+# `build_graph_store`).
+def _make_edge_arrays(nodes: tuple[dict, ...],
+                      edges: tuple[dict, ...]) -> tuple[np.ndarray,
+                                                        np.ndarray]:
+    curie_to_index_map = _make_curie_to_index_map(nodes)
+    return tuple(np.fromiter((curie_to_index_map[e[end]] for e in edges),
+                             dtype=np.int32, count=len(edges))
+                 for end in ('subject', 'object'))  # type: ignore
+
+
+# A read-only adjacency view over compressed sparse row (CSR) arrays: the
+# neighbors of node v are indices[indptr[v]:indptr[v + 1]], in ascending
+# order. The arrays can be memory-mapped from a graph store, so that no
+# adjacency data are read until they are used.
+class _CSRAdjacency(collections.abc.Sequence):
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return self.indptr.shape[0] - 1
+
+    @typing.overload
+    def __getitem__(self, v: int) -> list[int]: ...
+
+    @typing.overload
+    def __getitem__(self, v: slice) -> typing.Sequence[list[int]]: ...
+
+    def __getitem__(self, v):
+        if isinstance(v, slice):
+            return [self[i] for i in range(len(self))[v]]
+        return self.indices[self.indptr[v]:self.indptr[v + 1]].tolist()
+
+    def degrees(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    @classmethod
+    def from_edges(cls,
+                   rows: np.ndarray,
+                   cols: np.ndarray,
+                   num_nodes: int) -> '_CSRAdjacency':
+        order = np.lexsort((cols, rows))
+        rows = rows[order]
+        cols = cols[order]
+        keep = np.ones(rows.shape[0], dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows = rows[keep]
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+        return cls(indptr, cols[keep].astype(np.int32))
+
+    @classmethod
+    def from_sets(cls, adj: Adjacency) -> '_CSRAdjacency':
+        indptr = np.zeros(len(adj) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, adj), dtype=np.int64, count=len(adj)),
+                  out=indptr[1:])
+        indices = np.fromiter(it.chain.from_iterable(map(sorted, adj)),
+                              dtype=np.int32, count=indptr[-1])
+        return cls(indptr, indices)
+
+    def edges(self) -> tuple[np.ndarray, np.ndarray]:
+        return (np.repeat(np.arange(len(self), dtype=np.int32),
+                          self.degrees()),
+                np.asarray(self.indices))
+
+
+# The undirected adjacency has the union of the neighbors of each node in g
+# and g_inv; if g_inv is g, the graph is already undirected, and no second
+# copy is made.
+def _make_undirected_adjacency(g: Adjacency, g_inv: Adjacency) -> Adjacency:
+    if g_inv is g:
+        return g
+    if isinstance(g, _CSRAdjacency) and isinstance(g_inv, _CSRAdjacency):
+        rows, cols = g.edges()
+        rows_inv, cols_inv = g_inv.edges()
+        return _CSRAdjacency.from_edges(np.concatenate((rows, rows_inv)),
+                                        np.concatenate((cols, cols_inv)),
+                                        len(g))
+    return tuple(set(g[v]) | set(g_inv[v]) for v in range(len(g)))
+
+
+# A graph store is a directory with the forward, inverse and undirected
+# adjacencies of the graph as CSR arrays in .npy files (which
+# `read_graph_store` memory-maps), and the node CURIEs and node table in a
+# small pickle file.
+# If `node_order` is given, the nodes are renumbered first (see
+# `make_node_order`), and the ids and node table are stored in the new order,
+# so that CURIE lookups and `paths_to_curies` work unchanged on the store.
+def write_graph_store(g_dict: dict,
+                      path: str,
+                      num_landmarks: int = 0,
+                      node_order: typing.Optional[str] = None):
+    os.makedirs(path, exist_ok=True)
+    g = g_dict['g']
+    g_inv = g_dict['g_inv']
+    g_csr = g if isinstance(g, _CSRAdjacency) else \
+        _CSRAdjacency.from_sets(g)
+    g_inv_csr = g_inv if isinstance(g_inv, _CSRAdjacency) else \
+        _CSRAdjacency.from_sets(g_inv)
+    adjacencies = {'g': g_csr,
+                   'g_inv': g_inv_csr,
+                   'g_undirected': typing.cast(
+                       _CSRAdjacency,
+                       _make_undirected_adjacency(g_csr, g_inv_csr))}
+    ids = g_dict['ids']
+    node_table = get_node_table(g_dict)
+    edge_table = g_dict.get('edge_table')
+    order = None
+    if node_order is not None:
+        order = make_node_order(adjacencies['g_undirected'], node_order)
+        new_index = _invert_node_order(order)
+        adjacencies = {key: _relabel_adjacency(adj, new_index)
+                       for key, adj in adjacencies.items()}
+        ids, node_table = _reorder_nodes(ids, node_table, order)
+        if edge_table is not None:
+            edge_table = _relabel_edge_table(edge_table, new_index)
+    for key, adj in adjacencies.items():
+        _save_adjacency(path, key, adj)
+    _finish_graph_store(path, adjacencies['g'], adjacencies['g_inv'], ids,
+                        node_table, g_dict.get('version', 0), num_landmarks,
+                        order, edge_table)
+
+
+def _save_adjacency(path: str, key: str, adj: _CSRAdjacency):
+    np.save(os.path.join(path, f"{key}-indptr.npy"), adj.indptr)
+    np.save(os.path.join(path, f"{key}-indices.npy"), adj.indices)
+
+
+def _load_adjacency(path: str, key: str) -> _CSRAdjacency:
+    return _CSRAdjacency(
+        np.load(os.path.join(path, f"{key}-indptr.npy"), mmap_mode='r'),
+        np.load(os.path.join(path, f"{key}-indices.npy"), mmap_mode='r'))
+
+
+# Writes the parts of a graph store other than the adjacencies; the node
+# table goes last, since a store without it can't be read.
+def _finish_graph_store(path: str,
+                        g: _CSRAdjacency,
+                        g_inv: _CSRAdjacency,
+                        ids: tuple[str, ...],
+                        node_table: dict[str, np.ndarray],
+                        version: int,
+                        num_landmarks: int,
+                        order: typing.Optional[np.ndarray] = None,
+                        edge_table: typing.Optional[
+                            dict[str, np.ndarray]] = None):
+    for key in g_edge_table_arrays:
+        file_name = os.path.join(path, f"edge_table-{key}.npy")
+        if edge_table is not None:
+            np.save(file_name, edge_table[key])
+        elif os.path.exists(file_name):
+            os.remove(file_name)
+    node_categories = make_node_categories(node_table) \
+        if 'category' in node_table else None
+    file_name = os.path.join(path, "node_categories.npy")
+    if node_categories is not None:
+        np.save(file_name, node_categories['codes'])
+    elif os.path.exists(file_name):
+        os.remove(file_name)
+    if order is not None:
+        np.save(os.path.join(path, "node_order.npy"), order)
+    elif os.path.exists(os.path.join(path, "node_order.npy")):
+        os.remove(os.path.join(path, "node_order.npy"))
+    if num_landmarks > 0:
+        landmark_index = build_landmark_index(g, g_inv, num_landmarks)
+        for key, array in landmark_index.items():
+            np.save(os.path.join(path, f"{key}.npy"), array)
+    else:
+        # (don't leave an index from an earlier graph in the store)
+        for key in ('landmarks', 'forward', 'backward'):
+            if os.path.exists(os.path.join(path, f"{key}.npy")):
+                os.remove(os.path.join(path, f"{key}.npy"))
+    _write_pickle_atomically({'ids': ids,
+                              'node_table': node_table,
+                              'version': version,
+                              'predicate_names':
+                              None if edge_table is None
+                              else edge_table['predicate_names'],
+                              'category_names':
+                              None if node_categories is None
+                              else node_categories['names']},
+                             os.path.join(path, "nodes.pkl"))
+
+
+# The python version of `findpaths_core.build_graph_store`
+def _build_graph_store(subjects: np.ndarray,
+                       objects: np.ndarray,
+                       num_nodes: int,
+                       path: str):
+    os.makedirs(path, exist_ok=True)
+    g = _CSRAdjacency.from_edges(subjects, objects, num_nodes)
+    g_inv = _CSRAdjacency.from_edges(objects, subjects, num_nodes)
+    _save_adjacency(path, 'g', g)
+    _save_adjacency(path, 'g_inv', g_inv)
+    _save_adjacency(path, 'g_undirected', typing.cast(
+        _CSRAdjacency, _make_undirected_adjacency(g, g_inv)))
+
+
+# Writes a graph store straight from the edges, given as arrays of subject
+# and object node indices, without building the adjacency sets first; in C++
+# mode, `findpaths_core.build_graph_store` sorts the edges and builds the CSR
+# arrays in parallel.
+def build_graph_store(ids: tuple[str, ...],
+                      subjects: np.ndarray,
+                      objects: np.ndarray,
+                      path: str,
+                      node_table: typing.Optional[dict[str,
+                                                       np.ndarray]] = None,
+                      num_landmarks: int = 0,
+                      node_order: typing.Optional[str] = None,
+                      predicates: typing.Optional[np.ndarray] = None,
+                      predicate_names: typing.Optional[
+                          Iterable[str]] = None):
+    subjects = np.ascontiguousarray(subjects, dtype=np.int32)
+    objects = np.ascontiguousarray(objects, dtype=np.int32)
+    if subjects.ndim != 1 or subjects.shape != objects.shape:
+        raise ValueError("the subject and object arrays must be "
+                         "one-dimensional, and the same size")
+    if subjects.shape[0] > 0 and \
+       (min(subjects.min(), objects.min()) < 0 or
+            max(subjects.max(), objects.max()) >= len(ids)):
+        raise ValueError("edge has a node index that is out of range")
+    if node_table is None:
+        node_table = make_node_table(ids)
+    build = g_module.build_graph_store if _using_cxx() else \
+        _build_graph_store
+    build(subjects, objects, len(ids), path)
+    order = None
+    if node_order is not None:
+        # (the order is worked out on the undirected graph, so the store is
+        # built a second time, from the renumbered edges)
+        order = make_node_order(_load_adjacency(path, 'g_undirected'),
+                                node_order)
+        new_index = _invert_node_order(order)
+        subjects = new_index[subjects]
+        objects = new_index[objects]
+        build(subjects, objects, len(ids), path)
+        ids, node_table = _reorder_nodes(ids, node_table, order)
+    edge_table = None
+    if predicates is not None:
+        edge_table = make_edge_table(subjects, objects, predicates,
+                                     predicate_names or (), len(ids))
+    _finish_graph_store(path, _load_adjacency(path, 'g'),
+                        _load_adjacency(path, 'g_inv'), ids, node_table, 0,
+                        num_landmarks, order, edge_table)
+
+
+# A renumbering of the nodes that puts nodes that are searched together close
+# to each other in the CSR arrays, so that a BFS touches fewer cache lines and
+# pages: 'degree' sorts the nodes by descending degree (so the hubs, which
+# most searches go through, are packed together), and 'bfs' is the reverse
+# Cuthill-McKee order (breadth-first from a lowest-degree node of each
+# connected component, taking the neighbors of each node in ascending order
+# of degree, then reversed), which keeps the neighbors of a node at nearby
+# indices. Returns the old index of the node at each new index.
+def make_node_order(g_undirected: _CSRAdjacency, method: str) -> np.ndarray:
+    degrees = g_undirected.degrees()
+    if method == 'degree':
+        return np.argsort(-degrees, kind='stable').astype(np.int32)
+    if method != 'bfs':
+        raise ValueError(f"invalid node order: {method}")
+    num_nodes = len(g_undirected)
+    order = np.empty(num_nodes, dtype=np.int32)
+    visited = degrees == 0
+    # (the isolated nodes end up at the end)
+    num_ordered = int(visited.sum())
+    order[:num_ordered] = np.flatnonzero(visited)
+    for start in np.argsort(degrees, kind='stable')[num_ordered:].tolist():
+        if visited[start]:
+            continue
+        visited[start] = True
+        frontier = np.array([start], dtype=np.int64)
+        while frontier.shape[0] > 0:
+            order[num_ordered:num_ordered + frontier.shape[0]] = frontier
+            num_ordered += frontier.shape[0]
+            starts = g_undirected.indptr[frontier]
+            lens = g_undirected.indptr[frontier + 1] - starts
+            offsets = np.repeat(starts - (np.cumsum(lens) - lens), lens)
+            neighbors = g_undirected.indices[offsets +
+                                             np.arange(offsets.shape[0])]
+            parents = np.repeat(np.arange(frontier.shape[0]), lens)
+            unvisited = ~visited[neighbors]
+            neighbors = neighbors[unvisited]
+            parents = parents[unvisited]
+            # each node goes after the first of its parents in the frontier:
+            neighbors = neighbors[np.lexsort((neighbors, degrees[neighbors],
+                                              parents))]
+            _, first = np.unique(neighbors, return_index=True)
+            frontier = neighbors[np.sort(first)].astype(np.int64)
+            visited[frontier] = True
+    return order[::-1].copy()
+
+
+def _invert_node_order(order: np.ndarray) -> np.ndarray:
+    new_index = np.empty_like(order)
+    new_index[order] = np.arange(order.shape[0], dtype=order.dtype)
+    return new_index
+
+
+def _relabel_adjacency(adj: _CSRAdjacency,
+                       new_index: np.ndarray) -> _CSRAdjacency:
+    rows, cols = adj.edges()
+    return _CSRAdjacency.from_edges(new_index[rows], new_index[cols],
+                                    len(adj))
+
+
+def _reorder_nodes(ids: tuple[str, ...],
+                   node_table: dict[str, np.ndarray],
+                   order: np.ndarray) -> tuple[tuple[str, ...],
+                                               dict[str, np.ndarray]]:
+    # (the empty entry at the end of each column stays at the end)
+    return (tuple(ids[i] for i in order.tolist()),
+            {attribute: np.concatenate((column[:-1][order], column[-1:]))
+             for attribute, column in node_table.items()})
+
+
+# Translates a path array from a graph store whose nodes were renumbered back
+# to the original node indices (the order of the nodes file, as used by a
+# pickled graph), given the store's 'node_order'; the -1 padding is kept.
+def paths_to_original_node_ids(paths_np: np.ndarray,
+                               node_order: np.ndarray) -> np.ndarray:
+    return np.where(paths_np >= 0, np.asarray(node_order)[paths_np],
+                    paths_np)
+
+
+def _read_graph_store(path: str, debug=False) -> dict:
+    if not os.path.exists(os.path.join(path, "nodes.pkl")):
+        sys.exit(f"unable to open graph store {path}")
+    if debug:
+        print(f"Loading graph from graph store: {path}")
+    return read_graph_store(path)
+
+
+def read_graph_store(path: str) -> dict:
+    with open(os.path.join(path, "nodes.pkl"), 'rb') as input_file:
+        g_dict = pickle.load(input_file)
+    for key in g_graph_store_adjacencies:
+        g_dict[key] = _load_adjacency(path, key)
+    predicate_names = g_dict.pop('predicate_names', None)
+    if predicate_names is not None:
+        g_dict['edge_table'] = dict(
+            {key: np.load(os.path.join(path, f"edge_table-{key}.npy"),
+                          mmap_mode='r')
+             for key in g_edge_table_arrays},
+            predicate_names=predicate_names)
+    category_names = g_dict.pop('category_names', None)
+    if category_names is not None:
+        g_dict['node_categories'] = {
+            'codes': np.load(os.path.join(path, "node_categories.npy"),
+                             mmap_mode='r'),
+            'names': category_names}
+    if os.path.exists(os.path.join(path, "landmarks.npy")):
+        g_dict['landmark_index'] = {
+            key: np.load(os.path.join(path, f"{key}.npy"), mmap_mode='r')
+            for key in ('landmarks', 'forward', 'backward')}
+    if os.path.exists(os.path.join(path, "node_order.npy")):
+        g_dict['node_order'] = np.load(os.path.join(path, "node_order.npy"),
+                                       mmap_mode='r')
     return g_dict
 
 
+# Distances (in hops) from `source` to every node, by a breadth-first search
+# that expands a whole layer at a time with numpy; distances of
+# g_landmark_max_distance or more are stored as g_landmark_max_distance.
+def _bfs_distances(adj: _CSRAdjacency, source: int) -> np.ndarray:
+    dist = np.full(len(adj), g_landmark_unreachable, dtype=np.uint8)
+    dist[source] = 0
+    frontier = np.array([source], dtype=np.int64)
+    d = 0
+    while frontier.shape[0] > 0:
+        d += 1
+        starts = adj.indptr[frontier]
+        lens = adj.indptr[frontier + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(lens) - lens), lens)
+        neighbors = adj.indices[offsets + np.arange(offsets.shape[0])]
+        frontier = np.unique(neighbors[dist[neighbors] ==
+                                       g_landmark_unreachable])
+        dist[frontier] = min(d, g_landmark_max_distance)
+    return dist
+
+
+# The landmark index holds, for a set of hub nodes (the landmarks), the
+# distance from each landmark to every node ('forward') and from every node to
+# each landmark ('backward'), as uint8 arrays with one row per node (so that
+# the distances for a node are contiguous). By the triangle inequality, they
+# give a lower bound on the distance from s to t (see
+# `_distance_lower_bound`), which lets a query that has no path within its
+# cutoff return without doing either of the bounded BFS expansions.
+def build_landmark_index(g: Adjacency,
+                         g_inv: Adjacency,
+                         num_landmarks: int) -> dict[str, np.ndarray]:
+    if num_landmarks < 1:
+        raise ValueError(f"invalid number of landmarks: {num_landmarks}")
+    g_csr = g if isinstance(g, _CSRAdjacency) else _CSRAdjacency.from_sets(g)
+    g_inv_csr = g_inv if isinstance(g_inv, _CSRAdjacency) else \
+        _CSRAdjacency.from_sets(g_inv)
+    degrees = g_csr.degrees() + g_inv_csr.degrees()
+    num_landmarks = min(num_landmarks, len(g_csr))
+    landmarks = np.argsort(-degrees, kind='stable')[:num_landmarks]
+    forward = np.empty((len(g_csr), num_landmarks), dtype=np.uint8)
+    backward = np.empty((len(g_csr), num_landmarks), dtype=np.uint8)
+    for i, landmark in enumerate(landmarks.tolist()):
+        forward[:, i] = _bfs_distances(g_csr, landmark)
+        backward[:, i] = _bfs_distances(g_inv_csr, landmark)
+    return {'landmarks': landmarks, 'forward': forward, 'backward': backward}
+
+
+def _distance_lower_bound(landmark_index: dict[str, np.ndarray],
+                          s: int,
+                          t: int) -> int:
+    unreachable = g_landmark_unreachable
+    from_s = landmark_index['backward'][s]
+    from_t = landmark_index['backward'][t]
+    to_s = landmark_index['forward'][s]
+    to_t = landmark_index['forward'][t]
+    # if a landmark reaches s but not t, or t reaches a landmark that s
+    # doesn't, there is no path from s to t at all:
+    if np.any((to_s != unreachable) & (to_t == unreachable)) or \
+       np.any((from_t != unreachable) & (from_s == unreachable)):
+        return unreachable
+    # d(s, t) >= d(L, t) - d(L, s), and d(s, t) >= d(s, L) - d(t, L); a
+    # distance that is subtracted has to be exact, not capped:
+    exact = g_landmark_max_distance
+    bound_forward = np.where((to_s < exact) & (to_t != unreachable),
+                             to_t.astype(np.int16) - to_s, 0)
+    bound_backward = np.where((from_t < exact) & (from_s != unreachable),
+                              from_s.astype(np.int16) - from_t, 0)
+    return int(max(bound_forward.max(initial=0),
+                   bound_backward.max(initial=0)))
+
+
+def _query_is_impossible(s: int, t: int, n: int, undirected: bool) -> bool:
+    landmark_index = g_landmark_index
+    # (invalid queries are left to the path-finding code to report, and the
+    # landmark distances are for the directed graph)
+    if landmark_index is None or undirected or n <= 0 or s == t or \
+       not 0 <= s < landmark_index['forward'].shape[0] or \
+       not 0 <= t < landmark_index['forward'].shape[0]:
+        return False
+    return _distance_lower_bound(landmark_index, s, t) > n
+
+
+def _make_empty_paths(n: int) -> np.ndarray:
+    return np.full(shape=[0, n + 1], fill_value=g_np_graph_initializer,
+                   dtype=np.int32 if _using_cxx() else int)
+
+
+# The node table has one NumPy string array per node attribute ('id', and
+# if the node dicts are given, 'name' and 'category'), indexed by integer node
+# ID. Each array has one extra, empty entry at the end, so that the -1 padding
+# in a path array (which indexes the last entry) maps to "".
+def make_node_table(ids: Iterable[str],
+                    nodes: typing.Optional[Iterable[dict]] = None) -> \
+        dict[str, np.ndarray]:
+    string_dtype = np.dtypes.StringDType()
+    node_table = {'id': np.array((*ids, ''), dtype=string_dtype)}
+    if nodes is not None:
+        nodes = tuple(nodes)
+        for attribute in ('name', 'category'):
+            node_table[attribute] = np.array(
+                tuple(n.get(attribute) or '' for n in nodes) + ('',),
+                dtype=string_dtype)
+    return node_table
+
+
+def get_node_table(g_dict: dict) -> dict[str, np.ndarray]:
+    # graphs that were pickled before the node table was added only have the
+    # tuple of CURIEs:
+    if 'node_table' not in g_dict:
+        g_dict['node_table'] = make_node_table(g_dict['ids'])
+    return g_dict['node_table']
+
+
+# The category of each node as an int32 code (an index into the sorted tuple
+# of category names that is also returned), so that a metapath can be
+# checked during a search with an array lookup per node.
+def make_node_categories(node_table: dict[str, np.ndarray]) -> dict:
+    names, codes = np.unique(node_table['category'][:-1], return_inverse=True)
+    return {'codes': codes.astype(np.int32), 'names': tuple(names.tolist())}
+
+
+def get_node_categories(g_dict: dict) -> typing.Optional[dict]:
+    # (graphs that were pickled before the category codes were added, or that
+    # were updated by a graph delta, get them from the node table, if it has
+    # the categories)
+    if 'node_categories' not in g_dict:
+        node_table = get_node_table(g_dict)
+        g_dict['node_categories'] = make_node_categories(node_table) \
+            if 'category' in node_table else None
+    return g_dict['node_categories']
+
+
+# Translates a whole array of paths (as returned by `get_all_paths`) to
+# CURIEs (or to another node attribute in the node table) with one gather;
+# the -1 padding becomes "". Pass a node table rather than the `ids` tuple
+# when translating more than one array, so that the table is only built once.
+def paths_to_curies(paths_np: np.ndarray,
+                    node_table: typing.Union[dict[str, np.ndarray],
+                                             Iterable[str]],
+                    attribute: str = 'id') -> np.ndarray:
+    if not isinstance(node_table, dict):
+        node_table = make_node_table(node_table)
+    if attribute not in node_table:
+        raise ValueError(f"node table has no attribute: {attribute}")
+    return node_table[attribute][paths_np]
+
+
+# The predicate of each edge, as an index into the tuple of predicate names
+# (in order of first appearance) that is also returned.
+def _make_predicate_codes(edges: tuple[dict, ...]) -> \
+        tuple[np.ndarray, tuple[str, ...]]:
+    predicate_to_code: dict[str, int] = dict()
+    codes = np.fromiter((predicate_to_code.setdefault(
+        e.get('predicate') or '', len(predicate_to_code)) for e in edges),
+                        dtype=np.int32, count=len(edges))
+    return (codes, tuple(predicate_to_code))
+
+
+# An edge table holds all of the edges of the graph, including the parallel
+# edges that the adjacencies collapse into one, sorted by subject and then by
+# object, as CSR arrays: the edges out of node v are indptr[v]:indptr[v + 1],
+# and each edge has an 'object', an 'edge_id' (its index in the edges file,
+# or in the `subjects` and `objects` arrays) and a 'predicate' (an index into
+# 'predicate_names', whose last entry is the empty name for the -1 padding).
+def make_edge_table(subjects: np.ndarray,
+                    objects: np.ndarray,
+                    predicates: np.ndarray,
+                    predicate_names: Iterable[str],
+                    num_nodes: int,
+                    edge_ids: typing.Optional[np.ndarray] = None) -> \
+        dict[str, np.ndarray]:
+    order = np.lexsort((objects, subjects))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(subjects, minlength=num_nodes), out=indptr[1:])
+    return {'indptr': indptr,
+            'object': np.asarray(objects, dtype=np.int32)[order],
+            'edge_id': order if edge_ids is None
+            else np.asarray(edge_ids, dtype=np.int64)[order],
+            'predicate': np.asarray(predicates, dtype=np.int32)[order],
+            'predicate_names': np.array((*predicate_names, ''),
+                                        dtype=np.dtypes.StringDType())}
+
+
+def _get_edge_table_subjects(edge_table: dict[str, np.ndarray]) -> np.ndarray:
+    indptr = edge_table['indptr']
+    return np.repeat(np.arange(indptr.shape[0] - 1, dtype=np.int32),
+                     np.diff(indptr))
+
+
+def _relabel_edge_table(edge_table: dict[str, np.ndarray],
+                        new_index: np.ndarray) -> dict[str, np.ndarray]:
+    return make_edge_table(new_index[_get_edge_table_subjects(edge_table)],
+                           new_index[edge_table['object']],
+                           edge_table['predicate'],
+                           edge_table['predicate_names'][:-1],
+                           new_index.shape[0], edge_table['edge_id'])
+
+
+# The first of the edges from each of `subjects` to the matching one of
+# `objects`, as a position in the edge table, and the number of them; all
+# of the lookups are done together, by a binary search of the subjects'
+# (sorted) rows of the edge table.
+def _find_edges(edge_table: dict[str, np.ndarray],
+                subjects: np.ndarray,
+                objects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    indptr = edge_table['indptr']
+    edge_objects = edge_table['object']
+
+    def _search(right: bool) -> np.ndarray:
+        lo = indptr[subjects].astype(np.int64)
+        hi = indptr[subjects + 1].astype(np.int64)
+        while (active := lo < hi).any():
+            mid = (lo + hi) // 2
+            mid_objects = edge_objects[np.where(active, mid, 0)]
+            go_right = active & ((mid_objects <= objects) if right
+                                 else (mid_objects < objects))
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+        return lo
+    first = _search(False)
+    return (first, _search(True) - first)
+
+
+# The edges along each hop of each path in a path array (as returned by
+# `get_all_paths`, with n + 1 columns), looked up in an edge table (see
+# `make_edge_table`), as a dict of arrays with n columns, aligned with the
+# hops of the paths, and with -1 for the padding:
+#   'edge_id', 'predicate'  the edge's ID and predicate code
+#   'reversed'              whether the edge goes against the path (this
+#                           can only be the case for an undirected search)
+# If there are parallel edges along a hop, then with parallel_edges='count'
+# (the default) there is one row per path, holding the first of the edges,
+# and 'num_edges' holds the number of edges along each hop; with
+# parallel_edges='expand', there is a row for each combination of edges
+# along a path, and 'path_index' holds the row of the path for each row. A
+# hop with no edge along it (e.g., of a path found by an undirected search,
+# looked up with undirected=False) gets -1 in either mode, so both modes
+# report every path.
+def get_path_edges(edge_table: dict[str, np.ndarray],
+                   paths_np: np.ndarray,
+                   parallel_edges: str = 'count',
+                   undirected: bool = False) -> dict[str, np.ndarray]:
+    if parallel_edges not in g_parallel_edges_modes:
+        raise ValueError(f"invalid parallel edges mode: {parallel_edges}")
+    num_paths = paths_np.shape[0]
+    num_hops = max(0, paths_np.shape[1] - 1)
+    subjects = paths_np[:, :-1]
+    objects = paths_np[:, 1:]
+    valid = (subjects != g_np_graph_initializer) & \
+        (objects != g_np_graph_initializer)
+    first = np.full((num_paths, num_hops), -1, dtype=np.int64)
+    count = np.zeros((num_paths, num_hops), dtype=np.int64)
+    first[valid], count[valid] = _find_edges(edge_table, subjects[valid],
+                                             objects[valid])
+    reverse_first = np.full((num_paths, num_hops), -1, dtype=np.int64)
+    reverse_count = np.zeros((num_paths, num_hops), dtype=np.int64)
+    if undirected:
+        reverse_first[valid], reverse_count[valid] = _find_edges(
+            edge_table, objects[valid], subjects[valid])
+    num_edges = count + reverse_count
+    if parallel_edges == 'count':
+        reverse = (count == 0) & (reverse_count > 0)
+        positions = np.where(reverse, reverse_first,
+                             np.where(count > 0, first, -1))
+        result: dict[str, np.ndarray] = {
+            'num_edges': num_edges.astype(np.int32)}
+    else:
+        # the rows are expanded a hop at a time: a row gets a copy for each
+        # of the edges along the hop, which picks that edge
+        path_index = np.arange(num_paths)
+        positions = np.empty((num_paths, 0), dtype=np.int64)
+        reverse = np.empty((num_paths, 0), dtype=bool)
+        for hop in range(num_hops):
+            hop_valid = valid[path_index, hop]
+            repeats = np.where(hop_valid,
+                               np.maximum(num_edges[path_index, hop], 1), 1)
+            path_index = np.repeat(path_index, repeats)
+            positions = np.repeat(positions, repeats, axis=0)
+            reverse = np.repeat(reverse, repeats, axis=0)
+            k = np.arange(path_index.shape[0]) - \
+                np.repeat(np.cumsum(repeats) - repeats, repeats)
+            hop_count = count[path_index, hop]
+            hop_reverse = k >= hop_count
+            hop_positions = np.where(
+                hop_reverse,
+                reverse_first[path_index, hop] + k - hop_count,
+                first[path_index, hop] + k)
+            hop_found = valid[path_index, hop] & \
+                (num_edges[path_index, hop] > 0)
+            positions = np.column_stack(
+                (positions, np.where(hop_found, hop_positions, -1)))
+            reverse = np.column_stack((reverse, hop_found & hop_reverse))
+        result = {'path_index': path_index}
+    found = positions >= 0
+    safe_positions = np.where(found, positions, 0)
+    result['edge_id'] = np.where(found,
+                                 edge_table['edge_id'][safe_positions], -1)
+    result['predicate'] = np.where(
+        found, edge_table['predicate'][safe_positions], -1).astype(np.int32)
+    result['reversed'] = reverse
+    return result
+
+
+# A graph delta holds the changes from one version of the graph to the next:
+# the nodes that were added (which get the next free integer node IDs, so that
+# the IDs of the existing nodes don't change), and the edges that were added
+# and removed, as (subject, object) rows of integer node IDs. A node that is
+# gone from the new version keeps its ID, but loses all of its edges.
+def make_graph_delta(g_dict: dict,
+                     nodes: Iterable[dict],
+                     edges: Iterable[dict]) -> dict:
+    ids = g_dict['ids']
+    g = g_dict['g']
+    curie_to_index_map = {curie: i for i, curie in enumerate(ids)}
+    new_nodes = []
+    for node in nodes:
+        if node['id'] not in curie_to_index_map:
+            curie_to_index_map[node['id']] = len(curie_to_index_map)
+            new_nodes.append(node)
+    new_g: defaultdict[int, set[int]] = defaultdict(set)
+    for e in edges:
+        new_g[curie_to_index_map[e['subject']]].add(
+            curie_to_index_map[e['object']])
+    added_edges: list[tuple[int, int]] = []
+    removed_edges: list[tuple[int, int]] = []
+    no_edges: set[int] = set()
+    for s in range(len(curie_to_index_map)):
+        old_out = g[s] if s < len(g) else no_edges
+        new_out = new_g.get(s, no_edges)
+        if old_out != new_out:
+            added_edges.extend((s, t) for t in new_out - old_out)
+            removed_edges.extend((s, t) for t in old_out - new_out)
+    return {'base_version': g_dict.get('version', 0),
+            'base_num_nodes': len(ids),
+            'nodes': tuple(new_nodes),
+            'added_edges': np.array(added_edges,
+                                    dtype=np.int64).reshape(-1, 2),
+            'removed_edges': np.array(removed_edges,
+                                      dtype=np.int64).reshape(-1, 2)}
+
+
+def _extend_node_table(node_table: dict[str, np.ndarray],
+                       nodes: tuple[dict, ...]) -> dict[str, np.ndarray]:
+    # (the last entry of each column is the empty entry for the -1 padding)
+    return {attribute: np.concatenate(
+        (column[:-1],
+         np.array(tuple(n.get(attribute) or '' for n in nodes) + ('',),
+                  dtype=column.dtype)))
+            for attribute, column in node_table.items()}
+
+
+# Returns the next version of the graph, leaving `g_dict` unchanged; only the
+# adjacency sets of the nodes that the delta touches are copied, and the rest
+# are shared with the previous version, so the cost of an update is in
+# proportion to the size of the delta rather than the size of the graph.
+def apply_graph_delta(g_dict: dict, delta: dict) -> dict:
+    version = g_dict.get('version', 0)
+    if delta['base_version'] != version or \
+       delta['base_num_nodes'] != len(g_dict['ids']):
+        raise ValueError("graph delta does not apply to version "
+                         f"{version} of the graph")
+    nodes = delta['nodes']
+    base_num_nodes = delta['base_num_nodes']
+    g = list(g_dict['g']) + [set() for _ in nodes]
+    g_inv = list(g_dict['g_inv']) + [set() for _ in nodes]
+    copied: tuple[set[int], set[int]] = (set(), set())
+
+    def _own(adj: list[set[int]], which: int, v: int) -> set[int]:
+        if v < base_num_nodes and v not in copied[which]:
+            adj[v] = set(adj[v])
+            copied[which].add(v)
+        return adj[v]
+    for s, t in delta['removed_edges'].tolist():
+        _own(g, 0, s).discard(t)
+        _own(g_inv, 1, t).discard(s)
+    for s, t in delta['added_edges'].tolist():
+        _own(g, 0, s).add(t)
+        _own(g_inv, 1, t).add(s)
+    # (a delta doesn't record the parallel edges or the predicates, so the
+    # new version has no edge table; its category codes are made from the
+    # extended node table when they are needed)
+    return dict({key: value for key, value in g_dict.items()
+                 if key not in ('edge_table', 'node_categories')},
+                ids=g_dict['ids'] + tuple(n['id'] for n in nodes),
+                g=tuple(g),
+                g_inv=tuple(g_inv),
+                node_table=_extend_node_table(get_node_table(g_dict), nodes),
+                version=version + 1)
+
+
 def _get_args() -> argparse.Namespace:
+    import argparse
     arg_parser = argparse.ArgumentParser(description="findpaths.py: "
                                          "find paths between genes "
                                          "and symptoms in a large "
@@ -155,6 +1008,34 @@ def _get_args() -> argparse.Namespace:
                             default=None,
                             help='optional base filename for the output '
                             'file(s)')
+    arg_parser.add_argument('--writeStore',
+                            default=False,
+                            dest='write_store',
+                            action='store_true',
+                            help="write the graph to a graph store directory "
+                            "(memory-mappable CSR arrays)")
+    arg_parser.add_argument('--readStore',
+                            default=False,
+                            dest='read_store',
+                            action='store_true',
+                            help="read the graph from a graph store directory")
+    arg_parser.add_argument('--numLandmarks',
+                            type=int,
+                            default=0,
+                            dest='num_landmarks',
+                            help="with --writeStore, also write a landmark "
+                            "distance index of this many hub nodes, used to "
+                            "skip queries that have no path within the cutoff"
+                            " (default 0, no index)")
+    arg_parser.add_argument('--nodeOrder',
+                            type=str,
+                            choices=g_node_orders,
+                            default=None,
+                            dest='node_order',
+                            help="with --writeStore, renumber the nodes for "
+                            "cache locality: by descending degree, or in "
+                            "reverse Cuthill-McKee (bfs) order (default: the "
+                            "order of the nodes file)")
     arg_parser.add_argument('--readPickle',
                             default=False,
                             dest='read_pickle',
@@ -163,7 +1044,9 @@ def _get_args() -> argparse.Namespace:
     arg_parser.add_argument('--cutoff',
                             dest='cutoff',
                             type=int,
-                            help='maximum path length, in edge hops')
+                            help='maximum path length, in edge hops (with '
+                            '--multiNodeFileName, the default for the jobs '
+                            'that don\'t give a max-hops)')
     arg_parser.add_argument('--debug',
                             default=False,
                             action='store_true',
@@ -180,8 +1063,11 @@ def _get_args() -> argparse.Namespace:
                             default=g_default_end_node)
     arg_parser.add_argument('--multiNodeFileName',
                             type=str,
-                            help='name of a tab-delimited text file' +
-                            ' containing two columns of CURIES',
+                            help='name of a batch job file: tab-delimited '
+                            'text with a header line, JSON lines (.jsonl) or '
+                            'Parquet (.parquet), with the fields start, end '
+                            'and (optionally) max-hops, direction, exclude, '
+                            'limit and output',
                             default=g_default_multi_node_file_name)
     arg_parser.add_argument('--lang',
                             default='python',
@@ -196,6 +1082,143 @@ def _get_args() -> argparse.Namespace:
                             type=int,
                             dest='mult',
                             help='repeat the path-finding work N times')
+    arg_parser.add_argument('--numWorkers',
+                            default=None,
+                            type=int,
+                            dest='num_workers',
+                            help='number of worker processes to use for '
+                            'batch path-finding (default is the number of '
+                            'CPUs)')
+    arg_parser.add_argument('--serve',
+                            default=False,
+                            action='store_true',
+                            dest='serve',
+                            help='load the graph, then answer path queries '
+                            'sent as JSON lines or HTTP requests until '
+                            'interrupted')
+    arg_parser.add_argument('--host',
+                            default=g_default_serve_host,
+                            dest='host',
+                            help='host address for --serve or '
+                            '--coordinate to listen on '
+                            f'(default {g_default_serve_host})')
+    arg_parser.add_argument('--port',
+                            default=g_default_serve_port,
+                            type=int,
+                            dest='port',
+                            help='TCP port for --serve or --coordinate to '
+                            'listen on '
+                            f'(default {g_default_serve_port})')
+    arg_parser.add_argument('--unixSocket',
+                            default=None,
+                            dest='unix_socket',
+                            help='path of a Unix socket for --serve to '
+                            'listen on, instead of a TCP port')
+    arg_parser.add_argument('--maxPending',
+                            default=None,
+                            type=int,
+                            dest='max_pending',
+                            help='maximum number of queries that --serve '
+                            'will queue or run at a time (default is twice '
+                            'the number of workers)')
+    arg_parser.add_argument('--coordinate',
+                            default=False,
+                            action='store_true',
+                            dest='coordinate',
+                            help='without loading the graph, split the jobs '
+                            'of --multiNodeFileName into shards, hand them '
+                            'out to --workFor workers over TCP (listening on '
+                            '--host and --port), and write the paths for '
+                            'each shard to a file in the --outputPaths '
+                            'directory')
+    arg_parser.add_argument('--workFor',
+                            default=None,
+                            dest='work_for',
+                            metavar='HOST:PORT',
+                            help='load the graph, then run the shards of '
+                            'jobs handed out by the --coordinate process at '
+                            'HOST:PORT until they are all done')
+    arg_parser.add_argument('--shardSize',
+                            default=g_batch_shard_size,
+                            type=int,
+                            dest='shard_size',
+                            help='the number of jobs in each shard, for '
+                            f'--coordinate (default {g_batch_shard_size})')
+    arg_parser.add_argument('--updateFrom',
+                            default=None,
+                            dest='update_from',
+                            help='base filename of the JSON-lines files for '
+                            'a new version of the graph; the pickled graph '
+                            'is updated to match them (requires '
+                            '--readPickle)')
+    arg_parser.add_argument('--outputPaths',
+                            default=None,
+                            dest='output_paths',
+                            help='write the paths found for the batch to '
+                            'this file, either as an indexed binary file, '
+                            'or (if the filename ends in \'.parquet\') as '
+                            'a Parquet file of CURIE paths')
+    arg_parser.add_argument('--outputCompression',
+                            default=None,
+                            choices=('zstd', 'lz4'),
+                            dest='output_compression',
+                            help='compress the paths written with '
+                            '--outputPaths (and the edges written with '
+                            '--outputEdges)')
+    arg_parser.add_argument('--outputEdges',
+                            default=None,
+                            dest='output_edges',
+                            help='write the edges along each hop of the '
+                            'paths found for the batch (edge IDs, '
+                            'predicates, and whether each edge is reversed) '
+                            'to this Parquet file')
+    arg_parser.add_argument('--parallelEdges',
+                            default='count',
+                            choices=g_parallel_edges_modes,
+                            dest='parallel_edges',
+                            help='for --outputEdges, where there are '
+                            'parallel edges along a hop, give the first one '
+                            'and the number of them (count, the default), '
+                            'or a row for each combination of edges along a '
+                            'path (expand)')
+    arg_parser.add_argument('--resume',
+                            default=False,
+                            action='store_true',
+                            dest='resume',
+                            help='skip the jobs that an earlier run (that '
+                            'may have died) already wrote to --outputPaths, '
+                            'according to its journal file, and add the '
+                            'paths for the rest')
+    arg_parser.add_argument('--outputCounts',
+                            default=None,
+                            dest='output_counts',
+                            help='write the number of paths found for each '
+                            'job to this tab-delimited file (the paths for '
+                            'the jobs whose output is \'count\' aren\'t '
+                            'written to --outputPaths)')
+    arg_parser.add_argument('--queryStats',
+                            default=None,
+                            dest='query_stats',
+                            help='write per-phase query statistics, totalled '
+                            'over all of the queries, to this file (in '
+                            'Prometheus text format if the file name ends in '
+                            '\'.prom\', otherwise as JSON)')
+    arg_parser.add_argument('--maxMemoryGB',
+                            type=float,
+                            default=None,
+                            dest='max_memory_gb',
+                            help='the most memory (in GiB) that this process '
+                            'should use: refuse to run if the graph alone '
+                            'needs more, and in python mode, use fewer worker '
+                            'processes if need be (default: no limit)')
+    arg_parser.add_argument('--profile',
+                            default=False,
+                            action='store_true',
+                            help='run the jobs one at a time under a '
+                            'profiler, print the hottest functions, and write '
+                            'the profile (collapsed stacks, and in python '
+                            'mode, pstats) to files starting with the output '
+                            'base filename')
     return arg_parser.parse_args()
 
 
@@ -208,6 +1231,77 @@ def _invert_graph(g: tuple[set[int], ...]) -> tuple[set[int], ...]:
     return g_inv
 
 
+# Statistics for the queries run with a `stats` dict (see `make_query_stats`)
+# are added to that dict, so one dict can collect them over many queries. The
+# times are in seconds, per phase: the forward and reverse BFS expansions, the
+# join at the border nodes (which includes the simple-path filter), sorting
+# (C++ only), and conversion to a numpy array. The frontier sizes are the
+# numbers of half-paths found in each BFS layer; `candidate_paths` and `paths`
+# are the numbers of joined paths before and after the simple-path filter; and
+# `bytes_allocated` is (roughly) the size of the path data held by the BFS
+# results, the joined paths and the numpy array.
+def make_query_stats() -> dict:
+    return {'num_queries': 0,
+            'skipped_queries': 0,
+            'forward_bfs_seconds': 0.0,
+            'reverse_bfs_seconds': 0.0,
+            'join_seconds': 0.0,
+            'sort_seconds': 0.0,
+            'convert_seconds': 0.0,
+            'forward_frontier_sizes': [],
+            'reverse_frontier_sizes': [],
+            'border_nodes': 0,
+            'candidate_paths': 0,
+            'paths': 0,
+            'bytes_allocated': 0,
+            # (the C++ core keeps paths in arenas of blocks of rows; see
+            # `get_arena_stats`)
+            'arena_blocks': 0}
+
+
+def add_query_stats(stats: dict, other: dict) -> dict:
+    for key, value in other.items():
+        if isinstance(value, list):
+            total = stats.setdefault(key, [])
+            total.extend([0] * (len(value) - len(total)))
+            for i, v in enumerate(value):
+                total[i] += v
+        else:
+            stats[key] = stats.get(key, 0) + value
+    return stats
+
+
+def query_stats_to_json(stats: dict) -> str:
+    return json.dumps(stats, indent=2)
+
+
+def _format_prometheus_metrics(metrics: dict, prefix: str) -> str:
+    lines = []
+    for name, value in metrics.items():
+        metric_type = 'counter' if name.endswith('_total') else 'gauge'
+        lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+        if isinstance(value, list):
+            lines.extend(f"{prefix}_{name}{{layer=\"{layer}\"}} {v}"
+                         for layer, v in enumerate(value, 1))
+        else:
+            lines.append(f"{prefix}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# (all of the query statistics are totals over the queries, so they are
+# exported as counters)
+def query_stats_to_prometheus(stats: dict,
+                              prefix: str = 'findpaths_query') -> str:
+    return _format_prometheus_metrics({f"{name}_total": value
+                                       for name, value in stats.items()},
+                                      prefix)
+
+
+def _get_path_bytes(paths: Iterable[Iterable[tuple[int, ...]]]) -> int:
+    # (a path tuple holds a pointer for each node)
+    return 8 * sum(len(p) for path_set in paths for p in path_set)
+
+
 def _update_backpaths(backpaths: defaultdict[int, set[tuple[int, ...]]],
                       g_inv: tuple[set[int], ...],
                       nodes: set[int],
@@ -228,49 +1322,61 @@ def _update_backpaths(backpaths: defaultdict[int, set[tuple[int, ...]]],
     return backpaths[v] | res_set
 
 
-def _bfs_limited_paths(g: tuple[set[int], ...],
-                       g_inv: tuple[set[int], ...],
+def _bfs_limited_paths(g: Adjacency,
+                       g_inv: Adjacency,
                        v_start: int,
                        cutoff: int,
-                       reverse: bool) -> dict[int, set[tuple[int]]]:
+                       reverse: bool,
+                       cancel_token: typing.Optional['CancelToken'] = None,
+                       frontier_sizes: typing.Optional[list[int]] = None,
+                       categories: typing.Optional[np.ndarray] = None,
+                       metapath: typing.Optional[np.ndarray] = None,
+                       exclude: typing.Optional[typing.Container[int]] =
+                       None) \
+                       -> dict[int, set[tuple[int]]]:
     if cutoff < 0:
         raise ValueError(f"invalid distance cutoff: {cutoff}")
-    if cutoff == 0:
+    if cutoff == 0 or (exclude is not None and v_start in exclude):
         return dict()
-    queue = deque([v_start])
-    distances = defaultdict(lambda: -1)
     backpaths: defaultdict[int, set[tuple[int, ...]]] = defaultdict(set)
-    distances[v_start] = 0
-    backpaths[v_start].add((v_start,))
+    # With a metapath (the flags for the allowed category codes at each
+    # depth, see `_make_metapath_masks`), the branches that leave it are
+    # never expanded, and only the paths of exactly `cutoff` hops are kept,
+    # since the shorter ones can't be joined into a path that fits it:
+    if metapath is not None:
+        assert categories is not None
+        if not metapath[0][categories[v_start]]:
+            return dict()
+    else:
+        backpaths[v_start].add((v_start,))
     g_use = g_inv if reverse else g
-    while queue:
-        v = queue.popleft()
-        v_dist = distances[v]  # get the shortest-path distance to vertex v
-        if v_dist > cutoff:
+    # The simple paths from v_start are expanded one hop (layer) at a time,
+    # so every simple path of up to `cutoff` hops is found, regardless of
+    # the order in which the nodes are visited; `frontier` holds the paths
+    # that were found in the previous layer:
+    frontier: list[tuple[int, ...]] = [(v_start,)]
+    for d in range(cutoff):
+        next_frontier = []
+        allowed = metapath[d + 1] if metapath is not None else None
+        keep = allowed is None or d + 1 == cutoff
+        for p in frontier:
+            _check_cancelled(cancel_token)
+            v = p[0] if reverse else p[-1]
+            for v_neighb in g_use[v]:
+                if v_neighb in p or \
+                   (exclude is not None and v_neighb in exclude) or \
+                   (allowed is not None and categories is not None and
+                        not allowed[categories[v_neighb]]):
+                    continue
+                new_path = (v_neighb,) + p if reverse else p + (v_neighb,)
+                if keep:
+                    backpaths[v_neighb].add(new_path)
+                next_frontier.append(new_path)
+        frontier = next_frontier
+        if frontier_sizes is not None:
+            frontier_sizes.append(len(frontier))
+        if not frontier:
             break
-        elif v_dist == cutoff:
-            # no point in looking at neighbors for v; they
-            # are too far away
-            continue
-        for v_neighb in g_use[v]:
-            if distances[v_neighb] == -1:
-                # We have not reached v_neighb before.
-                # By definition, the distance to v_neighb
-                # must be the distance to v, plus one:
-                distances[v_neighb] = v_dist + 1
-                # We need to explore v_neighb; add to queue:
-                queue.append(v_neighb)
-            # Record a path back from v_neighb to v:
-            assert v in backpaths, f"could not find node {v_neighb} " + \
-                f"in backpaths, when node v is: {v}"
-            if not reverse:
-                for p in backpaths[v]:
-                    if len(p) < cutoff + 1:
-                        backpaths[v_neighb].add(p + (v_neighb,))
-            else:
-                for p in backpaths[v]:
-                    if len(p) < cutoff + 1:
-                        backpaths[v_neighb].add((v_neighb,) + p)
 
     return dict(typing.cast(dict[int, set[tuple[int]]],
                             backpaths))
@@ -282,83 +1388,283 @@ def _drop_first(i: tuple[int]) -> tuple[int, ...]:
     return tuple(rest)
 
 
-def _get_all_paths_ret_set(g: tuple[set[int], ...],
-                           g_inv: tuple[set[int], ...],
-                           s: int,
-                           t: int,
-                           n: int,
-                           debug: bool = False) -> set[tuple[int, ...]]:
-    if n <= 0:
-        raise ValueError(f"invalid value for n: {n}")
+# The two halves of the meet-in-the-middle search for the paths from s to t,
+# as a dict: 's_paths', the paths from the search's start node of up to 'n1'
+# hops, and 't_paths', the paths to its end node of up to n - n1 hops, both
+# grouped by the node at their other end (see `_bfs_limited_paths`);
+# 'border_nodes', the nodes (other than the end node) where they can be
+# joined, or this worker's share of them, when a single heavy pair is split
+# across workers; and 'direct', the paths found by the first half alone. If
+# the search was run from t, on the inverse graph (since there are fewer
+# paths to expand from t), 'reversed' is True, and the paths read backwards.
+def _search_halves(g: Adjacency,
+                   g_inv: Adjacency,
+                   s: int,
+                   t: int,
+                   n: int,
+                   debug: bool = False,
+                   part: int = 0,
+                   num_parts: int = 1,
+                   cancel_token: typing.Optional['CancelToken'] = None,
+                   collect_stats: bool = False,
+                   categories: typing.Optional[np.ndarray] = None,
+                   metapath: typing.Optional[np.ndarray] = None,
+                   exclude: typing.Optional[typing.Container[int]] = None) \
+                   -> dict:
+    if num_parts < 1 or part < 0 or part >= num_parts:
+        raise ValueError(f"invalid partition {part} of {num_parts}")
+    _check_query_nodes(len(g), s, t, n)
     n1, n2 = (n + 1) // 2, n // 2
+    reverse = False
     if n2 < n1:
         k_s = len(g[s])
         k_t = len(g_inv[t])
         if debug:
             print(f"k_s: {k_s}  k_t: {k_t}")
         if k_s > k_t:
-            return set(
-                map(tuple,
-                    map(reversed,
-                        _get_all_paths_ret_set(g_inv, g, t, s, n, debug))))
-    N = len(g)
-    if s > N - 1 or s < 0:
-        raise ValueError(f"source vertex is invalid: {s}")
-    if t > N - 1 or t < 0:
-        raise ValueError(f"target vertex is invalid: {t}")
-    if s == t:
-        raise ValueError("this function won't find a path between a node and "
-                         f"itself; value: {s}")
+            reverse = True
+            g, g_inv, s, t = g_inv, g, t, s
+            if metapath is not None:
+                metapath = metapath[::-1]
+    # (the frontier sizes are only collected if they are wanted)
+    frontier_sizes: tuple[typing.Optional[list[int]], ...] = \
+        ([], []) if collect_stats else (None, None)
     if debug:
         print(f"running bfs on node s with cutoff {n1}")
-    s_paths: dict[int, set[tuple[int]]] = _bfs_limited_paths(g, g_inv, s,
-                                                             cutoff=n1,
-                                                             reverse=False)
+    phase_start = timeit.default_timer()
+    s_paths: dict[int, set[tuple[int]]] = \
+        _bfs_limited_paths(g, g_inv, s, cutoff=n1, reverse=False,
+                           cancel_token=cancel_token,
+                           frontier_sizes=frontier_sizes[0],
+                           categories=categories,
+                           metapath=None if metapath is None
+                           else metapath[:n1 + 1],
+                           exclude=exclude)
+    forward_bfs_seconds = timeit.default_timer() - phase_start
     s_nodes = set(s_paths.keys())
     if debug:
         print(f"number of nodes found in paths of length {n1} "
               f"from starting vertex: {len(s_nodes)}")
     if debug:
         print(f"running bfs on node t with cutoff {n2}")
-    t_paths: dict[int, set[tuple[int]]] = _bfs_limited_paths(g, g_inv, t,
-                                                             cutoff=n2,
-                                                             reverse=True)
+    phase_start = timeit.default_timer()
+    t_paths: dict[int, set[tuple[int]]] = \
+        _bfs_limited_paths(g, g_inv, t, cutoff=n2, reverse=True,
+                           cancel_token=cancel_token,
+                           frontier_sizes=frontier_sizes[1],
+                           categories=categories,
+                           metapath=None if metapath is None
+                           else metapath[::-1][:n2 + 1],
+                           exclude=exclude)
+    reverse_bfs_seconds = timeit.default_timer() - phase_start
     t_nodes = set(t_paths.keys())
     if debug:
         print(f"number of nodes found in paths of length {n2} "
               f"from ending vertex: {len(t_nodes)}")
     border_nodes = s_nodes & t_nodes
-    res_set: set[tuple[int, ...]] = set()
+    direct: set[tuple[int]] = set()
 
     if t in s_nodes:
-        res_set |= s_paths[t]
+        # (with a metapath, a path to t from the forward BFS alone only fits
+        # it if the metapath is for paths of n1 hops)
+        if part == 0 and (metapath is None or n1 == n):
+            direct = s_paths[t]
         border_nodes = border_nodes - {t}
 
+    # When a single heavy pair is split across workers, each worker only
+    # does the join for its own share of the border nodes:
+    if num_parts > 1:
+        border_nodes = {b for b in border_nodes if b % num_parts == part}
+
     if debug:
         print(f"number of border nodes: {len(border_nodes)}")
-
+    return {'s_paths': s_paths,
+            't_paths': t_paths,
+            'border_nodes': border_nodes,
+            'direct': direct,
+            'n1': n1,
+            'reversed': reverse,
+            'forward_bfs_seconds': forward_bfs_seconds,
+            'reverse_bfs_seconds': reverse_bfs_seconds,
+            'frontier_sizes': frontier_sizes}
+
+
+def _add_halves_stats(stats: dict, halves: dict, other: dict):
+    s_paths, t_paths, n1 = halves['s_paths'], halves['t_paths'], halves['n1']
+    add_query_stats(stats, dict({
+        'forward_bfs_seconds': halves['forward_bfs_seconds'],
+        'reverse_bfs_seconds': halves['reverse_bfs_seconds'],
+        'forward_frontier_sizes': halves['frontier_sizes'][0],
+        'reverse_frontier_sizes': halves['frontier_sizes'][1],
+        'border_nodes': len(halves['border_nodes']),
+        'candidate_paths': sum(
+            sum(len(p) == n1 + 1 for p in s_paths[b]) * len(t_paths[b])
+            for b in halves['border_nodes'])}, **other))
+
+
+def _get_all_paths_ret_set(g: Adjacency,
+                           g_inv: Adjacency,
+                           s: int,
+                           t: int,
+                           n: int,
+                           debug: bool = False,
+                           part: int = 0,
+                           num_parts: int = 1,
+                           cancel_token: typing.Optional['CancelToken'] =
+                           None,
+                           stats: typing.Optional[dict] = None,
+                           categories: typing.Optional[np.ndarray] = None,
+                           metapath: typing.Optional[np.ndarray] = None,
+                           exclude: typing.Optional[typing.Container[int]] =
+                           None) -> \
+        set[tuple[int, ...]]:
+    halves = _search_halves(g, g_inv, s, t, n, debug, part, num_parts,
+                            cancel_token, stats is not None, categories,
+                            metapath, exclude)
+    s_paths, t_paths = halves['s_paths'], halves['t_paths']
+    border_nodes, n1 = halves['border_nodes'], halves['n1']
+    res_set: set[tuple[int, ...]] = set(halves['direct'])
+
+    # Every simple path of more than n1 hops passes through exactly one border
+    # node at position n1, so the join only needs the s-halves of exactly n1
+    # hops, and the results for different border nodes can't overlap:
+    phase_start = timeit.default_timer()
+    res_set.update(_join_border_nodes(s_paths, t_paths,
+                                      border_nodes, n1, cancel_token))
+    join_seconds = timeit.default_timer() - phase_start
+    if halves['reversed']:
+        res_set = set(map(tuple, map(reversed, res_set)))
+
+    if stats is not None:
+        _add_halves_stats(stats, halves, {
+            'join_seconds': join_seconds,
+            'paths': len(res_set),
+            'bytes_allocated': _get_path_bytes(it.chain(s_paths.values(),
+                                                        t_paths.values(),
+                                                        (res_set,)))})
+    return res_set
+
+
+def _join_border_nodes(s_paths: dict[int, set[tuple[int]]],
+                       t_paths: dict[int, set[tuple[int]]],
+                       border_nodes: Iterable[int],
+                       n1: int,
+                       cancel_token: typing.Optional['CancelToken'] = None) \
+                       -> list[tuple[int, ...]]:
+    res: list[tuple[int, ...]] = []
     for b in border_nodes:
-        res_set |= set(map(tuple,
-                           map(it.chain.from_iterable,
-                               it.product(*(s_paths[b],
-                                            map(_drop_first, t_paths[b]))))))
+        _check_cancelled(cancel_token)
+        t_halves = tuple(map(_drop_first, t_paths[b]))
+        for s_half in s_paths[b]:
+            if len(s_half) != n1 + 1:
+                continue
+            # both halves are simple paths, so the combined path is simple
+            # as long as the halves don't share a node:
+            s_half_nodes = set(s_half)
+            res.extend(s_half + t_half for t_half in t_halves
+                       if s_half_nodes.isdisjoint(t_half))
+    return res
+
+
+def _set_num_threads(num_threads: int):
+    global g_num_threads
+    if num_threads < 1:
+        raise ValueError(f"invalid number of threads: {num_threads}")
+    g_num_threads = num_threads
 
-    # At cutoff=4, a small proportion of paths will be non-simple; filter them
-    # out (this line of code is kind of slow (maybe 5% of total running time):
-    return set(filter(lambda path: len(set(path)) == len(path), res_set))
 
+def set_num_threads(num_threads: int):
+    g_module._set_num_threads(num_threads)
 
-def _set_graph(g: tuple[set[int], ...],
-               g_inv: tuple[set[int], ...]):
-    global g_g
-    global g_g_inv
-    g_g = g
-    g_g_inv = g_inv
 
+def _set_graph(g: Adjacency,
+               g_inv: Adjacency,
+               g_undirected: typing.Optional[Adjacency] = None,
+               node_categories: typing.Optional[np.ndarray] = None):
+    global g_graph
+    # (the undirected adjacency, if it isn't given, is built the first time
+    # that it is needed, and kept in the list)
+    g_graph = (g, g_inv, [] if g_undirected is None else [g_undirected],
+               node_categories)
 
-def set_graph(g: tuple[set[int], ...],
-              g_inv: tuple[set[int], ...]):
-    g_module._set_graph(g, g_inv)
+
+def _get_stored_graph(undirected: bool = False) -> tuple[Adjacency,
+                                                         Adjacency]:
+    graph = g_graph
+    if graph is None:
+        raise ValueError("cannot call _get_all_paths_np_cached_graph "
+                         "unless set_graph has previously been caled")
+    g, g_inv, undirected_cache, _ = graph
+    if not undirected:
+        return (g, g_inv)
+    if not undirected_cache:
+        undirected_cache.append(_make_undirected_adjacency(g, g_inv))
+    return (undirected_cache[0], undirected_cache[0])
+
+
+def _get_stored_node_categories() -> typing.Optional[np.ndarray]:
+    graph = g_graph
+    return None if graph is None else graph[3]
+
+
+def _prepare_undirected_graph():
+    _get_stored_graph(undirected=True)
+
+
+def _get_degrees(adj: Adjacency) -> np.ndarray:
+    if isinstance(adj, _CSRAdjacency):
+        return adj.degrees()
+    return np.fromiter(map(len, adj), dtype=np.int64, count=len(adj))
+
+
+def _set_degrees(g: Adjacency,
+                 g_inv: Adjacency):
+    global g_out_degree
+    global g_in_degree
+    global g_mean_degree
+    g_out_degree = _get_degrees(g)
+    g_in_degree = _get_degrees(g_inv)
+    g_mean_degree = max(1.0, float(g_out_degree.mean())) if len(g) else 1.0
+
+
+# `g_undirected` is optional; if it isn't given, the undirected adjacency is
+# built the first time that an undirected query is run. If `g_inv is g`, the
+# graph is taken to be undirected, and only stored once. `landmark_index` is
+# optional too (see `build_landmark_index`), as is `node_categories` (see
+# `make_node_categories`), which is needed for metapath queries.
+def set_graph(g: Adjacency,
+              g_inv: Adjacency,
+              g_undirected: typing.Optional[Adjacency] = None,
+              landmark_index: typing.Optional[dict[str, np.ndarray]] = None,
+              node_categories: typing.Optional[dict] = None):
+    global g_landmark_index
+    global g_node_categories
+    if landmark_index is not None and \
+       landmark_index['forward'].shape[0] != len(g):
+        raise ValueError("the landmark index is for a different graph")
+    codes = None
+    if node_categories is not None:
+        codes = np.ascontiguousarray(node_categories['codes'],
+                                     dtype=np.int32)
+        if codes.shape != (len(g),) or \
+           (len(g) > 0 and not 0 <= codes.min() <= codes.max() <
+                len(node_categories['names'])):
+            raise ValueError("the node categories are for a different graph")
+    if not _using_cxx():
+        _set_graph(g, g_inv, g_undirected, codes)
+    elif isinstance(g, _CSRAdjacency) and isinstance(g_inv, _CSRAdjacency):
+        undirected_arrays = (None, None) if g_undirected is None else \
+            (g_undirected.indptr, g_undirected.indices)  # type: ignore
+        g_module._set_graph_csr(g.indptr, g.indices, g_inv.indptr,
+                                g_inv.indices, *undirected_arrays,
+                                node_categories=codes)
+    else:
+        g_module._set_graph(g, g_inv, node_categories=codes)
+    # the degrees are needed (in the parent process, whichever language is
+    # being used) for estimating the cost of batch jobs:
+    _set_degrees(g, g_inv)
+    g_landmark_index = landmark_index
+    g_node_categories = node_categories
 
 
 def _get_all_paths_np(g: tuple[set[int], ...],
@@ -374,192 +1680,496 @@ def _get_all_paths_np(g: tuple[set[int], ...],
 def _get_all_paths_np_cached_graph(s: int,
                                    t: int,
                                    n: int,
-                                   debug: bool = False) -> np.ndarray:
-    if g_g is None or g_g_inv is None:
-        raise ValueError("cannot call _get_all_paths_np_cached_graph "
-                         "unless set_graph has previously been caled")
-    paths = _get_all_paths_ret_set(g_g, g_g_inv, s, t, n, debug)
-    return _convert_paths_from_ragged_list_to_np(paths, n)
+                                   debug: bool = False,
+                                   part: int = 0,
+                                   num_parts: int = 1,
+                                   cancel_token: typing.Optional['CancelToken']
+                                   = None,
+                                   undirected: bool = False,
+                                   stats: typing.Optional[dict] = None,
+                                   metapath: typing.Optional[np.ndarray] =
+                                   None,
+                                   exclude: typing.Optional[np.ndarray] =
+                                   None) -> \
+        np.ndarray:
+    # (a query keeps using the graph it started with, even if `set_graph` is
+    # called while it is running)
+    g, g_inv = _get_stored_graph(undirected)
+    categories = _get_stored_node_categories()
+    if metapath is not None and categories is None:
+        raise ValueError("the graph has no node categories")
+    paths = _get_all_paths_ret_set(g, g_inv, s, t, n, debug,
+                                   part, num_parts, cancel_token, stats,
+                                   categories, metapath,
+                                   None if exclude is None
+                                   else set(exclude.tolist()))
+    phase_start = timeit.default_timer()
+    paths_np = _convert_paths_from_ragged_list_to_np(paths, n)
+    if stats is not None:
+        # (a query whose border nodes are partitioned is only counted once)
+        add_query_stats(stats, {
+            'num_queries': int(part == 0),
+            'convert_seconds': timeit.default_timer() - phase_start,
+            'bytes_allocated': paths_np.nbytes})
+    return paths_np
 
 
+# The paths from s to t in the factored form that `get_all_paths_factored`
+# returns, built from the two halves of the search; the halves are put in the
+# orientation of the paths, so that the 'heads' run from s to a border node,
+# and the 'tails' from the border node to t.
+def _make_factored_paths(halves: dict, n: int) -> dict:
+    s_paths, t_paths, n1 = halves['s_paths'], halves['t_paths'], halves['n1']
+    reverse = halves['reversed']
+    heads: list[tuple[int, ...]] = []
+    tails: list[tuple[int, ...]] = []
+    border_nodes = []
+    head_offsets, tail_offsets = [0], [0]
+    for b in sorted(halves['border_nodes']):
+        s_halves = sorted(p for p in s_paths[b] if len(p) == n1 + 1)
+        if not s_halves:
+            continue
+        t_halves = sorted(t_paths[b])
+        if reverse:
+            s_halves, t_halves = \
+                sorted(p[::-1] for p in t_halves), \
+                sorted(p[::-1] for p in s_halves)
+        border_nodes.append(b)
+        heads.extend(s_halves)
+        tails.extend(t_halves)
+        head_offsets.append(len(heads))
+        tail_offsets.append(len(tails))
+    direct = halves['direct']
+    if reverse:
+        direct = [p[::-1] for p in direct]
+    n2 = n - n1
+    head_hops, tail_hops = (n2, n1) if reverse else (n1, n2)
+    return {'n': n,
+            'direct': _convert_paths_from_ragged_list_to_np(sorted(direct),
+                                                            n),
+            'border_nodes': np.array(border_nodes, dtype=int),
+            'heads': _convert_paths_from_ragged_list_to_np(heads, head_hops),
+            'head_offsets': np.array(head_offsets, dtype=np.int64),
+            'tails': _convert_paths_from_ragged_list_to_np(tails, tail_hops),
+            'tail_offsets': np.array(tail_offsets, dtype=np.int64)}
+
+
+def _get_all_paths_factored_cached_graph(s: int,
+                                         t: int,
+                                         n: int,
+                                         debug: bool = False,
+                                         part: int = 0,
+                                         num_parts: int = 1,
+                                         cancel_token:
+                                         typing.Optional['CancelToken'] =
+                                         None,
+                                         undirected: bool = False,
+                                         stats: typing.Optional[dict] = None,
+                                         metapath: typing.Optional[
+                                             np.ndarray] = None,
+                                         exclude: typing.Optional[
+                                             np.ndarray] = None) -> dict:
+    g, g_inv = _get_stored_graph(undirected)
+    categories = _get_stored_node_categories()
+    if metapath is not None and categories is None:
+        raise ValueError("the graph has no node categories")
+    halves = _search_halves(g, g_inv, s, t, n, debug, part, num_parts,
+                            cancel_token, stats is not None, categories,
+                            metapath, None if exclude is None
+                            else set(exclude.tolist()))
+    phase_start = timeit.default_timer()
+    factored = _make_factored_paths(halves, n)
+    if stats is not None:
+        _add_halves_stats(stats, halves, {
+            'num_queries': int(part == 0),
+            'convert_seconds': timeit.default_timer() - phase_start,
+            'bytes_allocated': sum(v.nbytes for v in factored.values()
+                                   if isinstance(v, np.ndarray))})
+    return factored
+
+
+def _make_skipped_query_paths(n: int,
+                              stats: typing.Optional[dict]) -> np.ndarray:
+    if stats is not None:
+        add_query_stats(stats, {'num_queries': 1, 'skipped_queries': 1})
+    return _make_empty_paths(n)
+
+
+# The node categories allowed at each position of a path of n hops, as a
+# uint8 flag for each category code. Each step of the metapath is a category
+# name (with or without its 'biolink:' prefix), a collection of them, or None
+# for any category.
+def _make_metapath_masks(metapath: typing.Sequence, n: int) -> np.ndarray:
+    node_categories = g_node_categories
+    if node_categories is None:
+        raise ValueError("the graph has no node categories")
+    if len(metapath) != n + 1:
+        raise ValueError(f"a metapath for paths of {n} hops must have "
+                         f"{n + 1} steps, not {len(metapath)}")
+    codes = {name: code for code, name in enumerate(node_categories['names'])}
+    masks = np.zeros((n + 1, len(codes)), dtype=np.uint8)
+    for position, step in enumerate(metapath):
+        if step is None:
+            masks[position] = 1
+            continue
+        for name in ((step,) if isinstance(step, str) else step):
+            code = codes.get(_curie_to_parts(name)[-1])
+            if code is None:
+                raise ValueError(f"unknown node category: {name}")
+            masks[position, code] = 1
+    return masks
+
+
+# With a `metapath` (a sequence of n + 1 steps, see `_make_metapath_masks`),
+# only the paths of exactly n hops whose nodes have the categories that it
+# allows at each position are found; the branches that leave the metapath
+# are pruned in both halves of the search. Likewise, the search never enters
+# the nodes in `exclude`, so only the paths that avoid them are found.
 def get_all_paths(s: int,
                   t: int,
                   n: int,
-                  debug: bool = False) -> np.ndarray:
-    return g_module._get_all_paths_np_cached_graph(s, t, n, debug)
-
-
-def _get_all_paths_lazy(g: tuple[set[int], ...],
-                        s: int,
-                        t: int,
-                        n: int,
-                        debug: bool = False) -> set[tuple[int]]:
-    g_inv = _invert_graph(g)
-    paths_np = g_module._get_all_paths_np(g, g_inv, s, t, n, debug)
-    return _convert_paths_from_np_to_ragged_list(paths_np)
-
-
-test_graphs_edgelist = {
-    'g1': ((0, 1),
-           (1, 2),
-           (2, 3),
-           (0, 4),
-           (4, 2)),  # this graph is a simple DAG
-    'g2': ((0, 1),
-           (1, 2),
-           (1, 3),
-           (2, 4),
-           (3, 4),
-           (4, 9),
-           (0, 5),
-           (5, 6),
-           (5, 7),
-           (6, 8),
-           (7, 8),
-           (8, 9),
-           (9, 0)),  # this graph has a cycle
-    'g3': ((0, 1),
-           (0, 2),
-           (1, 3),
-           (2, 3)),
-    'g4': ((0, 1),   # this graph is v1 with a shortcut
-           (1, 2),
-           (2, 3),
-           (0, 4),
-           (4, 2),
-           (0, 2)),
-    'g5': ((0, 1),
-           (1, 2),
-           (2, 1),
-           (1, 3))   # this graph has a cycle
-}
-
-
-def _make_test_graph_from_edgelist(el: tuple[tuple[int, int],
-                                             ...]) -> tuple[set[int], ...]:
-    N = max(max(s, t) for s, t in el) + 1
-    g: tuple[set[int], ...] = tuple(set() for _ in range(N))
-    for s, t in el:
-        g[s].add(t)
-    return g
-
-
-def _make_test_graphs(el_dict: dict[str,
-                                    tuple[tuple[int, int],
-                                          ...]]) \
-                                          -> dict[str, tuple[set[int], ...]]:
-    return {k: _make_test_graph_from_edgelist(v)
-            for k, v in el_dict.items()}
-
-
-test_graphs = _make_test_graphs(test_graphs_edgelist)
-
-
-def _results_are_all_ints(r: set[tuple[int]]) -> bool:
-    return all(isinstance(v, int) for p in r for v in p)
-
-
-def test_g3_two_paths_length_two(lang):
-    r = _get_all_paths_lazy(test_graphs['g3'], 0, 3, 2)
-    assert len(r) == 2
-
-
-def test_g1_no_path_insufficient_length():
-    r = _get_all_paths_lazy(test_graphs['g1'], 0, 2, 1)
-    assert not r
-
-
-def test_g1_no_path_against_edge_direction():
-    r = _get_all_paths_lazy(test_graphs['g1'], 3, 0, 3)
-    assert not r
-
-
-def test_g1_length_longer_than_needed():
-    r = _get_all_paths_lazy(test_graphs['g1'], 0, 3, 4)
-    assert r == {(0, 1, 2, 3),
-                 (0, 4, 2, 3)}
-
-
-def test_g1_length_exact_length():
-    r = _get_all_paths_lazy(test_graphs['g1'], 0, 3, 3)
-    assert r == {(0, 1, 2, 3),
-                 (0, 4, 2, 3)}
-
-
-def test_g1_one_hop():
-    r = _get_all_paths_lazy(test_graphs['g1'], 0, 4, 1)
-    assert len(r) == 1
-    assert _results_are_all_ints(r)
-    assert r == {(0, 4)}
-
-
-def test_g1_zero_length():
-    with pytest.raises(ValueError):
-        _get_all_paths_lazy(test_graphs['g1'], 0, 4, 0)
-
-
-def test_g1_self_edge():
-    with pytest.raises(ValueError):
-        _get_all_paths_lazy(test_graphs['g1'], 0, 0, 1)
-
-
-def test_g1_non_existing_vertex():
-    with pytest.raises(ValueError):
-        _get_all_paths_lazy(test_graphs['g1'], 0, 6, 2)
-
-
-def test_g1_length_2_single_path():
-    r = _get_all_paths_lazy(test_graphs['g1'], 4, 3, 2)
-    assert r == {(4, 2, 3)}
-
-
-def test_g2_length_4():
-    r = _get_all_paths_lazy(test_graphs['g2'], 0, 9, 4)
-    assert r == {(0, 1, 2, 4, 9),
-                 (0, 1, 3, 4, 9),
-                 (0, 5, 6, 8, 9),
-                 (0, 5, 7, 8, 9)}
-
-
-def test_g4_one_hop():
-    r = _get_all_paths_lazy(test_graphs['g4'], 0, 2, 1)
-    assert r == {(0, 2)}
-
-
-def test_g4_three_hop():
-    r = _get_all_paths_lazy(test_graphs['g4'], 0, 3, 3)
-    assert r == {(0, 2, 3),
-                 (0, 1, 2, 3),
-                 (0, 4, 2, 3)}
-
-
-def test_g4_three_hop_inv():
-    r = _get_all_paths_lazy(_invert_graph(test_graphs['g4']), 3, 0, 3)
-    assert r == {(3, 2, 0),
-                 (3, 2, 1, 0),
-                 (3, 2, 4, 0)}
-
-
-def test_bfs_g1_one_hop():
-    g = test_graphs['g1']
-    g_inv = _invert_graph(g)
-    r = g_module._bfs_limited_paths(g, g_inv, 0, 1, reverse=False)
-    assert r == {0: {(0,)}, 1: {(0, 1)}, 4: {(0, 4)}}
-
-
-def test_bfs_g1_one_hop_rev_drop_first():
-    g = test_graphs['g1']
-    g_inv = _invert_graph(g)
-    r = g_module._bfs_limited_paths(g_inv, g, 0, 1, reverse=True)
-    assert r == {0: {(0,)}, 1: {(1, 0)}, 4: {(4, 0)}}
+                  debug: bool = False,
+                  undirected: bool = False,
+                  stats: typing.Optional[dict] = None,
+                  metapath: typing.Optional[typing.Sequence] = None,
+                  exclude: typing.Optional[Iterable[int]] = None) -> \
+        np.ndarray:
+    masks = None if metapath is None else _make_metapath_masks(metapath, n)
+    if _query_is_impossible(s, t, n, undirected):
+        return _make_skipped_query_paths(n, stats)
+    return g_module._get_all_paths_np_cached_graph(
+        s, t, n, debug, undirected=undirected, stats=stats, metapath=masks,
+        exclude=_make_exclude_array(exclude))
+
+
+def _make_exclude_array(exclude: typing.Optional[Iterable[int]]) -> \
+        typing.Optional[np.ndarray]:
+    return None if exclude is None else \
+        np.fromiter(exclude, dtype=np.int32)
+
+
+def _make_empty_factored_paths(n: int) -> dict:
+    n1 = (n + 1) // 2
+    empty = _make_empty_paths(n)
+    return {'n': n,
+            'direct': empty,
+            'border_nodes': empty[:, 0].copy(),
+            'heads': empty[:, :n1 + 1].copy(),
+            'head_offsets': np.zeros(1, dtype=np.int64),
+            'tails': empty[:, :n - n1 + 1].copy(),
+            'tail_offsets': np.zeros(1, dtype=np.int64)}
+
+
+# The paths from s to t of up to n hops, without joining the halves of the
+# search: a dict with the 'direct' paths (that don't need joining), the
+# sorted 'border_nodes', and for the i'th border node, the 'heads' from s to
+# it in rows head_offsets[i]:head_offsets[i + 1], and the 'tails' from it to
+# t in rows tail_offsets[i]:tail_offsets[i + 1]. Every pairing of a head and
+# a tail of a border node that don't share a node (other than the border
+# node) is a path, so for a large result this takes a fraction of the memory
+# of the paths themselves; see `iter_factored_paths` and
+# `expand_factored_paths`.
+def get_all_paths_factored(s: int,
+                           t: int,
+                           n: int,
+                           debug: bool = False,
+                           undirected: bool = False,
+                           stats: typing.Optional[dict] = None,
+                           metapath: typing.Optional[typing.Sequence] =
+                           None,
+                           exclude: typing.Optional[Iterable[int]] = None) \
+        -> dict:
+    masks = None if metapath is None else _make_metapath_masks(metapath, n)
+    if _query_is_impossible(s, t, n, undirected):
+        _make_skipped_query_paths(n, stats)
+        return _make_empty_factored_paths(n)
+    return g_module._get_all_paths_factored_cached_graph(
+        s, t, n, debug, undirected=undirected, stats=stats, metapath=masks,
+        exclude=_make_exclude_array(exclude))
+
+
+# Merges the factored paths of the parts of a query whose border nodes were
+# partitioned across workers.
+def _concatenate_factored_paths(parts: list[dict]) -> dict:
+    order = np.argsort(np.concatenate([p['border_nodes'] for p in parts]),
+                       kind='stable')
+    res = {'n': parts[0]['n'],
+           'direct': np.concatenate([p['direct'] for p in parts]),
+           'border_nodes': np.concatenate(
+               [p['border_nodes'] for p in parts])[order]}
+    for name in ('heads', 'tails'):
+        offsets = [p[f"{name[:-1]}_offsets"] for p in parts]
+        starts = np.concatenate([o[:-1] + sum(len(p[name]) for p in
+                                              parts[:i])
+                                 for i, (p, o) in
+                                 enumerate(zip(parts, offsets))])[order]
+        counts = np.concatenate([np.diff(o) for o in offsets])[order]
+        rows = np.concatenate([p[name] for p in parts])
+        res[name] = rows[np.repeat(starts - np.cumsum(counts) + counts,
+                                   counts) + np.arange(counts.sum())]
+        res[f"{name[:-1]}_offsets"] = np.concatenate(
+            ([0], np.cumsum(counts))).astype(np.int64)
+    return res
 
 
-def test_g5_non_simple_path():
-    r = _get_all_paths_lazy(test_graphs['g5'], 0, 3, 4)
-    assert r == {(0, 1, 3)}
+# Expands factored paths (see `get_all_paths_factored`) into arrays of
+# padded paths, of up to about `max_rows` paths at a time (but at least all
+# of the paths through one head of a border node), so that the paths of a
+# large result can be processed without all of them being held in memory.
+def iter_factored_paths(factored: dict,
+                        max_rows: int = 1 << 20) -> Iterator[np.ndarray]:
+    if max_rows < 1:
+        raise ValueError(f"invalid maximum number of rows: {max_rows}")
+    n = factored['n']
+    direct = factored['direct']
+    if len(direct):
+        yield direct
+    heads, tails = factored['heads'], factored['tails']
+    head_offsets, tail_offsets = \
+        factored['head_offsets'], factored['tail_offsets']
+    for i in range(len(factored['border_nodes'])):
+        b_tails = tails[tail_offsets[i]:tail_offsets[i + 1]]
+        b_heads = heads[head_offsets[i]:head_offsets[i + 1]]
+        head_lens = (b_heads != g_np_graph_initializer).sum(axis=1)
+        heads_per_chunk = max(1, max_rows // max(1, len(b_tails)))
+        # (the heads of a border node can differ in length, if the search
+        # was run from t, so the heads of each length are joined together)
+        for head_len in np.unique(head_lens):
+            len_heads = b_heads[head_lens == head_len, :head_len]
+            for start in range(0, len(len_heads), heads_per_chunk):
+                chunk = len_heads[start:start + heads_per_chunk]
+                h = np.repeat(chunk, len(b_tails), axis=0)
+                tl = np.tile(b_tails[:, 1:], (len(chunk), 1))
+                # both halves are simple paths, so the joined path is simple
+                # as long as they don't share a node:
+                simple = ~(h[:, :-1, None] == tl[:, None, :]).any(axis=(1, 2))
+                paths_np = np.full((int(simple.sum()), n + 1),
+                                   g_np_graph_initializer, dtype=direct.dtype)
+                paths_np[:, :head_len] = h[simple]
+                width = min(tl.shape[1], n + 1 - head_len)
+                paths_np[:, head_len:head_len + width] = \
+                    tl[simple, :width]
+                if len(paths_np):
+                    yield paths_np
+
+
+def expand_factored_paths(factored: dict) -> np.ndarray:
+    return np.concatenate([_make_empty_paths(factored['n'])
+                           .astype(factored['direct'].dtype),
+                           *iter_factored_paths(factored)])
+
+
+def _check_query_nodes(num_nodes: int, s: int, t: int, n: int):
+    if n <= 0:
+        raise ValueError(f"invalid value for n: {n}")
+    if s > num_nodes - 1 or s < 0:
+        raise ValueError(f"source vertex is invalid: {s}")
+    if t > num_nodes - 1 or t < 0:
+        raise ValueError(f"target vertex is invalid: {t}")
+    if s == t:
+        raise ValueError("this function won't find a path between a node and "
+                         f"itself; value: {s}")
 
 
-def _convert_paths_from_ragged_list_to_np(paths: set[tuple[int, ...]],
+# The nodes on the shortest paths of up to `max_n` hops from s to t, as one
+# set per position along the paths (or an empty list, if there is no such
+# path). A bidirectional BFS expands a whole layer of whichever side has the
+# smaller frontier, until the two sides meet; every shortest path then goes
+# through the nodes where they met, and the nodes on the shortest paths are
+# found by walking back from them on each side. The nodes in `banned` are
+# never entered, nor are the edges from s to the nodes in `banned_first_hops`
+# (for the spur paths of `_get_k_shortest_simple_paths`).
+def _shortest_path_layers(g: Adjacency,
+                          g_inv: Adjacency,
+                          s: int,
+                          t: int,
+                          max_n: int,
+                          banned: typing.Collection[int] = (),
+                          banned_first_hops: typing.Collection[int] = (),
+                          cancel_token: typing.Optional['CancelToken'] =
+                          None) -> list[set[int]]:
+    def _edge_allowed(u: int, v: int) -> bool:
+        return u != s or v not in banned_first_hops
+    adjs = (g, g_inv)
+    dist: tuple[dict[int, int], dict[int, int]] = ({s: 0}, {t: 0})
+    frontiers: list[list[int]] = [[s], [t]]
+    radius = [0, 0]
+    meeting: set[int] = set()
+    while not meeting:
+        if radius[0] + radius[1] >= max_n or \
+           not frontiers[0] or not frontiers[1]:
+            return []
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        seen, other = dist[side], dist[1 - side]
+        radius[side] += 1
+        next_frontier = []
+        for u in frontiers[side]:
+            _check_cancelled(cancel_token)
+            for v in adjs[side][u]:
+                if v in seen or v in banned or \
+                   not (_edge_allowed(u, v) if side == 0
+                        else _edge_allowed(v, u)):
+                    continue
+                seen[v] = radius[side]
+                next_frontier.append(v)
+                if v in other:
+                    meeting.add(v)
+        frontiers[side] = next_frontier
+    n, k = sum(radius), radius[0]
+    layers: list[set[int]] = [set() for _ in range(n + 1)]
+    layers[k] = meeting
+    for i in range(k - 1, -1, -1):
+        layers[i] = {u for v in layers[i + 1] for u in g_inv[v]
+                     if dist[0].get(u) == i and _edge_allowed(u, v)}
+    for i in range(k + 1, n + 1):
+        layers[i] = {v for u in layers[i - 1] for v in g[u]
+                     if dist[1].get(v) == n - i and _edge_allowed(u, v)}
+    return layers
+
+
+def _get_shortest_paths(g: Adjacency,
+                        g_inv: Adjacency,
+                        s: int,
+                        t: int,
+                        max_n: int,
+                        cancel_token: typing.Optional['CancelToken'] =
+                        None) -> list[tuple[int, ...]]:
+    _check_query_nodes(len(g), s, t, max_n)
+    layers = _shortest_path_layers(g, g_inv, s, t, max_n,
+                                   cancel_token=cancel_token)
+    if not layers:
+        return []
+    # (every node in a layer is on a shortest path, so no branch is a dead
+    # end)
+    paths: list[tuple[int, ...]] = [(s,)]
+    for layer in layers[1:]:
+        _check_cancelled(cancel_token)
+        paths = [p + (v,) for p in paths for v in g[p[-1]] if v in layer]
+    return sorted(paths)
+
+
+# Yen's algorithm, for the k simple paths of up to `max_n` hops that come
+# first in order of length, then node by node: each path after the first is
+# the best of the candidates made by taking a prefix (the root) of a path
+# already found, and extending it from its last node (the spur node) by the
+# first shortest path to t that avoids the root's other nodes and the edges
+# that the paths already found take from the spur node.
+def _get_k_shortest_simple_paths(g: Adjacency,
+                                 g_inv: Adjacency,
+                                 s: int,
+                                 t: int,
+                                 k: int,
+                                 max_n: int,
+                                 cancel_token: typing.Optional['CancelToken']
+                                 = None) -> list[tuple[int, ...]]:
+    import heapq
+    _check_query_nodes(len(g), s, t, max_n)
+    if k < 1:
+        raise ValueError(f"invalid value for k: {k}")
+
+    def _first_shortest_path(spur: int,
+                             max_hops: int,
+                             banned: set[int],
+                             banned_first_hops: set[int]) -> \
+            typing.Optional[tuple[int, ...]]:
+        layers = _shortest_path_layers(g, g_inv, spur, t, max_hops, banned,
+                                       banned_first_hops, cancel_token)
+        if not layers:
+            return None
+        # (the layers leave out the banned edges)
+        path = [spur]
+        for layer in layers[1:]:
+            path.append(min(v for v in g[path[-1]] if v in layer))
+        return tuple(path)
+    first = _first_shortest_path(s, max_n, set(), set())
+    if first is None:
+        return []
+    found = [first]
+    candidates: list[tuple[int, tuple[int, ...]]] = []
+    seen = {first}
+    while len(found) < k:
+        previous = found[-1]
+        for i in range(len(previous) - 1):
+            root = previous[:i + 1]
+            spur_path = _first_shortest_path(
+                previous[i], max_n - i, set(root[:-1]),
+                {p[i + 1] for p in found if p[:i + 1] == root})
+            if spur_path is not None and \
+               root[:-1] + spur_path not in seen:
+                seen.add(root[:-1] + spur_path)
+                heapq.heappush(candidates, (len(spur_path) + i,
+                                            root[:-1] + spur_path))
+        if not candidates:
+            break
+        found.append(heapq.heappop(candidates)[1])
+    return found
+
+
+def _get_shortest_paths_np_cached_graph(s: int,
+                                        t: int,
+                                        max_n: int,
+                                        debug: bool = False,
+                                        cancel_token: typing.Optional[
+                                            'CancelToken'] = None,
+                                        undirected: bool = False) -> \
+        np.ndarray:
+    g, g_inv = _get_stored_graph(undirected)
+    paths = _get_shortest_paths(g, g_inv, s, t, max_n, cancel_token)
+    if debug:
+        print(f"found {len(paths)} shortest paths")
+    return _convert_paths_from_ragged_list_to_np(paths, max_n)
+
+
+def _get_k_shortest_simple_paths_np_cached_graph(s: int,
+                                                 t: int,
+                                                 k: int,
+                                                 max_n: int,
+                                                 debug: bool = False,
+                                                 cancel_token:
+                                                 typing.Optional[
+                                                     'CancelToken'] = None,
+                                                 undirected: bool = False) \
+        -> np.ndarray:
+    g, g_inv = _get_stored_graph(undirected)
+    paths = _get_k_shortest_simple_paths(g, g_inv, s, t, k, max_n,
+                                         cancel_token)
+    if debug:
+        print(f"found {len(paths)} of the {k} shortest simple paths")
+    return _convert_paths_from_ragged_list_to_np(paths, max_n)
+
+
+# All of the shortest paths from s to t, if they have at most `max_n` hops,
+# in the padded format of `get_all_paths` (with `max_n + 1` columns), sorted.
+# Only the nodes on the shortest paths are expanded, so this is much cheaper
+# than `get_all_paths` for pairs of hubs.
+def get_shortest_paths(s: int,
+                       t: int,
+                       max_n: int,
+                       debug: bool = False,
+                       undirected: bool = False) -> np.ndarray:
+    if _query_is_impossible(s, t, max_n, undirected):
+        return _make_empty_paths(max_n)
+    return g_module._get_shortest_paths_np_cached_graph(
+        s, t, max_n, debug, undirected=undirected)
+
+
+# The k shortest simple paths from s to t of at most `max_n` hops (fewer, if
+# there aren't k of them), in order of length, then node by node, in the
+# padded format of `get_all_paths`.
+def get_k_shortest_simple_paths(s: int,
+                                t: int,
+                                k: int,
+                                max_n: int,
+                                debug: bool = False,
+                                undirected: bool = False) -> np.ndarray:
+    if _query_is_impossible(s, t, max_n, undirected):
+        return _make_empty_paths(max_n)
+    return g_module._get_k_shortest_simple_paths_np_cached_graph(
+        s, t, k, max_n, debug, undirected=undirected)
+
+
+def _convert_paths_from_ragged_list_to_np(paths: typing.Collection[
+                                              tuple[int, ...]],
                                           cutoff: int) -> np.ndarray:
     num_paths = len(paths)
     paths_np = np.full(shape=[num_paths, cutoff + 1], dtype=int,
@@ -592,16 +2202,883 @@ def _return_paths_are_valid(g: tuple[set, ...],
                    path_list))
 
 
+# A unit of work for a batch worker: (job index, s, t, n, part, num_parts)
+BatchWorkItem = tuple[int, int, int, int, int, int]
+
+
+# Rough estimates of the number of half-paths found by each of the two
+# bounded BFS expansions, or None if the degrees of s and t aren't known
+def _estimate_num_half_paths(s: int, t: int, n: int) -> \
+        typing.Optional[tuple[float, float]]:
+    if g_out_degree is None or g_in_degree is None or \
+       not 0 <= s < len(g_out_degree) or not 0 <= t < len(g_in_degree):
+        return None
+    n1, n2 = (n + 1) // 2, n // 2
+    s_est = 1.0 + g_out_degree[s] * g_mean_degree ** max(n1 - 1, 0)
+    t_est = 1.0 + (g_in_degree[t] * g_mean_degree ** (n2 - 1)
+                   if n2 > 0 else 0.0)
+    return (float(s_est), float(t_est))
+
+
+def _estimate_search_cost(s: int, t: int, n: int) -> float:
+    num_half_paths = _estimate_num_half_paths(s, t, n)
+    return 0.0 if num_half_paths is None else sum(num_half_paths)
+
+
+# The cost of a job is that of the two searches, plus that of the join, which
+# is about the product of the numbers of half-paths:
+def _estimate_job_cost(s: int, t: int, n: int) -> float:
+    num_half_paths = _estimate_num_half_paths(s, t, n)
+    if num_half_paths is None:
+        return 1.0
+    s_est, t_est = num_half_paths
+    return s_est * t_est + s_est + t_est
+
+
+def _plan_batch_tasks(job_data: tuple[tuple[int, int, int], ...],
+                      costs: list[float],
+                      num_workers: int) -> list[list[BatchWorkItem]]:
+    total_cost = sum(costs)
+    fair_share = total_cost / num_workers
+    chunk_target = fair_share / g_batch_chunks_per_worker
+    items: list[tuple[float, BatchWorkItem]] = []
+    # longest-first, so that the heavy jobs don't end up as stragglers:
+    for i in sorted(range(len(job_data)), key=lambda i: -costs[i]):
+        s, t, n = job_data[i]
+        # a job that would take more than its fair share of the batch's wall
+        # time gets its border nodes partitioned across several workers; each
+        # part still runs both of the searches, and only the join is split:
+        search_cost = min(_estimate_search_cost(s, t, n), costs[i])
+        join_cost = costs[i] - search_cost
+        num_parts = max(1, min(num_workers, math.ceil(
+            join_cost / max(fair_share - search_cost,
+                            fair_share / num_workers))))
+        items.extend((search_cost + join_cost / num_parts,
+                      (i, s, t, n, part, num_parts))
+                     for part in range(num_parts))
+    tasks: list[list[BatchWorkItem]] = []
+    chunk: list[BatchWorkItem] = []
+    chunk_cost = 0.0
+    for cost, item in items:
+        if cost >= chunk_target:
+            tasks.append([item])
+        else:
+            chunk.append(item)
+            chunk_cost += cost
+            if chunk_cost >= chunk_target:
+                tasks.append(chunk)
+                chunk, chunk_cost = [], 0.0
+    if chunk:
+        tasks.append(chunk)
+    return tasks
+
+
+# A batch job's 'limit' option, if it has one, keeps the first `limit` of the
+# paths that it finds (or, for a 'count' job, counts at most `limit` of them).
+def _apply_job_limit(res: typing.Union[np.ndarray, int],
+                     options: dict) -> typing.Union[np.ndarray, int]:
+    limit = options.get('limit')
+    if limit is None:
+        return res
+    return min(res, limit) if isinstance(res, int) else res[:limit]
+
+
+def _iter_all_paths_batch(job_data: tuple[tuple[int, int, int], ...],
+                          debug: bool,
+                          num_workers: int,
+                          busy_times: dict[int, float],
+                          undirected: bool = False,
+                          stats: typing.Optional[dict] = None,
+                          factored: bool = False,
+                          job_options: typing.Optional[
+                              typing.Sequence[dict]] = None) -> \
+        Iterator[tuple[int, typing.Any]]:
+    # Each job can have options (`job_options`, a dict per job): 'exclude',
+    # an array of the nodes that its search must not enter, 'count', which
+    # makes the job's result the number of its paths, so that only the
+    # number is sent back from the worker, and 'limit' (see
+    # `_apply_job_limit`), which is applied in the worker too. With
+    # `factored`, the workers send back the paths in the factored form (see
+    # `get_all_paths_factored`), which is much smaller to pickle (but can't
+    # be limited, so a job with a limit gets its paths as an array).
+    def _query(s: int, t: int, n: int, part: int, num_parts: int,
+               options: dict, query_stats: typing.Optional[dict]):
+        if factored and not options.get('count') and \
+           options.get('limit') is None:
+            query = g_module._get_all_paths_factored_cached_graph
+        else:
+            query = g_module._get_all_paths_np_cached_graph
+        res = query(s, t, n, debug, part, num_parts, undirected=undirected,
+                    stats=query_stats, exclude=options.get('exclude'))
+        return _apply_job_limit(res.shape[0] if options.get('count') else res,
+                                options)
+
+    def _run_batch_task(task: list[tuple[BatchWorkItem, dict]]) -> \
+            tuple[int, float, list[tuple[int, int, typing.Any]],
+                  typing.Optional[dict]]:
+        start = timeit.default_timer()
+        task_stats = make_query_stats() if stats is not None else None
+        res = [(i, num_parts,
+                _query(s, t, n, part, num_parts, options, task_stats))
+               for (i, s, t, n, part, num_parts), options in task]
+        return (os.getpid(), timeit.default_timer() - start, res, task_stats)
+
+    def _get_options(i: int) -> dict:
+        return {} if job_options is None else job_options[i]
+
+    def _merge_parts(i: int, parts: list):
+        options = _get_options(i)
+        if options.get('count'):
+            return _apply_job_limit(sum(parts), options)
+        if factored and options.get('limit') is None:
+            return _concatenate_factored_paths(parts)
+        return _apply_job_limit(np.concatenate(parts), options)
+    if num_workers < 1:
+        raise ValueError(f"invalid number of workers: {num_workers}")
+    # the jobs that the landmark index shows to have no paths are done
+    # straight away:
+    skipped = {i for i, (s, t, n) in enumerate(job_data)
+               if _query_is_impossible(s, t, n, undirected)}
+    for i in sorted(skipped):
+        paths_np = _make_skipped_query_paths(job_data[i][2], stats)
+        yield (i, 0 if _get_options(i).get('count') else
+               _make_empty_factored_paths(job_data[i][2])
+               if factored and _get_options(i).get('limit') is None
+               else paths_np)
+    if len(skipped) == len(job_data):
+        return
+    if len(job_data) == 1:
+        # a single pair is better served by the intra-query parallelism
+        # than by splitting it across worker processes:
+        start = timeit.default_timer()
+        res = _query(*job_data[0], 0, 1, _get_options(0), stats)
+        busy_times[os.getpid()] = timeit.default_timer() - start
+        yield (0, res)
+        return
+    if undirected:
+        # build the undirected graph before the worker processes are forked,
+        # so that they share it rather than each building their own:
+        g_module._prepare_undirected_graph()
+    costs = [0.0 if i in skipped else _estimate_job_cost(s, t, n)
+             for i, (s, t, n) in enumerate(job_data)]
+    tasks = [task for task in
+             ([(item, _get_options(item[0])) for item in task
+               if item[0] not in skipped]
+              for task in _plan_batch_tasks(job_data, costs, num_workers))
+             if task]
+    parts_done: defaultdict[int, list] = defaultdict(list)
+    # share the CPUs between the worker processes, so that the C++ threads
+    # don't oversubscribe them:
+    threads_per_worker = max(1, multiprocess.cpu_count() // num_workers)
+    with multiprocess.Pool(num_workers,
+                           initializer=set_num_threads,
+                           initargs=(threads_per_worker,)) as mp_pool:
+        # chunksize=1 because the tasks have already been chunked by cost;
+        # idle workers pull the next task as soon as they are done:
+        for pid, busy_time, res, task_stats in mp_pool.imap_unordered(
+                _run_batch_task, tasks, chunksize=1):
+            busy_times[pid] = busy_times.get(pid, 0.0) + busy_time
+            if stats is not None:
+                add_query_stats(stats, task_stats)
+            for i, num_parts, paths_np in res:
+                if num_parts == 1:
+                    yield (i, paths_np)
+                    continue
+                parts_done[i].append(paths_np)
+                if len(parts_done[i]) == num_parts:
+                    yield (i, _merge_parts(i, parts_done.pop(i)))
+
+
+def _get_all_paths_batch(job_data: tuple[tuple[int, int, int], ...],
+                         debug: bool,
+                         num_workers: typing.Optional[int] = None,
+                         undirected: bool = False,
+                         stats: typing.Optional[dict] = None,
+                         factored: bool = False) -> \
+        tuple[list, dict[int, float]]:
+    if num_workers is None:
+        num_workers = multiprocess.cpu_count()
+    res: list = [None] * len(job_data)
+    busy_times: dict[int, float] = dict()
+    for i, paths_np in _iter_all_paths_batch(job_data, debug, num_workers,
+                                             busy_times, undirected, stats,
+                                             factored):
+        res[i] = paths_np
+        _check_memory_limit()
+    return (res, busy_times)
+
+
+# With `factored`, the paths of each job are in the factored form that
+# `get_all_paths_factored` returns.
 def get_all_paths_batch(job_data: tuple[tuple[int, int, int], ...],
-                        debug: bool) -> list[np.ndarray]:
-    def _get_all_paths_internal(s: int,
-                                t: int,
-                                n: int) -> np.ndarray:
-        return g_module._get_all_paths_np_cached_graph(s, t, n, debug)
-    with multiprocess.Pool() as mp_pool:
-        res = mp_pool.starmap(_get_all_paths_internal,
-                              job_data)
-    return res
+                        debug: bool,
+                        num_workers: typing.Optional[int] = None,
+                        undirected: bool = False,
+                        stats: typing.Optional[dict] = None,
+                        factored: bool = False) -> list:
+    return _get_all_paths_batch(job_data, debug, num_workers, undirected,
+                                stats, factored)[0]
+
+
+# Yields (job index, paths) for each job as soon as it is done, so that the
+# paths for the whole batch don't have to be held in memory at once.
+def iter_all_paths_batch(job_data: tuple[tuple[int, int, int], ...],
+                         debug: bool,
+                         num_workers: typing.Optional[int] = None,
+                         undirected: bool = False,
+                         stats: typing.Optional[dict] = None,
+                         factored: bool = False) -> \
+        Iterator[tuple[int, typing.Any]]:
+    if num_workers is None:
+        num_workers = multiprocess.cpu_count()
+    return _iter_all_paths_batch(job_data, debug, num_workers, dict(),
+                                 undirected, stats, factored)
+
+
+def _get_paths_codec(compression: str) -> \
+        tuple[typing.Callable, typing.Callable]:
+    # the compression libraries are only needed if compression is used:
+    if compression == 'zstd':
+        import zstandard
+        return (zstandard.ZstdCompressor().compress,
+                zstandard.ZstdDecompressor().decompress)
+    if compression == 'lz4':
+        import lz4.frame
+        return (lz4.frame.compress, lz4.frame.decompress)
+    raise ValueError(f"unknown compression: {compression}")
+
+
+# Writes the path arrays for the jobs of a batch, in any order, to a single
+# file that `PathsBatchReader` can read: a header, then one block per job
+# holding the job's path array as int32 in C order (compressed, if
+# `compression` is 'zstd' or 'lz4'), then an index with one entry per job,
+# which is written when the writer is closed.
+# With `journal=True`, each job is also recorded in a journal (filename +
+# '.journal', one JSON line per job, after the job's paths have been flushed
+# to the file), so that if the process dies before `close` writes the index,
+# a writer made with `resume=True` can pick up where it left off: it drops
+# anything written after the last job in the journal, and `done_jobs` holds
+# the jobs that don't need to be run again.
+# `write_count` records a job whose paths aren't kept (or that failed, with
+# its error message).
+class PathsBatchWriter:
+    def __init__(self,
+                 filename: str,
+                 compression: typing.Optional[str] = None,
+                 journal: bool = False,
+                 resume: bool = False):
+        if compression not in g_paths_file_compressions:
+            raise ValueError(f"unknown compression: {compression}")
+        self._compress = None if compression is None else \
+            _get_paths_codec(compression)[0]
+        self._compression_code = g_paths_file_compressions.index(compression)
+        self._index: dict[int, tuple[int, int, int, int]] = dict()
+        self.done_jobs: set[int] = set()
+        self._journal: typing.Optional[typing.TextIO] = None
+        self._file: typing.BinaryIO
+        journal_file_name = filename + ".journal"
+        if resume and os.path.exists(filename) and \
+                os.path.exists(journal_file_name):
+            data_end, journal_end = self._read_journal(journal_file_name,
+                                                       compression)
+            self._file = open(filename, 'r+b')
+            self._file.truncate(data_end)
+            self._file.seek(data_end)
+            self._journal = open(journal_file_name, 'a')
+            self._journal.truncate(journal_end)
+        else:
+            self._file = open(filename, 'wb')
+            # the header is filled in by `close`:
+            self._file.write(bytes(g_paths_file_header_dtype.itemsize))
+            if journal or resume:
+                self._journal = open(journal_file_name, 'w')
+                self._write_journal({'version': g_paths_file_version,
+                                     'compression': compression})
+
+    def _read_journal(self,
+                      journal_file_name: str,
+                      compression: typing.Optional[str]) -> \
+            tuple[int, int]:
+        data_end = g_paths_file_header_dtype.itemsize
+        with open(journal_file_name, 'rb') as journal_file:
+            header = json.loads(journal_file.readline())
+            if header != {'version': g_paths_file_version,
+                          'compression': compression}:
+                raise ValueError("cannot resume a paths file written with "
+                                 f"compression {header.get('compression')} "
+                                 f"(version {header.get('version')})")
+            journal_end = journal_file.tell()
+            for line in journal_file:
+                if not line.endswith(b"\n"):
+                    # the line that was being written when the process died
+                    break
+                entry = json.loads(line)
+                journal_end += len(line)
+                self.done_jobs.add(entry['job'])
+                if 'offset' in entry:
+                    self._index[entry['job']] = (entry['offset'],
+                                                 entry['nbytes'],
+                                                 entry['num_paths'],
+                                                 entry['path_len'])
+                    data_end = max(data_end,
+                                   entry['offset'] + entry['nbytes'])
+        return (data_end, journal_end)
+
+    def _write_journal(self, entry: dict):
+        assert self._journal is not None
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def write(self, job_index: int, paths_np: np.ndarray):
+        if job_index < 0:
+            raise ValueError(f"invalid job index: {job_index}")
+        if job_index in self._index:
+            raise ValueError(f"paths for job {job_index} were already written")
+        if paths_np.ndim != 2:
+            raise ValueError("path array must be two-dimensional")
+        paths_np = np.ascontiguousarray(paths_np, dtype='<i4')
+        data = paths_np.data if self._compress is None else \
+            self._compress(paths_np.data)
+        offset = self._file.tell()
+        self._file.write(data)
+        self._index[job_index] = (offset, self._file.tell() - offset,
+                                  paths_np.shape[0], paths_np.shape[1])
+        self.done_jobs.add(job_index)
+        if self._journal is not None:
+            self._file.flush()
+            self._write_journal(dict(zip(('offset', 'nbytes', 'num_paths',
+                                          'path_len'),
+                                         self._index[job_index]),
+                                     job=job_index))
+
+    def write_count(self,
+                    job_index: int,
+                    num_paths: int,
+                    error: typing.Optional[str] = None):
+        self.done_jobs.add(job_index)
+        if self._journal is not None:
+            self._write_journal({'job': job_index, 'num_paths': num_paths}
+                                if error is None else
+                                {'job': job_index, 'num_paths': num_paths,
+                                 'error': error})
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._journal is not None:
+            self._journal.close()
+        num_jobs = max(self._index, default=-1) + 1
+        index = np.zeros(num_jobs, dtype=g_paths_file_index_dtype)
+        for job_index, entry in self._index.items():
+            index[job_index] = entry + (1,)
+        index_offset = self._file.tell()
+        padding = -index_offset % g_paths_file_index_dtype.alignment
+        self._file.write(bytes(padding))
+        index_offset += padding
+        self._file.write(index.tobytes())
+        header = np.array([(g_paths_file_magic, g_paths_file_version,
+                            self._compression_code, num_jobs, index_offset)],
+                          dtype=g_paths_file_header_dtype)
+        self._file.seek(0)
+        self._file.write(header.tobytes())
+        self._file.close()
+
+    def __enter__(self) -> 'PathsBatchWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Reads a file written by `PathsBatchWriter`; the file is memory-mapped, so
+# for an uncompressed file, `reader[i]` is a read-only view of the paths for
+# job i, and no path data are read until they are used.
+class PathsBatchReader:
+    def __init__(self, filename: str):
+        self._data = np.memmap(filename, dtype=np.uint8, mode='r')
+        if self._data.shape[0] < g_paths_file_header_dtype.itemsize:
+            raise ValueError(f"not a findpaths paths file: {filename}")
+        header = np.frombuffer(self._data, dtype=g_paths_file_header_dtype,
+                               count=1)[0]
+        if header['magic'] != g_paths_file_magic:
+            raise ValueError(f"not a findpaths paths file: {filename}")
+        if header['version'] != g_paths_file_version:
+            raise ValueError("unsupported paths file version: "
+                             f"{header['version']}")
+        self.compression = g_paths_file_compressions[header['compression']]
+        self._decompress = None if self.compression is None else \
+            _get_paths_codec(self.compression)[1]
+        self._index = np.frombuffer(self._data,
+                                    dtype=g_paths_file_index_dtype,
+                                    count=int(header['num_jobs']),
+                                    offset=int(header['index_offset']))
+
+    def __len__(self) -> int:
+        return self._index.shape[0]
+
+    def is_written(self, job_index: int) -> bool:
+        return bool(self._index[range(len(self))[job_index]]['written'])
+
+    def __getitem__(self, job_index: int) -> np.ndarray:
+        offset, nbytes, num_paths, path_len, written = \
+            self._index[range(len(self))[job_index]].tolist()
+        if not written:
+            raise ValueError(f"no paths were written for job {job_index}")
+        if self._decompress is None:
+            return np.frombuffer(self._data, dtype='<i4',
+                                 count=num_paths * path_len,
+                                 offset=offset).reshape(num_paths, path_len)
+        data = self._decompress(self._data[offset:offset + nbytes])
+        return np.frombuffer(data, dtype='<i4').reshape(num_paths, path_len)
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return (self[i] for i in range(len(self)))
+
+
+# Writes the paths for the jobs of a batch to a Parquet file with one row per
+# path: the job index, and the path as a list of CURIEs (the translation from
+# node indices to CURIEs is done with one Arrow `take` per job).
+class ParquetPathsWriter:
+    def __init__(self,
+                 filename: str,
+                 ids: Iterable[str],
+                 compression: typing.Optional[str] = None):
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._ids = pyarrow.array(ids, type=pyarrow.string())
+        self._schema = pyarrow.schema([('job', pyarrow.int32()),
+                                       ('path',
+                                        pyarrow.list_(pyarrow.string()))])
+        self._writer = pyarrow.parquet.ParquetWriter(
+            filename, self._schema,
+            **({} if compression is None else {'compression': compression}))
+
+    def write(self, job_index: int, paths_np: np.ndarray):
+        pa = self._pa
+        mask = paths_np != g_np_graph_initializer
+        offsets = np.zeros(paths_np.shape[0] + 1, dtype=np.int32)
+        np.cumsum(mask.sum(axis=1), out=offsets[1:])
+        curies = self._ids.take(pa.array(paths_np[mask]))
+        table = pa.Table.from_arrays(
+            [pa.array(np.full(paths_np.shape[0], job_index, dtype=np.int32)),
+             pa.ListArray.from_arrays(pa.array(offsets), curies)],
+            schema=self._schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self) -> 'ParquetPathsWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Writes the edges along the paths of the jobs of a batch (see
+# `get_path_edges`) to a Parquet file, as a companion to the paths file: one
+# row per path (or, if the parallel edges are expanded, per combination of
+# edges along a path), holding the job index, the row of the path in the
+# job's path array, and lists with an entry for each hop of the edge ID, the
+# predicate, whether the edge goes against the path, and (when counting the
+# parallel edges) the number of edges.
+class ParquetPathEdgesWriter:
+    def __init__(self,
+                 filename: str,
+                 edge_table: dict[str, np.ndarray],
+                 parallel_edges: str = 'count',
+                 compression: typing.Optional[str] = None):
+        import pyarrow
+        import pyarrow.parquet
+        if parallel_edges not in g_parallel_edges_modes:
+            raise ValueError(f"invalid parallel edges mode: {parallel_edges}")
+        self._pa = pyarrow
+        self._edge_table = edge_table
+        self._parallel_edges = parallel_edges
+        # (including the empty name at the end, for the hops with no edge)
+        self._predicate_names = pyarrow.array(
+            edge_table['predicate_names'].tolist(), type=pyarrow.string())
+        fields = [('job', pyarrow.int32()),
+                  ('path', pyarrow.int32()),
+                  ('edge_id', pyarrow.list_(pyarrow.int64())),
+                  ('predicate', pyarrow.list_(pyarrow.string())),
+                  ('reversed', pyarrow.list_(pyarrow.bool_()))]
+        if parallel_edges == 'count':
+            fields.append(('num_edges', pyarrow.list_(pyarrow.int32())))
+        self._schema = pyarrow.schema(fields)
+        self._writer = pyarrow.parquet.ParquetWriter(
+            filename, self._schema,
+            **({} if compression is None else {'compression': compression}))
+
+    def write(self,
+              job_index: int,
+              paths_np: np.ndarray,
+              undirected: bool = False):
+        pa = self._pa
+        res = get_path_edges(self._edge_table, paths_np,
+                             self._parallel_edges, undirected)
+        rows = res.get('path_index', np.arange(paths_np.shape[0]))
+        hops = paths_np[rows, 1:] != g_np_graph_initializer
+        offsets = pa.array(np.concatenate(([0], np.cumsum(hops.sum(axis=1))))
+                           .astype(np.int32))
+
+        def _hop_list(values: np.ndarray, pa_values=None):
+            return pa.ListArray.from_arrays(
+                offsets, pa.array(values[hops]) if pa_values is None
+                else pa_values)
+        hop_predicates = res['predicate'][hops]
+        hop_predicates[hop_predicates < 0] = len(self._predicate_names) - 1
+        columns = [pa.array(np.full(rows.shape[0], job_index,
+                                    dtype=np.int32)),
+                   pa.array(rows.astype(np.int32)),
+                   _hop_list(res['edge_id']),
+                   _hop_list(res['predicate'], self._predicate_names.take(
+                       pa.array(hop_predicates))),
+                   _hop_list(res['reversed'])]
+        if self._parallel_edges == 'count':
+            columns.append(_hop_list(res['num_edges']))
+        self._writer.write_table(pa.Table.from_arrays(columns,
+                                                      schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self) -> 'ParquetPathEdgesWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _open_paths_writer(filename: str,
+                       compression: typing.Optional[str] = None,
+                       ids: typing.Optional[Iterable[str]] = None,
+                       journal: bool = False,
+                       resume: bool = False) -> \
+        typing.Union[PathsBatchWriter, ParquetPathsWriter]:
+    if filename.endswith('.parquet'):
+        if ids is None:
+            raise ValueError("node IDs are needed to write paths to Parquet")
+        if resume:
+            raise ValueError("cannot resume writing paths to Parquet")
+        return ParquetPathsWriter(filename, ids, compression)
+    return PathsBatchWriter(filename, compression, journal, resume)
+
+
+def write_paths_batch(filename: str,
+                      paths_all: Iterable[np.ndarray],
+                      compression: typing.Optional[str] = None,
+                      ids: typing.Optional[Iterable[str]] = None):
+    with _open_paths_writer(filename, compression, ids) as writer:
+        for job_index, paths_np in enumerate(paths_all):
+            writer.write(job_index, paths_np)
+
+
+def read_paths_batch(filename: str) -> PathsBatchReader:
+    return PathsBatchReader(filename)
+
+
+def _get_peak_rss_bytes(who: int = resource.RUSAGE_SELF) -> int:
+    max_rss = resource.getrusage(who).ru_maxrss
+    # (ru_maxrss is in bytes on macOS, and in KiB on Linux)
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _get_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * \
+                os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # (without /proc, as on macOS, the peak is the best there is)
+        return _get_peak_rss_bytes()
+
+
+# The resident set size of this process, now and at its peak, and the peak
+# resident set size of the largest of its finished child processes (such as
+# the batch worker processes).
+def get_memory_usage() -> dict[str, int]:
+    rss = _get_rss_bytes()
+    # (the kernel only updates the peak now and then, so it can lag behind)
+    return {'rss_bytes': rss,
+            'peak_rss_bytes': max(rss, _get_peak_rss_bytes()),
+            'children_peak_rss_bytes':
+            _get_peak_rss_bytes(resource.RUSAGE_CHILDREN)}
+
+
+# The memory that a graph store will take up once it has been read and all of
+# its pages have been touched (its arrays are memory-mapped, so this is mostly
+# page cache that can be shared between processes).
+def estimate_graph_store_bytes(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path)
+               if entry.name.endswith(('.npy', '.pkl')))
+
+
+# With a memory limit (in bytes) set, `get_all_paths_batch` raises MemoryError
+# rather than letting this process grow past the limit while it collects the
+# paths; `iter_all_paths_batch` doesn't hold on to the paths, so it can be
+# used instead.
+def set_memory_limit(max_bytes: typing.Optional[int]):
+    global g_max_memory_bytes
+    if max_bytes is not None and max_bytes <= 0:
+        raise ValueError(f"invalid memory limit: {max_bytes}")
+    g_max_memory_bytes = max_bytes
+
+
+# Allocation statistics for the arenas that the C++ core keeps the paths found
+# by queries in: the blocks and bytes allocated so far, and the bytes held by
+# the queries that are running, now and at most; and the bytes held by the
+# per-node scratch arrays of its BFS expansions, in all and kept for reuse
+# (all zero in python mode)
+def get_arena_stats() -> dict[str, int]:
+    if _using_cxx():
+        return g_module.get_arena_stats()
+    return dict.fromkeys(('blocks_allocated', 'bytes_allocated',
+                          'live_bytes', 'peak_live_bytes',
+                          'node_scratch_bytes', 'node_scratch_pooled_bytes'),
+                         0)
+
+
+def _check_memory_limit():
+    if g_max_memory_bytes is not None and \
+       _get_rss_bytes() > g_max_memory_bytes:
+        raise MemoryError("memory use is over the limit of "
+                          f"{_format_bytes(g_max_memory_bytes)}; "
+                          "use iter_all_paths_batch to process the paths "
+                          "as they are found")
+
+
+def _format_bytes(num_bytes: float) -> str:
+    return f"{num_bytes / 2**30:0.2f} GiB"
+
+
+def _print_memory_usage(phase: str):
+    usage = get_memory_usage()
+    scratch = f", BFS scratch arrays " \
+        f"{_format_bytes(get_arena_stats()['node_scratch_bytes'])}" \
+        if _using_cxx() else ""
+    print(f"Memory {phase}: RSS {_format_bytes(usage['rss_bytes'])}, "
+          f"peak RSS {_format_bytes(usage['peak_rss_bytes'])}{scratch}")
+
+
+def _print_worker_utilization(busy_times: dict[int, float],
+                              num_workers: int,
+                              elapsed_time: float):
+    for pid, busy_time in sorted(busy_times.items()):
+        print(f"Worker {pid}: busy {busy_time:0.2f} sec "
+              f"({100 * busy_time / elapsed_time:0.0f}% utilization)")
+    mean_util = sum(busy_times.values()) / (num_workers * elapsed_time)
+    print(f"Mean worker utilization: {100 * mean_util:0.0f}%")
+
+
+class QueryCancelledError(Exception):
+    pass
+
+
+# A flag that a running query checks periodically, so that the query can be
+# cancelled; the flags can be in shared memory, so that a query that is running
+# in a worker process can be cancelled from the parent process.
+class CancelToken:
+    def __init__(self, flags=None, slot: int = 0):
+        self._flags = flags if flags is not None else bytearray(1)
+        self._slot = slot
+
+    def cancel(self):
+        self._flags[self._slot] = 1
+
+    def is_cancelled(self) -> bool:
+        return self._flags[self._slot] != 0
+
+
+def _check_cancelled(cancel_token: typing.Optional[CancelToken]):
+    if cancel_token is not None and cancel_token.is_cancelled():
+        raise QueryCancelledError("query was cancelled")
+
+
+def _using_cxx() -> bool:
+    return g_module is not sys.modules[__name__]
+
+
+def _make_cancel_token():
+    return g_module.CancelToken() if _using_cxx() else CancelToken()
+
+
+def _init_async_worker(cancel_flags):
+    global g_async_cancel_flags
+    g_async_cancel_flags = cancel_flags
+
+
+def _run_async_query(slot: int,
+                     s: int,
+                     t: int,
+                     n: int,
+                     undirected: bool = False,
+                     count_only: bool = False) -> typing.Union[np.ndarray,
+                                                               int]:
+    res = _get_all_paths_np_cached_graph(
+        s, t, n, cancel_token=CancelToken(g_async_cancel_flags, slot),
+        undirected=undirected)
+    # (only the number of paths is sent back, rather than the whole array)
+    return res.shape[0] if count_only else res
+
+
+def _count_paths_np_cached_graph(*args) -> int:
+    return g_module._get_all_paths_np_cached_graph(*args).shape[0]
+
+
+# Runs queries against the graph stored by `set_graph` without blocking the
+# event loop: in C++ mode, on a pool of threads (the C++ code releases the GIL
+# while it is finding paths), and in python mode, on a pool of persistent
+# worker processes (which get the graph through fork, so create the
+# AsyncPathFinder after calling `set_graph`). At most `max_pending` queries can
+# be queued or running at a time; beyond that, callers wait for a slot.
+# Cancelling the task that awaits a query stops the underlying search.
+# `count_paths` only gets the number of paths, without sending their array
+# back from the worker.
+class AsyncPathFinder:
+    def __init__(self,
+                 max_workers: typing.Optional[int] = None,
+                 max_pending: typing.Optional[int] = None):
+        if max_workers is None:
+            max_workers = multiprocess.cpu_count()
+        if max_pending is None:
+            max_pending = 2 * max_workers
+        if max_workers < 1:
+            raise ValueError(f"invalid number of workers: {max_workers}")
+        if max_pending < 1:
+            raise ValueError("invalid maximum number of pending queries: "
+                             f"{max_pending}")
+        self.max_pending = max_pending
+        self._pending = asyncio.Semaphore(max_pending)
+        self._free_slots = list(range(max_pending))
+        self._cxx = _using_cxx()
+        if self._cxx:
+            self._tokens: list = [None] * max_pending
+            import concurrent.futures
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        else:
+            self._cancel_flags = multiprocess.Array('b', max_pending,
+                                                    lock=False)
+            self._pool = multiprocess.Pool(max_workers,
+                                           initializer=_init_async_worker,
+                                           initargs=(self._cancel_flags,))
+
+    def _submit(self,
+                slot: int,
+                s: int,
+                t: int,
+                n: int,
+                undirected: bool,
+                count_only: bool) -> concurrent.futures.Future:
+        if self._cxx:
+            token = g_module.CancelToken()
+            self._tokens[slot] = token
+            return self._executor.submit(
+                _count_paths_np_cached_graph if count_only
+                else g_module._get_all_paths_np_cached_graph,
+                s, t, n, False, 0, 1, token, undirected)
+        self._cancel_flags[slot] = 0
+        import concurrent.futures
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        # a query that has been handed to the pool can only be stopped through
+        # its cancellation flag:
+        future.set_running_or_notify_cancel()
+        self._pool.apply_async(_run_async_query,
+                               (slot, s, t, n, undirected, count_only),
+                               callback=future.set_result,
+                               error_callback=future.set_exception)
+        return future
+
+    def _cancel(self, slot: int):
+        if self._cxx:
+            self._tokens[slot].cancel()
+        else:
+            self._cancel_flags[slot] = 1
+
+    def _release(self, slot: int):
+        self._free_slots.append(slot)
+        self._pending.release()
+
+    # Waits until a query could be started without waiting for a slot (without
+    # taking the slot).
+    async def wait_for_slot(self):
+        async with self._pending:
+            pass
+
+    async def _run(self,
+                   s: int,
+                   t: int,
+                   n: int,
+                   undirected: bool,
+                   count_only: bool) -> typing.Any:
+        loop = asyncio.get_running_loop()
+        await self._pending.acquire()
+        slot = self._free_slots.pop()
+        try:
+            future = self._submit(slot, s, t, n, undirected, count_only)
+        except BaseException:
+            self._release(slot)
+            raise
+
+        # the slot is only given back when the query has actually stopped,
+        # which for a cancelled query can be a little while after the
+        # cancellation:
+        def _on_done(_):
+            try:
+                loop.call_soon_threadsafe(self._release, slot)
+            except RuntimeError:
+                pass  # the event loop has already been closed
+        future.add_done_callback(_on_done)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self._cancel(slot)
+            raise
+
+    async def get_all_paths(self,
+                            s: int,
+                            t: int,
+                            n: int,
+                            undirected: bool = False) -> np.ndarray:
+        if _query_is_impossible(s, t, n, undirected):
+            return _make_empty_paths(n)
+        return await self._run(s, t, n, undirected, False)
+
+    async def count_paths(self,
+                          s: int,
+                          t: int,
+                          n: int,
+                          undirected: bool = False) -> int:
+        if _query_is_impossible(s, t, n, undirected):
+            return 0
+        return await self._run(s, t, n, undirected, True)
+
+    async def get_all_paths_batch(self,
+                                  job_data: Iterable[tuple[int, int, int]],
+                                  undirected: bool = False) \
+            -> list[np.ndarray]:
+        return list(await asyncio.gather(*(self.get_all_paths(s, t, n,
+                                                              undirected)
+                                           for s, t, n in job_data)))
+
+    def close(self):
+        if self._cxx:
+            for token in self._tokens:
+                if token is not None:
+                    token.cancel()
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self._pool.terminate()
+            self._pool.join()
+
+    async def __aenter__(self) -> 'AsyncPathFinder':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # (closing waits for the running queries to stop, which mustn't
+        # block the event loop)
+        await asyncio.to_thread(self.close)
 
 
 def node_name_to_id(ids: tuple[str, ...],
@@ -619,58 +3096,1004 @@ def node_names_to_ids(ids: tuple[str, ...],
             node_name_to_id(ids, names[1]))
 
 
+# Answers path queries against the graph stored by `set_graph`, for clients
+# that connect over TCP or a Unix socket. A connection either sends JSON-lines
+# requests (one JSON object per line, answered by one or more JSON lines that
+# carry the request's "id"; requests on a connection run concurrently), or
+# a single HTTP request (GET /health, GET /metrics, or POST /query with a
+# JSON-lines request as the body). Requests look like
+#   {"id": 1, "op": "paths", "start": "X:1", "end": "X:2", "cutoff": 3}
+#   {"id": 2, "op": "count", "start": "X:1", "end": "X:2", "cutoff": 3}
+#   {"id": 3, "op": "batch", "jobs": [["X:1", "X:2", 3], ...], "count": false}
+# where nodes are CURIEs or integer node IDs, "format" can be "curies" (the
+# default) or "ids", and "undirected" overrides the server's --undirected
+# setting. The results of a batch request are sent one job at a
+# time, in the order in which the jobs finish, followed by {"done": true}.
+# Concurrency is limited by the AsyncPathFinder's workers and pending slots.
+class PathServer:
+    def __init__(self,
+                 ids: tuple[str, ...],
+                 finder: AsyncPathFinder,
+                 undirected: bool = False):
+        self._ids = ids
+        self._undirected = undirected
+        self._node_table = make_node_table(ids)
+        self._curie_to_index = {curie: i for i, curie in enumerate(ids)}
+        self._finder = finder
+        self._start_time = timeit.default_timer()
+        self._metrics = {'connections_total': 0,
+                         'queries_total': 0,
+                         'queries_in_flight': 0,
+                         'query_errors_total': 0,
+                         'query_seconds_total': 0.0,
+                         'paths_returned_total': 0}
+
+    def _node_index(self, node: typing.Union[str, int]) -> int:
+        if isinstance(node, int):
+            if not 0 <= node < len(self._ids):
+                raise ValueError(f"invalid node ID: {node}")
+            return node
+        try:
+            return self._curie_to_index[node]
+        except KeyError:
+            raise ValueError(f"unable to get integer node ID for CURIE {node}")
+
+    async def _find_paths(self,
+                          start: typing.Union[str, int],
+                          end: typing.Union[str, int],
+                          cutoff: int,
+                          undirected: bool,
+                          count_only: bool = False) -> typing.Union[np.ndarray,
+                                                                    int]:
+        s = self._node_index(start)
+        t = self._node_index(end)
+        metrics = self._metrics
+        metrics['queries_total'] += 1
+        metrics['queries_in_flight'] += 1
+        query_start = timeit.default_timer()
+        res: typing.Union[np.ndarray, int]
+        try:
+            if count_only:
+                res = await self._finder.count_paths(s, t, int(cutoff),
+                                                     undirected)
+            else:
+                res = await self._finder.get_all_paths(s, t, int(cutoff),
+                                                       undirected)
+        except Exception:
+            metrics['query_errors_total'] += 1
+            raise
+        finally:
+            metrics['queries_in_flight'] -= 1
+            metrics['query_seconds_total'] += \
+                timeit.default_timer() - query_start
+        metrics['paths_returned_total'] += \
+            res.shape[0] if isinstance(res, np.ndarray) else res
+        return res
+
+    def _format_result(self,
+                       request_id,
+                       res: typing.Union[np.ndarray, int],
+                       count_only: bool,
+                       fmt: str) -> dict:
+        if count_only:
+            return {'id': request_id, 'count': res}
+        paths_np = typing.cast(np.ndarray, res)
+        if fmt == 'curies':
+            paths = [[curie for curie in row if curie]
+                     for row in paths_to_curies(paths_np,
+                                                self._node_table).tolist()]
+        else:
+            paths = [[i for i in row if i != g_np_graph_initializer]
+                     for row in paths_np.tolist()]
+        return {'id': request_id, 'paths': paths}
+
+    async def _handle_request(self, request: dict) -> \
+            typing.AsyncIterator[dict]:
+        request_id = request.get('id')
+        op = request.get('op', 'paths')
+        fmt = request.get('format', 'curies')
+        undirected = bool(request.get('undirected', self._undirected))
+        if fmt not in ('curies', 'ids'):
+            raise ValueError(f"invalid format: {fmt}")
+        if op == 'health':
+            yield dict(self._health(), id=request_id)
+        elif op == 'metrics':
+            yield {'id': request_id, 'metrics': self._get_metrics()}
+        elif op in ('paths', 'count'):
+            res = await self._find_paths(request['start'],
+                                         request['end'],
+                                         request.get('cutoff',
+                                                     g_default_cutoff),
+                                         undirected,
+                                         op == 'count')
+            yield self._format_result(request_id, res, op == 'count', fmt)
+        elif op == 'batch':
+            count_only = bool(request.get('count', False))
+
+            async def _run_job(job_index: int, job: list) -> tuple:
+                try:
+                    start, end, cutoff = job
+                    return (job_index,
+                            await self._find_paths(start, end, cutoff,
+                                                   undirected, count_only),
+                            None)
+                except (ValueError, TypeError, QueryCancelledError) as e:
+                    return job_index, None, e
+            jobs = enumerate(request['jobs'])
+            tasks: set[asyncio.Future] = set()
+            try:
+                while True:
+                    # a job is only started when the finder has a free slot
+                    # for it, and at most max_pending of them are running, so
+                    # that a large batch isn't queued up all at once:
+                    if len(tasks) < self._finder.max_pending:
+                        next_job = next(jobs, None)
+                        if next_job is not None:
+                            await self._finder.wait_for_slot()
+                            tasks.add(asyncio.ensure_future(
+                                _run_job(*next_job)))
+                            continue
+                    if not tasks:
+                        break
+                    done, tasks = await asyncio.wait(
+                        tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        job_index, res, error = task.result()
+                        if error is not None:
+                            yield {'id': request_id, 'job': job_index,
+                                   'error': str(error)}
+                        else:
+                            yield dict(self._format_result(request_id, res,
+                                                           count_only, fmt),
+                                       job=job_index)
+            finally:
+                # stops any searches that are still running if the client goes
+                # away partway through the batch:
+                for task in tasks:
+                    task.cancel()
+            yield {'id': request_id, 'done': True}
+        else:
+            raise ValueError(f"unknown op: {op}")
+
+    async def _respond(self,
+                       line: bytes,
+                       send: typing.Callable[[dict], typing.Awaitable]):
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            request_id = request.get('id')
+            async for response in self._handle_request(request):
+                await send(response)
+        except (ValueError, KeyError, TypeError, QueryCancelledError) as e:
+            message = f"missing field: {e}" if isinstance(e, KeyError) \
+                else str(e)
+            await send({'id': request_id, 'error': message})
+
+    def _health(self) -> dict:
+        return {'status': 'ok',
+                'num_nodes': len(self._ids),
+                'uptime_seconds': timeit.default_timer() - self._start_time}
+
+    def _get_metrics(self) -> dict:
+        usage = get_memory_usage()
+        return dict(self._metrics,
+                    uptime_seconds=timeit.default_timer() - self._start_time,
+                    rss_bytes=usage['rss_bytes'],
+                    peak_rss_bytes=usage['peak_rss_bytes'],
+                    **{f"path_arena_{key}": value
+                       for key, value in get_arena_stats().items()})
+
+    def _format_metrics_prometheus(self) -> str:
+        return _format_prometheus_metrics(self._get_metrics(), 'findpaths')
+
+    async def _serve_json_lines(self,
+                                line: bytes,
+                                reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        write_lock = asyncio.Lock()
+
+        async def _send(response: dict):
+            async with write_lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        tasks: set[asyncio.Future] = set()
+        try:
+            while line:
+                if line.strip():
+                    # (stops reading requests while max_pending of them are
+                    # running, or while the finder has no free slot)
+                    while len(tasks) >= self._finder.max_pending:
+                        done, tasks = await asyncio.wait(
+                            tasks, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            task.result()
+                    await self._finder.wait_for_slot()
+                    tasks.add(asyncio.ensure_future(
+                        self._respond(line, _send)))
+                line = await reader.readline()
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _serve_http(self,
+                          request_line: bytes,
+                          reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter):
+        def _write_head(status: str, content_type: str, extra: str):
+            writer.write((f"HTTP/1.1 {status}\r\n"
+                          f"Content-Type: {content_type}\r\n"
+                          f"{extra}Connection: close\r\n\r\n").encode())
+
+        def _write_body(status: str, content_type: str, content: str):
+            data = content.encode()
+            _write_head(status, content_type,
+                        f"Content-Length: {len(data)}\r\n")
+            writer.write(data)
+        fields = request_line.decode('latin-1').split()
+        headers = {}
+        while (line := await reader.readline()).strip():
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            content_length = -1
+        if len(fields) < 2 or content_length < 0:
+            _write_body("400 Bad Request", "text/plain", "bad request\n")
+            await writer.drain()
+            return
+        method, target = fields[:2]
+        body = await reader.readexactly(content_length)
+        path = target.split('?')[0]
+        if method == 'GET' and path == '/health':
+            _write_body("200 OK", "application/json",
+                        json.dumps(self._health()))
+        elif method == 'GET' and path == '/metrics':
+            _write_body("200 OK", "text/plain; version=0.0.4",
+                        self._format_metrics_prometheus())
+        elif method == 'POST' and path == '/query':
+            # results are streamed back as JSON lines, using chunked transfer
+            # encoding, as they become available
+            _write_head("200 OK", "application/x-ndjson",
+                        "Transfer-Encoding: chunked\r\n")
+
+            async def _send(response: dict):
+                data = json.dumps(response).encode() + b"\n"
+                writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                await writer.drain()
+            await self._respond(body, _send)
+            writer.write(b"0\r\n\r\n")
+        elif path in ('/health', '/metrics', '/query'):
+            _write_body("405 Method Not Allowed", "text/plain",
+                        "method not allowed\n")
+        else:
+            _write_body("404 Not Found", "text/plain", "not found\n")
+        await writer.drain()
+
+    async def handle_connection(self,
+                                reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        self._metrics['connections_total'] += 1
+        try:
+            line = await reader.readline()
+            if line.startswith(g_http_methods):
+                await self._serve_http(line, reader, writer)
+            else:
+                await self._serve_json_lines(line, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        finally:
+            writer.close()
+
+    async def start(self,
+                    host: typing.Optional[str] = g_default_serve_host,
+                    port: typing.Optional[int] = g_default_serve_port,
+                    unix_socket: typing.Optional[str] = None) -> \
+            asyncio.Server:
+        if unix_socket is not None:
+            return await asyncio.start_unix_server(self.handle_connection,
+                                                   path=unix_socket)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def _serve(ids: tuple[str, ...],
+                 host: str,
+                 port: int,
+                 unix_socket: typing.Optional[str],
+                 num_workers: typing.Optional[int],
+                 max_pending: typing.Optional[int],
+                 undirected: bool):
+    async with AsyncPathFinder(num_workers, max_pending) as finder:
+        server = await PathServer(ids, finder, undirected).start(host, port,
+                                                                 unix_socket)
+        where = unix_socket if unix_socket is not None else \
+            ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"Serving path queries on {where}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+# Hands out the jobs of a batch, a shard of `shard_size` jobs at a time, to
+# the workers (see `run_batch_worker`) that connect to it over TCP, and
+# writes the paths file (see `PathsBatchWriter`) that a worker sends back
+# for each shard to `output_dir`, as shard-NNNNNN.bin (indexed by the job's
+# position within the shard). The protocol is JSON lines: a worker sends
+#   {"op": "lease"}
+# and is answered with {"shard": k, "jobs": [...]} (the jobs as yielded by
+# `iter_batch_jobs`), {"wait": seconds} if all of the remaining shards are
+# leased to other workers, or {"done": true}; then it sends either
+#   {"op": "result", "shard": k, "nbytes": n, "job_errors": {"i": "..."}}
+# followed by the n bytes of the shard's paths file, or
+#   {"op": "error", "shard": k, "error": "..."}
+# and is answered with {"ok": true}. The job errors are those of the jobs in
+# the shard (by position) that failed on their own, e.g. because of an
+# unknown CURIE, and are written next to the shard's file, as
+# shard-NNNNNN.errors.json. A shard whose file is in `output_dir` is done, so
+# a coordinator that is restarted on the same directory only hands out the
+# shards that aren't; the shards leased to a worker that disconnects (or that
+# doesn't send back a result within g_batch_lease_seconds) are handed out
+# again, and a second result for a shard is ignored. If the jobs can't be
+# read (e.g., because of a malformed row), no more shards are handed out,
+# and `wait` raises ValueError.
+class BatchCoordinator:
+    def __init__(self,
+                 jobs: Iterable[dict],
+                 output_dir: str,
+                 shard_size: int = g_batch_shard_size):
+        if shard_size < 1:
+            raise ValueError(f"invalid shard size: {shard_size}")
+        self._output_dir = output_dir
+        self._shard_size = shard_size
+        os.makedirs(output_dir, exist_ok=True)
+        manifest_file = os.path.join(output_dir, g_batch_manifest_file_name)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as input_file:
+                manifest = json.load(input_file)
+            if manifest['shard_size'] != shard_size:
+                raise ValueError(f"{output_dir} holds shards of "
+                                 f"{manifest['shard_size']} jobs, not "
+                                 f"{shard_size}")
+        else:
+            self._write_manifest()
+        jobs_iter = iter(jobs)
+        self._shards = enumerate(iter(
+            lambda: list(it.islice(jobs_iter, shard_size)), []))
+        self._next_shard: typing.Optional[tuple[int, list[dict]]] = None
+        # shard -> (jobs, lease deadline, the connection holding the lease)
+        self._leases: dict[int, tuple[list[dict], float,
+                                      typing.Optional[object]]] = dict()
+        self._failed: dict[int, str] = dict()
+        # job index -> error, for the jobs that failed on their own
+        self._job_errors: dict[int, str] = dict()
+        self._fatal_error: typing.Optional[str] = None
+        self._num_jobs = 0
+        self._num_shards = 0
+        self._num_connections = 0
+        self._done = asyncio.Event()
+        self._find_next_shard()
+
+    def _shard_file_name(self, shard: int) -> str:
+        return os.path.join(self._output_dir, f"shard-{shard:06d}.bin")
+
+    def _job_errors_file_name(self, shard: int) -> str:
+        return os.path.join(self._output_dir,
+                            f"shard-{shard:06d}.errors.json")
+
+    def _add_job_errors(self, shard: int, job_errors: dict[str, str]):
+        for i, error in job_errors.items():
+            self._job_errors[shard * self._shard_size + int(i)] = error
+
+    def _write_manifest(self, **summary):
+        _write_json_atomically(
+            dict(summary, shard_size=self._shard_size),
+            os.path.join(self._output_dir, g_batch_manifest_file_name))
+
+    def _find_next_shard(self):
+        self._next_shard = None
+        try:
+            for shard, jobs in self._shards:
+                self._num_shards = shard + 1
+                self._num_jobs += len(jobs)
+                if not os.path.exists(self._shard_file_name(shard)):
+                    self._next_shard = (shard, jobs)
+                    return
+                if os.path.exists(self._job_errors_file_name(shard)):
+                    with open(self._job_errors_file_name(shard)) as \
+                            input_file:
+                        self._add_job_errors(shard, json.load(input_file))
+        except ValueError as e:
+            # (the shards that are already leased are abandoned too, since
+            # the batch can't be finished)
+            print(f"Reading the jobs failed: {e}")
+            self._fatal_error = str(e)
+            self._done.set()
+            return
+        if not self._leases:
+            self._done.set()
+
+    def _lease(self, connection: object) -> dict:
+        if self._fatal_error is not None:
+            return {'done': True}
+        now = timeit.default_timer()
+        deadline = now + g_batch_lease_seconds
+        for shard, (jobs, lease_deadline, _) in self._leases.items():
+            if lease_deadline <= now:
+                self._leases[shard] = (jobs, deadline, connection)
+                return {'shard': shard, 'jobs': jobs}
+        if self._next_shard is not None:
+            shard, jobs = self._next_shard
+            self._leases[shard] = (jobs, deadline, connection)
+            self._find_next_shard()
+            return {'shard': shard, 'jobs': jobs}
+        if self._leases:
+            return {'wait': g_batch_worker_poll_seconds}
+        return {'done': True}
+
+    def _finish_shard(self, shard: int):
+        self._leases.pop(shard, None)
+        if self._next_shard is None and not self._leases:
+            self._done.set()
+
+    async def _receive_shard(self,
+                             shard: int,
+                             nbytes: int,
+                             job_errors: dict[str, str],
+                             reader: asyncio.StreamReader):
+        file_name = self._shard_file_name(shard)
+        # a shard that is already done was also run by a worker whose lease
+        # had run out, so its paths are read and dropped:
+        done = shard not in self._leases or os.path.exists(file_name)
+        with contextlib.ExitStack() as stack:
+            output_file = None if done else \
+                stack.enter_context(open(file_name + ".tmp", 'wb'))
+            while nbytes > 0:
+                data = await reader.readexactly(min(nbytes,
+                                                    g_batch_transfer_bytes))
+                nbytes -= len(data)
+                if output_file is not None:
+                    output_file.write(data)
+        if not done:
+            # (the job errors are written first, since the shard's file is
+            # what marks it as done)
+            if job_errors:
+                _write_json_atomically(job_errors,
+                                       self._job_errors_file_name(shard))
+                self._add_job_errors(shard, job_errors)
+            os.replace(file_name + ".tmp", file_name)
+            self._failed.pop(shard, None)
+            self._finish_shard(shard)
+
+    async def handle_connection(self,
+                                reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        self._num_connections += 1
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'lease':
+                    response = self._lease(writer)
+                elif op == 'result':
+                    await self._receive_shard(int(request['shard']),
+                                              int(request['nbytes']),
+                                              request.get('job_errors', {}),
+                                              reader)
+                    response = {'ok': True}
+                elif op == 'error':
+                    shard = int(request['shard'])
+                    if shard in self._leases:
+                        print(f"Shard {shard} failed: {request['error']}")
+                        self._failed[shard] = request['error']
+                        self._finish_shard(shard)
+                    response = {'ok': True}
+                else:
+                    response = {'error': f"unknown op: {op}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # the worker's shards can be handed out again straight away:
+            for shard, (jobs, _, holder) in list(self._leases.items()):
+                if holder is writer:
+                    self._leases[shard] = (jobs, 0.0, None)
+            self._num_connections -= 1
+            writer.close()
+
+    async def start(self,
+                    host: typing.Optional[str] = g_default_serve_host,
+                    port: typing.Optional[int] = g_default_serve_port) -> \
+            asyncio.Server:
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    # Waits until all of the shards are done (or have failed), and the
+    # connected workers have been told so, and returns a summary of the
+    # batch, which is also written to the manifest; raises ValueError if the
+    # jobs couldn't be read (in which case the manifest records the error).
+    async def wait(self) -> dict:
+        await self._done.wait()
+        deadline = timeit.default_timer() + g_batch_lease_seconds
+        while self._num_connections > 0 and \
+                timeit.default_timer() < deadline:
+            await asyncio.sleep(g_batch_worker_poll_seconds / 10)
+        if self._fatal_error is not None:
+            self._write_manifest(error=self._fatal_error)
+            raise ValueError(self._fatal_error)
+        summary = {'num_jobs': self._num_jobs,
+                   'num_shards': self._num_shards,
+                   'failed_shards': {str(shard): error for shard, error
+                                     in sorted(self._failed.items())},
+                   'failed_jobs': {str(job): error for job, error
+                                   in sorted(self._job_errors.items())}}
+        self._write_manifest(**summary)
+        return dict(summary, shard_size=self._shard_size)
+
+
+async def _coordinate(coordinator: BatchCoordinator,
+                      host: str,
+                      port: int) -> dict:
+    server = await coordinator.start(host, port)
+    where = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+    print(f"Coordinating batch jobs on {where}", flush=True)
+    async with server:
+        return await coordinator.wait()
+
+
+def _run_worker_leases(sock,
+                       reader: typing.BinaryIO,
+                       curie_to_index: dict[str, int],
+                       run_jobs: typing.Callable,
+                       tmp_dir: str,
+                       compression: typing.Optional[str],
+                       shards_run: list[int]):
+    def _send(request: dict):
+        sock.sendall(json.dumps(request).encode() + b"\n")
+
+    def _receive() -> dict:
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("the coordinator closed the connection")
+        return json.loads(line)
+    file_name = os.path.join(tmp_dir, "shard.bin")
+    while True:
+        _send({'op': 'lease'})
+        response = _receive()
+        if response.get('done'):
+            return
+        if 'wait' in response:
+            time.sleep(response['wait'])
+            continue
+        shard = response['shard']
+        # (a job that fails on its own, e.g. because of an unknown CURIE, is
+        # reported with the shard's result, and the other jobs are kept)
+        job_errors = dict()
+        try:
+            with PathsBatchWriter(file_name, compression) as writer:
+                for i, job, paths_np, _, error in _iter_batch_job_paths(
+                        response['jobs'], curie_to_index, run_jobs):
+                    if error is not None:
+                        job_errors[str(i)] = error
+                    elif paths_np is not None:
+                        writer.write(i, paths_np)
+        except ValueError as e:
+            _send({'op': 'error', 'shard': shard, 'error': str(e)})
+            _receive()
+            continue
+        _send({'op': 'result', 'shard': shard,
+               'nbytes': os.path.getsize(file_name),
+               'job_errors': job_errors})
+        with open(file_name, 'rb') as input_file:
+            sock.sendfile(input_file)
+        _receive()
+        shards_run.append(shard)
+
+
+# Runs the shards of jobs handed out by the `BatchCoordinator` at host:port
+# on the graph stored by `set_graph` (whose node CURIEs are `ids`), until
+# they are all done, and returns the shards that it ran. If the
+# connection to the coordinator is lost (e.g., because the coordinator is
+# being restarted), the worker tries to reconnect for
+# g_batch_worker_connect_seconds.
+def run_batch_worker(host: str,
+                     port: int,
+                     ids: tuple[str, ...],
+                     debug: bool = False,
+                     num_workers: typing.Optional[int] = None,
+                     compression: typing.Optional[str] = None) -> list[int]:
+    import socket
+    import tempfile
+    if num_workers is None:
+        num_workers = multiprocess.cpu_count()
+    curie_to_index = {curie: i for i, curie in enumerate(ids)}
+    busy_times: dict[int, float] = dict()
+
+    def _run_jobs(job_data, undirected, job_options):
+        return _iter_all_paths_batch(job_data, debug, num_workers,
+                                     busy_times, undirected,
+                                     job_options=job_options)
+    shards_run: list[int] = []
+    deadline = timeit.default_timer() + g_batch_worker_connect_seconds
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        while True:
+            try:
+                sock = socket.create_connection((host, port))
+            except OSError:
+                if timeit.default_timer() > deadline:
+                    raise
+                time.sleep(g_batch_worker_poll_seconds)
+                continue
+            try:
+                with sock, sock.makefile('rb') as reader:
+                    _run_worker_leases(sock, reader, curie_to_index,
+                                       _run_jobs, tmp_dir, compression,
+                                       shards_run)
+                return shards_run
+            except ConnectionError:
+                deadline = timeit.default_timer() + \
+                    g_batch_worker_connect_seconds
+
+
+# Yields (job index, paths) for each job whose paths were written to the
+# output directory of a `BatchCoordinator`, in job order.
+def iter_sharded_paths(output_dir: str) -> Iterator[tuple[int, np.ndarray]]:
+    with open(os.path.join(output_dir, g_batch_manifest_file_name)) as \
+            input_file:
+        shard_size = json.load(input_file)['shard_size']
+    shard_files = sorted(name for name in os.listdir(output_dir)
+                         if name.startswith("shard-") and
+                         name.endswith(".bin"))
+    for name in shard_files:
+        first_job = int(name[len("shard-"):-len(".bin")]) * shard_size
+        reader = read_paths_batch(os.path.join(output_dir, name))
+        for i in range(len(reader)):
+            if reader.is_written(i):
+                yield (first_job + i, reader[i])
+
+
+def _set_graph_from_dict(g_dict: dict, undirected: bool):
+    set_graph(g_dict['g'], g_dict['g_inv'], g_dict.get('g_undirected'),
+              g_dict.get('landmark_index'), get_node_categories(g_dict))
+    if undirected:
+        g_module._prepare_undirected_graph()
+
+
+def _iter_all_paths_serial(job_data: tuple[tuple[int, int, int], ...],
+                           debug: bool,
+                           busy_times: dict[int, float],
+                           undirected: bool = False,
+                           stats: typing.Optional[dict] = None,
+                           job_options: typing.Optional[
+                               typing.Sequence[dict]] = None) -> \
+        Iterator[tuple[int, typing.Any]]:
+    for i, (s, t, n) in enumerate(job_data):
+        options = {} if job_options is None else job_options[i]
+        start = timeit.default_timer()
+        paths_np = get_all_paths(s, t, n, debug, undirected, stats,
+                                 exclude=options.get('exclude'))
+        busy_times[os.getpid()] = busy_times.get(os.getpid(), 0.0) + \
+            timeit.default_timer() - start
+        yield (i, _apply_job_limit(paths_np.shape[0] if options.get('count')
+                                   else paths_np, options))
+
+
+# Profiles the code run in its `with` block: a thread samples the block's
+# python call stack every `interval` seconds (labelling the samples taken
+# while a C++ function is running with that function's name, since the C++
+# code releases the GIL), and in python mode, cProfile also records every
+# call. The samples can be written as collapsed stacks, for flamegraph.pl or
+# speedscope.
+class _Profiler:
+    def __init__(self, interval: float = g_profile_sample_interval):
+        self._interval = interval
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._native_call: typing.Optional[str] = None
+        self._native_functions: dict[str, typing.Callable] = dict()
+        self._cprofile: typing.Optional[typing.Any] = None
+        self.samples: collections.Counter = collections.Counter()
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}:"
+                             f"{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.reverse()
+            native_call = self._native_call
+            if native_call is not None:
+                stack.append(f"{native_call} [native]")
+            self.samples[";".join(stack)] += 1
+
+    def _label_native_call(self, name: str, func: typing.Callable) -> \
+            typing.Callable:
+        def _call(*args, **kwargs):
+            self._native_call = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._native_call = None
+        return _call
+
+    def __enter__(self) -> '_Profiler':
+        if _using_cxx():
+            self._native_functions = {
+                name: func for name, func in vars(g_module).items()
+                if isinstance(func, types.BuiltinFunctionType)}
+            for name, func in self._native_functions.items():
+                setattr(g_module, name, self._label_native_call(name, func))
+        else:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._sampler.join()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        for name, func in self._native_functions.items():
+            setattr(g_module, name, func)
+
+    def write(self, file_base: str) -> list[str]:
+        file_names = [f"{file_base}-profile.folded"]
+        with open(file_names[0], 'w') as folded_file:
+            for stack, count in self.samples.most_common():
+                folded_file.write(f"{stack} {count}\n")
+        if self._cprofile is not None:
+            file_names.append(f"{file_base}-profile.pstats")
+            self._cprofile.dump_stats(file_names[-1])
+        return file_names
+
+    def print_summary(self, top_n: int):
+        if self._cprofile is not None:
+            import pstats
+            pstats.Stats(self._cprofile).sort_stats('tottime').print_stats(
+                top_n)
+            return
+        # (in C++ mode, the functions are ranked by the number of samples in
+        # which they are at the top of the stack)
+        num_samples = sum(self.samples.values())
+        self_samples: collections.Counter = collections.Counter()
+        for stack, count in self.samples.items():
+            self_samples[stack.rpartition(";")[2]] += count
+        print(f"Top {top_n} functions, by share of {num_samples} samples:")
+        for name, count in self_samples.most_common(top_n):
+            print(f"{100 * count / num_samples:6.1f}%  {name}")
+
+
+def _format_batch_progress(num_done: int,
+                           num_jobs: typing.Optional[int],
+                           num_done_now: int,
+                           num_paths: int,
+                           elapsed_time: float) -> str:
+    jobs_per_second = num_done_now / elapsed_time
+    message = f"Done {num_done} "
+    if num_jobs is not None:
+        message += f"of {num_jobs} jobs ({100 * num_done / num_jobs:0.1f}%)"
+    else:
+        message += "jobs"
+    message += (f", {jobs_per_second:0.1f} jobs/sec, "
+                f"{num_paths / elapsed_time:0.0f} paths/sec")
+    if num_jobs is not None and jobs_per_second > 0:
+        seconds_left = round((num_jobs - num_done) / jobs_per_second)
+        minutes, seconds = divmod(seconds_left, 60)
+        hours, minutes = divmod(minutes, 60)
+        message += f", ETA {hours}:{minutes:02d}:{seconds:02d}"
+    return message
+
+
+# Prints the progress of a batch run (the jobs done, the throughput of this
+# run, and an estimate of the time left, if the number of jobs is known)
+# every g_progress_interval_seconds; `num_done` jobs were done by an earlier
+# run.
+class _BatchProgress:
+    def __init__(self,
+                 num_jobs: typing.Optional[int],
+                 num_done: int = 0):
+        self._num_jobs = num_jobs
+        self._num_done_before = num_done
+        self._num_done = 0
+        self._num_paths = 0
+        self._start = self._last_report = timeit.default_timer()
+
+    def update(self, num_paths: int):
+        self._num_done += 1
+        self._num_paths += num_paths
+        now = timeit.default_timer()
+        if now - self._last_report >= g_progress_interval_seconds:
+            self._last_report = now
+            print(_format_batch_progress(
+                self._num_done_before + self._num_done, self._num_jobs,
+                self._num_done, self._num_paths, now - self._start),
+                flush=True)
+
+
 def _run_benchmark(g_dict: dict,
-                   job_data: Iterable[tuple[str, str, int]],
+                   jobs: Iterable[dict],
                    undirected: bool,
                    debug: bool,
                    multiprocess: bool,
                    chunksize: int,
-                   mult: int):
-
-    g = g_dict['g']
-    g_inv = g_dict['g_inv']
-    if undirected:
-        g = tuple(g[n] | g_inv[n] for n in range(len(g)))
-        g_inv = g
-
-    g_module._set_graph(g, g_inv)
+                   mult: int,
+                   num_workers: typing.Optional[int] = None,
+                   output_paths: typing.Optional[str] = None,
+                   output_compression: typing.Optional[str] = None,
+                   query_stats: typing.Optional[str] = None,
+                   profile_base: typing.Optional[str] = None,
+                   output_counts: typing.Optional[str] = None,
+                   num_jobs: typing.Optional[int] = None,
+                   resume: bool = False,
+                   output_edges: typing.Optional[str] = None,
+                   parallel_edges: str = 'count'):
+
+    _set_graph_from_dict(g_dict, undirected)
+    _print_memory_usage("after set_graph")
+    stats = make_query_stats() if query_stats is not None else None
+
+    if num_workers is None:
+        # (the `multiprocess` module is shadowed by an argument here)
+        num_workers = os.cpu_count() or 1
+    if g_max_memory_bytes is not None and not _using_cxx():
+        # in python mode, the worker processes get the graph from this process
+        # through fork, but reference counting writes to (and so copies) the
+        # pages that they touch, so at worst each worker has its own copy:
+        rss = _get_rss_bytes()
+        max_workers = max(1, (g_max_memory_bytes - rss) // rss)
+        if max_workers < num_workers:
+            print(f"Reducing the number of worker processes from "
+                  f"{num_workers} to {max_workers}, to stay within the "
+                  "memory limit")
+            num_workers = max_workers
 
     ids = g_dict['ids']
 
     start = timeit.default_timer()
 
-    job_data_processed = tuple(node_names_to_ids(ids, (s, t)) + (chunksize,)
-                               for s, t, chunksize in job_data)
-
     if mult is not None:
-        job_data_processed = job_data_processed * mult
-
-    paths_all = get_all_paths_batch(job_data_processed, debug)
-    paths_ctr = sum([pl.shape[0] for pl in paths_all])
+        # (this reads all of the jobs into memory)
+        jobs = tuple(jobs) * mult
+        if num_jobs is not None:
+            num_jobs *= mult
+
+    busy_times: dict[int, float] = dict()
+    paths_ctr = 0
+    profiler = _Profiler() if profile_base is not None else None
+    if profiler is None:
+        def _run_jobs(job_data, undirected, job_options):
+            return _iter_all_paths_batch(job_data, debug, num_workers,
+                                         busy_times, undirected, stats,
+                                         job_options=job_options)
+    else:
+        # when profiling, the jobs are run one at a time in this process, so
+        # that the profile sees all of the work:
+        num_workers = 1
+
+        def _run_jobs(job_data, undirected, job_options):
+            return _iter_all_paths_serial(job_data, debug, busy_times,
+                                          undirected, stats, job_options)
+    with contextlib.ExitStack() as stack:
+        # write each job's paths as soon as the job is done, rather than
+        # holding all of them in memory, and journal them, so that the run
+        # can be resumed if it dies:
+        writer: typing.Optional[typing.Union[PathsBatchWriter,
+                                             ParquetPathsWriter]] = None
+        done_jobs: set[int] = set()
+        if output_paths is not None:
+            writer = _open_paths_writer(output_paths, output_compression,
+                                        ids, journal=True, resume=resume)
+            stack.enter_context(writer)
+            if isinstance(writer, PathsBatchWriter):
+                done_jobs = writer.done_jobs
+        if done_jobs:
+            print(f"Skipping {len(done_jobs)} jobs that are already done")
+        edges_writer = None
+        if output_edges is not None:
+            if 'edge_table' not in g_dict:
+                raise ValueError("the graph has no edge table (rebuild "
+                                 "the graph store or pickle; a graph "
+                                 "updated with --updateFrom doesn't keep "
+                                 "one)")
+            edges_writer = stack.enter_context(ParquetPathEdgesWriter(
+                output_edges, g_dict['edge_table'], parallel_edges,
+                output_compression))
+        counts_file = None
+        if output_counts is not None:
+            resume_counts = resume and os.path.exists(output_counts)
+            counts_file = stack.enter_context(
+                open(output_counts, 'a' if resume_counts else 'w'))
+            if not resume_counts:
+                counts_file.write("job\tstart\tend\tnum_paths\n")
+        if profiler is not None:
+            stack.enter_context(profiler)
+        progress = _BatchProgress(num_jobs, len(done_jobs))
+        for i, job, paths_np, num_paths, error in _iter_batch_job_paths(
+                jobs, {curie: node for node, curie in enumerate(ids)},
+                _run_jobs, set(done_jobs)):
+            if error is not None:
+                # (the rest of the batch still runs, and the job is counted
+                # as having -1 paths)
+                print(f"Job {i} failed: {error}")
+            if counts_file is not None:
+                # (a resumed run may count a job again, but never misses one)
+                counts_file.write(f"{i}\t{job['start']}\t{job['end']}\t"
+                                  f"{num_paths}\n")
+                counts_file.flush()
+            if edges_writer is not None and paths_np is not None:
+                edges_writer.write(i, paths_np, job['undirected'])
+            if writer is not None and paths_np is not None:
+                writer.write(i, paths_np)
+            elif isinstance(writer, PathsBatchWriter):
+                writer.write_count(i, num_paths, error)
+            paths_ctr += max(0, num_paths)
+            progress.update(max(0, num_paths))
 
     end = timeit.default_timer()
     elapsed_time = end - start
     print(f"Elapsed time: {elapsed_time:0.2f} sec")
     print(f"Num paths: {paths_ctr}")
     print(f"Paths per second: {paths_ctr/elapsed_time:0.0f}")
+    _print_worker_utilization(busy_times, num_workers, elapsed_time)
+    _print_memory_usage("after running the jobs")
+    children_peak_rss = get_memory_usage()['children_peak_rss_bytes']
+    if children_peak_rss > 0:
+        print("Peak RSS of a worker process: "
+              f"{_format_bytes(children_peak_rss)}")
+    if profiler is not None:
+        assert profile_base is not None
+        file_names = profiler.write(profile_base)
+        profiler.print_summary(g_profile_top_n)
+        for file_name in file_names:
+            print(f"Wrote profile: {file_name}")
+    if query_stats is not None:
+        assert stats is not None
+        with open(query_stats, 'w') as stats_file:
+            stats_file.write(query_stats_to_prometheus(stats)
+                             if query_stats.endswith('.prom')
+                             else query_stats_to_json(stats))
 
 
 def _namespace_to_dict(namespace):
+    import argparse
     return {
         k: _namespace_to_dict(v) if isinstance(v, argparse.Namespace) else v
         for k, v in vars(namespace).items()
     }
 
 
-def _write_pickled_graph(g: tuple[tuple, tuple],
+def _write_pickled_graph(g: dict,
                          output_file_base: str,
                          debug=False):
     output_pickle_file_name = output_file_base + ".pkl"
     if debug:
         print("Writing graph to pickle file: "
               f"{output_pickle_file_name}")
-    with open(output_pickle_file_name, 'wb') as output_file:
-        pickle.dump(g, output_file)
+    _write_pickle_atomically(g, output_pickle_file_name)
+
+
+def _write_pickle_atomically(obj, file_name: str):
+    # write to a temporary file first, so that a process that reads the file
+    # never sees a partly-written file:
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, 'wb') as output_file:
+        pickle.dump(obj, output_file)
+    os.replace(temp_file_name, file_name)
+
+
+def _write_json_atomically(obj, file_name: str):
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, 'w') as output_file:
+        json.dump(obj, output_file)
+    os.replace(temp_file_name, file_name)
 
 
 def _read_pickled_graph(filebase: str, debug=False) -> dict[str, tuple]:
@@ -683,9 +4106,65 @@ def _read_pickled_graph(filebase: str, debug=False) -> dict[str, tuple]:
             g_dict = pickle.load(input_file)
     else:
         sys.exit(f"unable to open pickle file {input_pickle_file_name}")
+    for delta in _read_graph_deltas(filebase):
+        if delta['base_version'] >= g_dict.get('version', 0):
+            g_dict = apply_graph_delta(g_dict, delta)
     return g_dict
 
 
+def _read_graph_deltas(filebase: str) -> list[dict]:
+    delta_file_name = filebase + "-delta.pkl"
+    if not os.path.exists(delta_file_name):
+        return []
+    with open(delta_file_name, 'rb') as input_file:
+        return pickle.load(input_file)
+
+
+# The deltas from the updates since the pickle file was last written are kept
+# in a separate "-delta.pkl" file, and applied when the graph is read, so that
+# an update does not have to rewrite the whole graph; once the deltas add up
+# to more than g_delta_compaction_fraction of the edges in the graph, they are
+# compacted into the pickle file.
+def _store_graph_delta(filebase: str,
+                       g_dict: dict,
+                       delta: dict,
+                       debug=False):
+    delta_file_name = filebase + "-delta.pkl"
+    deltas = _read_graph_deltas(filebase) + [delta]
+    num_delta_edges = sum(d['added_edges'].shape[0] +
+                          d['removed_edges'].shape[0] for d in deltas)
+    num_edges = sum(map(len, g_dict['g']))
+    if num_delta_edges > g_delta_compaction_fraction * num_edges:
+        _write_pickled_graph(g_dict, filebase, debug)
+        # (if the process stops before this, the old deltas are skipped on
+        # reading anyway, since the pickled graph has a later version)
+        if os.path.exists(delta_file_name):
+            os.remove(delta_file_name)
+        return
+    if debug:
+        print(f"Writing graph deltas to pickle file: {delta_file_name}")
+    _write_pickle_atomically(deltas, delta_file_name)
+
+
+def _update_pickled_graph(filebase: str,
+                          g_dict: dict,
+                          gz_jl_base_file_name: str,
+                          debug=False) -> dict:
+    delta = make_graph_delta(g_dict, *_load_graph(gz_jl_base_file_name))
+    if debug:
+        print(f"Graph update: {len(delta['nodes'])} nodes added, "
+              f"{delta['added_edges'].shape[0]} edges added, "
+              f"{delta['removed_edges'].shape[0]} edges removed")
+    g_dict = apply_graph_delta(g_dict, delta)
+    _store_graph_delta(filebase, g_dict, delta, debug)
+    return g_dict
+
+
+def read_pickled_node_table(filebase: str,
+                            debug=False) -> dict[str, np.ndarray]:
+    return get_node_table(_read_pickled_graph(filebase, debug))
+
+
 def read_and_unpack_pickled_graph(filebase: str,
                                   debug=False) -> tuple[tuple, tuple, tuple]:
     g_dict = _read_pickled_graph(filebase, debug)
@@ -694,10 +4173,189 @@ def read_and_unpack_pickled_graph(filebase: str,
             g_dict['ids'])
 
 
-def _read_file_describing_batch_job(filename: str) -> \
-        tuple[tuple[str, str, int], ...]:
-    batch_job_df = pd.read_csv(filename, sep="\t")
-    return tuple(tuple(sub) for sub in batch_job_df.values.tolist())
+# Yields (where, record) for each job in a batch job file, reading the file
+# a line (or, for Parquet, a record batch) at a time; `where` is the file
+# name and the line or row number, for error messages.
+def _iter_batch_job_records(filename: str) -> Iterator[tuple[str, dict]]:
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet
+        row = 0
+        for batch in pyarrow.parquet.ParquetFile(filename).iter_batches():
+            for record in batch.to_pylist():
+                row += 1
+                yield (f"{filename}, row {row}", record)
+    elif filename.endswith('.jsonl'):
+        with open(filename) as input_file:
+            for line_num, line in enumerate(input_file, 1):
+                if line.strip():
+                    yield (f"{filename}, line {line_num}", json.loads(line))
+    else:
+        import csv
+        with open(filename, newline='') as input_file:
+            reader = csv.DictReader(input_file, delimiter='\t')
+            for record in reader:
+                yield (f"{filename}, line {reader.line_num}", record)
+
+
+def _parse_batch_job_int(record: dict,
+                         key: str,
+                         where: str) -> typing.Optional[int]:
+    value = record.get(key)
+    if value is None or value == '':
+        return None
+    try:
+        num = int(value)
+    except (TypeError, ValueError):
+        num = -1
+    if num < 0:
+        raise ValueError(f"{where}: invalid {key}: {value!r}")
+    return num
+
+
+def _make_batch_job(record: dict,
+                    where: str,
+                    default_cutoff: typing.Optional[int] = None,
+                    default_undirected: bool = False) -> dict:
+    if not isinstance(record, dict):
+        raise ValueError(f"{where}: a job must be an object")
+    start, end = record.get('start'), record.get('end')
+    if not start or not end:
+        raise ValueError(f"{where}: both 'start' and 'end' are required")
+    max_hops = _parse_batch_job_int(record, 'max-hops', where)
+    if max_hops is None:
+        if default_cutoff is None:
+            raise ValueError(f"{where}: no max-hops, and no default cutoff")
+        max_hops = default_cutoff
+    direction = record.get('direction') or None
+    if direction is not None and direction not in g_batch_job_directions:
+        raise ValueError(f"{where}: invalid direction: {direction!r}")
+    output = record.get('output') or 'paths'
+    if output not in g_batch_job_outputs:
+        raise ValueError(f"{where}: invalid output: {output!r}")
+    exclude = record.get('exclude') or ()
+    if isinstance(exclude, str):
+        exclude = [node for node in exclude.split(',') if node]
+    return {'start': str(start),
+            'end': str(end),
+            'max_hops': max_hops,
+            'undirected': default_undirected if direction is None
+            else direction == 'undirected',
+            'exclude': tuple(map(str, exclude)),
+            'limit': _parse_batch_job_int(record, 'limit', where),
+            'output': output}
+
+
+# Counts the jobs in a batch job file without parsing them (for progress
+# reports).
+def _count_batch_jobs(filename: str) -> int:
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(filename).metadata.num_rows
+    with open(filename, 'rb') as input_file:
+        num_lines = sum(1 for line in input_file if line.strip())
+    # (a tab-separated file has a header line)
+    return num_lines if filename.endswith('.jsonl') else max(0, num_lines - 1)
+
+
+# Yields the jobs in a batch job file one at a time, so that a file with
+# millions of jobs is never read into memory as a whole. The file is
+# tab-separated text with a header line, JSON lines (if its name ends in
+# '.jsonl') or Parquet (if its name ends in '.parquet'), with the fields
+#   start, end   the CURIEs of the start and end nodes
+#   max-hops     the maximum path length (default: `default_cutoff`)
+#   direction    'directed' or 'undirected' (default: `default_undirected`)
+#   exclude      CURIEs of nodes that the paths must not go through (a list,
+#                or a comma-separated string)
+#   limit        the most paths to keep for the job (the first ones found)
+#   output       'paths' (the default), or 'count' to only count the paths
+# of which only start and end are required.
+def iter_batch_jobs(filename: str,
+                    default_cutoff: typing.Optional[int] = None,
+                    default_undirected: bool = False) -> Iterator[dict]:
+    for where, record in _iter_batch_job_records(filename):
+        yield _make_batch_job(record, where, default_cutoff,
+                              default_undirected)
+
+
+# Runs the jobs g_batch_job_chunk_size at a time, with `run_jobs(job_data,
+# undirected, job_options)` (see `_iter_all_paths_batch`, which yields (index
+# in job_data, paths or number of paths) as each job is done) running the
+# directed and the undirected jobs of a chunk separately; the jobs whose
+# indices are in `skip` aren't run. The excluded nodes of a job are left out
+# of its search, rather than filtered out of its paths, since they are
+# usually hubs, and a job whose output is 'count' (or that has a limit) only
+# gets the number of its paths (or the paths that it keeps) back from the
+# workers. Yields (job index, job, paths, number of paths, error), where the
+# paths are None for a 'count' job; a job with a CURIE that isn't in the
+# graph isn't run, and is yielded with no paths, -1 paths and the error
+# message (the error is None for the other jobs).
+def _iter_batch_job_paths(jobs: Iterable[dict],
+                          curie_to_index: dict[str, int],
+                          run_jobs: typing.Callable[
+                              [tuple[tuple[int, int, int], ...], bool,
+                               list[dict]],
+                              Iterator[tuple[int, typing.Any]]],
+                          skip: typing.Container[int] = ()) -> \
+        Iterator[tuple[int, dict, typing.Optional[np.ndarray], int,
+                       typing.Optional[str]]]:
+    def _node_index(curie: str) -> int:
+        try:
+            return curie_to_index[curie]
+        except KeyError:
+            raise ValueError("unable to get integer node ID for CURIE "
+                             f"{curie}") from None
+    jobs_iter = enumerate(jobs)
+    while chunk := list(it.islice(jobs_iter, g_batch_job_chunk_size)):
+        for undirected in (False, True):
+            group = []
+            job_data = []
+            job_options = []
+            for i, job in chunk:
+                if job['undirected'] != undirected or i in skip:
+                    continue
+                try:
+                    s, t = _node_index(job['start']), _node_index(job['end'])
+                    exclude = [_node_index(curie) for curie in job['exclude']]
+                except ValueError as e:
+                    yield (i, job, None, -1, str(e))
+                    continue
+                group.append((i, job))
+                job_data.append((s, t, job['max_hops']))
+                job_options.append(
+                    {'exclude': np.array(exclude, dtype=np.int32)
+                     if exclude else None,
+                     'count': job['output'] == 'count',
+                     'limit': job['limit']})
+            if not group:
+                continue
+            for k, res in run_jobs(tuple(job_data), undirected, job_options):
+                i, job = group[k]
+                if job['output'] == 'count':
+                    yield (i, job, None, res, None)
+                else:
+                    yield (i, job, res, res.shape[0], None)
+
+
+# Yields (job index, job, paths, number of paths, error) for each of the
+# jobs (as yielded by `iter_batch_jobs`) as soon as it is done, with the
+# job's exclusions and limit applied; the paths are None for the jobs whose
+# output is 'count', and for a job with a CURIE that isn't in `ids`, which
+# has -1 paths and the error message (see `_iter_batch_job_paths`).
+def iter_batch_job_paths(jobs: Iterable[dict],
+                         ids: tuple[str, ...],
+                         debug: bool = False,
+                         num_workers: typing.Optional[int] = None,
+                         stats: typing.Optional[dict] = None) -> \
+        Iterator[tuple[int, dict, typing.Optional[np.ndarray], int,
+                       typing.Optional[str]]]:
+    if num_workers is None:
+        num_workers = multiprocess.cpu_count()
+    busy_times: dict[int, float] = dict()
+    return _iter_batch_job_paths(
+        jobs, {curie: i for i, curie in enumerate(ids)},
+        lambda job_data, undirected, job_options: _iter_all_paths_batch(
+            job_data, debug, num_workers, busy_times, undirected, stats,
+            job_options=job_options))
 
 
 # See the comment above the line `if __name__ == "__main__"`
@@ -715,21 +4373,133 @@ def _main(filebase=None,
           multiNodeFileName=None,
           lang=None,
           chunksize=None,
-          mult=None):
+          mult=None,
+          num_workers=None,
+          serve=False,
+          host=g_default_serve_host,
+          port=g_default_serve_port,
+          unix_socket=None,
+          max_pending=None,
+          output_paths=None,
+          output_compression=None,
+          update_from=None,
+          write_store=False,
+          read_store=False,
+          num_landmarks=0,
+          node_order=None,
+          query_stats=None,
+          profile=False,
+          max_memory_gb=None,
+          output_counts=None,
+          coordinate=False,
+          work_for=None,
+          shard_size=g_batch_shard_size,
+          resume=False,
+          output_edges=None,
+          parallel_edges='count'):
 
     set_language(lang)
 
     if mult is not None:
         if mult < 1:
             raise ValueError(f"invalid value for CLI option \'mult\': {mult}")
-    if read_pickle:
+    if num_workers is not None:
+        if num_workers < 1:
+            raise ValueError("invalid value for CLI option "
+                             f"\'numWorkers\': {num_workers}")
+    if read_pickle and read_store:
+        raise ValueError("cannot specify both 'readPickle' and 'readStore'")
+    if num_landmarks < 0 or (num_landmarks > 0 and not write_store):
+        raise ValueError("invalid value for CLI option "
+                         f"\'numLandmarks\': {num_landmarks}")
+    if node_order is not None and not write_store:
+        raise ValueError("CLI option 'nodeOrder' requires 'writeStore'")
+    if resume and output_paths is None:
+        raise ValueError("CLI option 'resume' requires 'outputPaths'")
+    if resume and output_edges is not None:
+        raise ValueError("cannot specify both 'resume' and 'outputEdges'")
+    if max_memory_gb is not None:
+        if max_memory_gb <= 0:
+            raise ValueError("invalid value for CLI option "
+                             f"\'maxMemoryGB\': {max_memory_gb}")
+        set_memory_limit(int(max_memory_gb * 2**30))
+    if coordinate:
+        if multiNodeFileName is None or output_paths is None:
+            raise ValueError("CLI option 'coordinate' requires "
+                             "'multiNodeFileName' and 'outputPaths'")
+        coordinator = BatchCoordinator(
+            iter_batch_jobs(multiNodeFileName,
+                            g_default_cutoff if cutoff is None else cutoff,
+                            undirected),
+            output_paths, shard_size)
+        summary = asyncio.run(_coordinate(coordinator, host, port))
+        print(f"Ran {summary['num_jobs']} jobs in {summary['num_shards']} "
+              f"shards, of which {len(summary['failed_shards'])} failed; "
+              f"{len(summary['failed_jobs'])} jobs failed")
+        return
+    output_file_base = filebase if outputbase is None else outputbase
+    if read_store:
+        store_path = filebase + "-store"
+        if os.path.isdir(store_path):
+            store_bytes = estimate_graph_store_bytes(store_path)
+            print("Estimated memory for the graph store: "
+                  f"{_format_bytes(store_bytes)}")
+            if g_max_memory_bytes is not None and \
+               store_bytes > g_max_memory_bytes:
+                sys.exit("the graph store needs more memory than "
+                         "--maxMemoryGB allows")
+        g_dict = _read_graph_store(store_path, debug)
+    elif read_pickle:
         g_dict = _read_pickled_graph(filebase, debug)
+    elif write_store and not write_pickle:
+        # build the store straight from the edge list
+        if debug:
+            print(f"Writing graph store: {output_file_base}-store")
+        nodes, edges = _load_graph(filebase)
+        ids = tuple(node['id'] for node in nodes)
+        build_graph_store(ids, *_make_edge_arrays(nodes, edges),
+                          output_file_base + "-store",
+                          make_node_table(ids, nodes), num_landmarks,
+                          node_order, *_make_predicate_codes(edges))
+        del nodes, edges
+        g_dict = read_graph_store(output_file_base + "-store")
+        write_store = False
     else:
         g_dict = _make_graph_edgelist(*_load_graph(filebase))
         if write_pickle:
-            output_file_base = (filebase if outputbase is None else
-                                outputbase)
             _write_pickled_graph(g_dict, output_file_base, debug)
+    if update_from is not None:
+        if not read_pickle:
+            raise ValueError("CLI option 'updateFrom' requires 'readPickle'")
+        g_dict = _update_pickled_graph(filebase, g_dict, update_from, debug)
+    _print_memory_usage("after loading the graph")
+    if g_max_memory_bytes is not None and \
+       _get_rss_bytes() > g_max_memory_bytes:
+        sys.exit("the graph needs more memory than --maxMemoryGB allows")
+    if write_store:
+        if debug:
+            print(f"Writing graph store: {output_file_base}-store")
+        write_graph_store(g_dict, output_file_base + "-store", num_landmarks,
+                          node_order)
+        if num_landmarks > 0 or node_order is not None:
+            g_dict = read_graph_store(output_file_base + "-store")
+    if serve:
+        _set_graph_from_dict(g_dict, undirected)
+        _print_memory_usage("after set_graph")
+        try:
+            asyncio.run(_serve(g_dict['ids'], host, port, unix_socket,
+                               num_workers, max_pending, undirected))
+        except KeyboardInterrupt:
+            pass
+        return
+    if work_for is not None:
+        _set_graph_from_dict(g_dict, undirected)
+        coordinator_host, _, coordinator_port = work_for.rpartition(':')
+        shards_run = run_batch_worker(coordinator_host, int(coordinator_port),
+                                      g_dict['ids'], debug, num_workers,
+                                      output_compression)
+        print(f"Ran {len(shards_run)} shards")
+        return
     if multiNodeFileName is None:
         if cutoff is None:
             cutoff = g_default_cutoff
@@ -738,23 +4508,38 @@ def _main(filebase=None,
             sys.exit("both `startnode` and `endnode` must be specified, or "
                      "neither of them")
         if startnode is not None:
-            job_data = [[startnode, endnode, cutoff]]
+            jobs: typing.Optional[Iterable[dict]] = [_make_batch_job(
+                {'start': startnode, 'end': endnode, 'max-hops': cutoff},
+                "command line", cutoff, undirected)]
         else:
-            job_data = None
+            jobs = None
+        num_jobs = 1
     else:
-        if cutoff is not None:
-            raise ValueError("cannot specify cutoff on CLI if using "
-                             "multiNodeFileName")
-        job_data = _read_file_describing_batch_job(multiNodeFileName)
-
-    if job_data is not None:
+        num_jobs = _count_batch_jobs(multiNodeFileName)
+        # the cutoff on the command line is the default for the jobs that
+        # don't give their own max-hops:
+        jobs = iter_batch_jobs(multiNodeFileName,
+                               g_default_cutoff if cutoff is None else cutoff,
+                               undirected)
+
+    if jobs is not None:
         _run_benchmark(g_dict,
-                       job_data,
+                       jobs,
                        undirected=undirected,
                        debug=debug,
                        multiprocess=multiprocess,
                        chunksize=chunksize,
-                       mult=mult)
+                       mult=mult,
+                       num_workers=num_workers,
+                       output_paths=output_paths,
+                       output_compression=output_compression,
+                       query_stats=query_stats,
+                       profile_base=output_file_base if profile else None,
+                       output_counts=output_counts,
+                       num_jobs=num_jobs,
+                       resume=resume,
+                       output_edges=output_edges,
+                       parallel_edges=parallel_edges)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+#!/usr/bin/env bash
+
+# Compares the BFS time for the batch benchmark on a graph store in the
+# original node order and on one renumbered in reverse Cuthill-McKee (bfs)
+# order; see the "forward_bfs_seconds" and "reverse_bfs_seconds" in the two
+# query statistics files.
+#
+# Default language is python. To change language to c++, just
+# pass "cxx" as the first argument to this bash script, like this:
+#     ./run-benchmark-node-order.sh cxx
+
+venv/bin/python3 findpaths.py kg2c-2.8.4 \
+                 --readPickle \
+                 --writeStore \
+                 --outputbase kg2c-2.8.4-unordered \
+                 --lang ${1:-python}
+
+venv/bin/python3 findpaths.py kg2c-2.8.4 \
+                 --readPickle \
+                 --writeStore \
+                 --nodeOrder bfs \
+                 --outputbase kg2c-2.8.4-bfs \
+                 --lang ${1:-python}
+
+for order in unordered bfs
+do
+    venv/bin/python3 findpaths.py kg2c-2.8.4-${order} \
+                     --readStore \
+                     --multiNodeFileName test-data-file.txt \
+                     --queryStats kg2c-2.8.4-${order}-stats.json \
+                     --lang ${1:-python}
+done
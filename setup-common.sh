@@ -7,6 +7,7 @@ python3.10 -m venv venv
 venv/bin/pip3 install -r requirements.txt
 
 venv/bin/mypy --ignore-missing-imports findpaths.py
+venv/bin/mypy --ignore-missing-imports test_findpaths.py
 
 curl -O -s https://kg2webhost.rtx.ai/kg2c-2.8.4-edges-lite.jsonl.gz
 mv kg2c-2.8.4-edges-lite.jsonl.gz kg2c-2.8.4-edges.jsonl.gz
@@ -0,0 +1,1294 @@
+#
+# test_findpaths.py
+#
+# The pytest suite for findpaths.py (see README.md for how to run it against
+# the python-only and the C++-enabled versions)
+
+from collections.abc import Iterator
+from collections import defaultdict
+import timeit
+import gzip
+import importlib.util
+import json
+import os
+import asyncio
+import multiprocess
+import numpy as np
+import itertools as it
+import random
+import typing
+import pytest
+import findpaths
+from findpaths import (Adjacency, apply_graph_delta, AsyncPathFinder,
+                       BatchCoordinator, build_graph_store,
+                       build_landmark_index, estimate_graph_store_bytes,
+                       expand_factored_paths, g_graph_store_adjacencies,
+                       g_node_orders, g_parallel_edges_modes, get_all_paths,
+                       get_all_paths_batch, get_all_paths_factored,
+                       get_arena_stats, get_k_shortest_simple_paths,
+                       get_memory_usage, get_path_edges, get_shortest_paths,
+                       iter_all_paths_batch, iter_batch_job_paths,
+                       iter_batch_jobs, iter_factored_paths,
+                       iter_sharded_paths, make_graph_delta, make_node_order,
+                       make_node_table, make_query_stats,
+                       ParquetPathEdgesWriter, paths_to_curies,
+                       paths_to_original_node_ids, PathsBatchWriter,
+                       PathServer, query_stats_to_json,
+                       query_stats_to_prometheus, read_graph_store,
+                       read_paths_batch, run_batch_worker, set_graph,
+                       set_language, set_memory_limit, write_graph_store,
+                       write_paths_batch)
+from findpaths import (_bfs_distances, _concatenate_factored_paths,
+                       _convert_paths_from_np_to_ragged_list, _CSRAdjacency,
+                       _distance_lower_bound, _format_batch_progress,
+                       _get_all_paths_ret_set, _invert_graph,
+                       _invert_node_order, _make_batch_job, _make_cancel_token,
+                       _make_edge_arrays, _make_graph_edgelist,
+                       _make_predicate_codes, _plan_batch_tasks, _Profiler,
+                       _query_is_impossible, _read_pickled_graph,
+                       _set_graph_from_dict, _update_pickled_graph, _using_cxx,
+                       _write_pickled_graph)
+
+# the random graphs for `test_random_graphs_match_dfs_oracle`: the seed, the
+# number of graphs, and the number of queries run on each of them
+g_differential_test_seed = 0
+g_differential_test_num_graphs = 20
+g_differential_test_num_queries = 8
+
+
+def _get_all_paths_lazy(g: tuple[set[int], ...],
+                        s: int,
+                        t: int,
+                        n: int,
+                        debug: bool = False) -> set[tuple[int]]:
+    g_inv = _invert_graph(g)
+    paths_np = findpaths.g_module._get_all_paths_np(g, g_inv, s, t, n, debug)
+    return _convert_paths_from_np_to_ragged_list(paths_np)
+
+
+test_graphs_edgelist = {
+    'g1': ((0, 1),
+           (1, 2),
+           (2, 3),
+           (0, 4),
+           (4, 2)),  # this graph is a simple DAG
+    'g2': ((0, 1),
+           (1, 2),
+           (1, 3),
+           (2, 4),
+           (3, 4),
+           (4, 9),
+           (0, 5),
+           (5, 6),
+           (5, 7),
+           (6, 8),
+           (7, 8),
+           (8, 9),
+           (9, 0)),  # this graph has a cycle
+    'g3': ((0, 1),
+           (0, 2),
+           (1, 3),
+           (2, 3)),
+    'g4': ((0, 1),   # this graph is v1 with a shortcut
+           (1, 2),
+           (2, 3),
+           (0, 4),
+           (4, 2),
+           (0, 2)),
+    'g5': ((0, 1),
+           (1, 2),
+           (2, 1),
+           (1, 3)),  # this graph has a cycle
+    'g6': ((0, 1),
+           (0, 2),
+           (2, 1),   # this edge is within a BFS layer
+           (1, 3),
+           (3, 3),   # this graph has a self-loop
+           (3, 4),
+           (4, 5))
+}
+
+
+def _make_test_graph_from_edgelist(el: tuple[tuple[int, int],
+                                             ...]) -> tuple[set[int], ...]:
+    N = max(max(s, t) for s, t in el) + 1
+    g: tuple[set[int], ...] = tuple(set() for _ in range(N))
+    for s, t in el:
+        g[s].add(t)
+    return g
+
+
+def _make_test_graphs(el_dict: dict[str,
+                                    tuple[tuple[int, int],
+                                          ...]]) \
+                                          -> dict[str, tuple[set[int], ...]]:
+    return {k: _make_test_graph_from_edgelist(v)
+            for k, v in el_dict.items()}
+
+
+test_graphs = _make_test_graphs(test_graphs_edgelist)
+
+
+def _results_are_all_ints(r: set[tuple[int]]) -> bool:
+    return all(isinstance(v, int) for p in r for v in p)
+
+
+# The simple paths from `s` to `t` of at most `n` edges, found by brute-force
+# depth-first search (the oracle for the differential tests)
+def _get_all_paths_dfs(g: Adjacency,
+                       s: int,
+                       t: int,
+                       n: int) -> set[tuple[int, ...]]:
+    paths: set[tuple[int, ...]] = set()
+
+    def _extend(path: list[int], on_path: set[int]):
+        u = path[-1]
+        if u == t:
+            paths.add(tuple(path))
+            return
+        if len(path) > n:
+            return
+        for v in g[u]:
+            if v not in on_path:
+                path.append(v)
+                on_path.add(v)
+                _extend(path, on_path)
+                on_path.remove(v)
+                path.pop()
+    _extend([s], {s})
+    return paths
+
+
+# A random directed graph with cycles, self-loops and a few high-degree hubs
+def _make_random_test_graph(rng: random.Random,
+                            num_nodes: int) -> tuple[set[int], ...]:
+    g: tuple[set[int], ...] = tuple(set() for _ in range(num_nodes))
+    for _ in range(rng.randint(num_nodes, 3 * num_nodes)):
+        g[rng.randrange(num_nodes)].add(rng.randrange(num_nodes))
+    cycle = rng.sample(range(num_nodes), rng.randint(2, num_nodes))
+    for u, v in zip(cycle, cycle[1:] + cycle[:1]):
+        g[u].add(v)
+    for u in rng.sample(range(num_nodes), rng.randint(1, min(3, num_nodes))):
+        g[u].add(u)
+    for hub in rng.sample(range(num_nodes), min(2, num_nodes)):
+        for u in rng.sample(range(num_nodes), num_nodes // 2):
+            g[hub].add(u)
+            g[u].add(hub)
+    return g
+
+
+def _make_random_test_query(rng: random.Random,
+                            num_nodes: int) -> tuple[int, ...]:
+    return (*rng.sample(range(num_nodes), 2), rng.randint(1, 5))
+
+
+# The random graphs for the differential tests, each with its inverse, its
+# undirected version, and g_differential_test_num_queries queries made by
+# `make_query`. Each graph is yielded twice, once stored by `set_graph` as
+# sets and once as CSR arrays, with the node categories made by
+# `make_node_categories`, if it is given.
+def _iter_random_test_graphs(
+        make_query: typing.Callable[[random.Random, int], tuple] =
+        _make_random_test_query,
+        make_node_categories: typing.Optional[
+            typing.Callable[[random.Random, int], dict]] = None) -> \
+        Iterator[tuple[tuple[set[int], ...], tuple[set[int], ...],
+                       tuple[set[int], ...], tuple]]:
+    rng = random.Random(g_differential_test_seed)
+    for _ in range(g_differential_test_num_graphs):
+        g = _make_random_test_graph(rng, rng.randint(2, 24))
+        g_inv = _invert_graph(g)
+        g_undirected = tuple(g[u] | g_inv[u] for u in range(len(g)))
+        node_categories = None if make_node_categories is None \
+            else make_node_categories(rng, len(g))
+        queries = tuple(make_query(rng, len(g))
+                        for _ in range(g_differential_test_num_queries))
+        for adj, adj_inv in ((g, g_inv), (_CSRAdjacency.from_sets(g),
+                                          _CSRAdjacency.from_sets(g_inv))):
+            set_graph(adj, adj_inv, node_categories=node_categories)
+            yield (g, g_inv, g_undirected, queries)
+
+
+# The backends that can be run here: python, and cxx if `findpaths_core`
+# has been built
+def _get_available_languages() -> tuple[str, ...]:
+    if importlib.util.find_spec('findpaths_core') is None:
+        return ('python',)
+    return ('python', 'cxx')
+
+
+def test_g3_two_paths_length_two(lang):
+    r = _get_all_paths_lazy(test_graphs['g3'], 0, 3, 2)
+    assert len(r) == 2
+
+
+def test_g1_no_path_insufficient_length():
+    r = _get_all_paths_lazy(test_graphs['g1'], 0, 2, 1)
+    assert not r
+
+
+def test_g1_no_path_against_edge_direction():
+    r = _get_all_paths_lazy(test_graphs['g1'], 3, 0, 3)
+    assert not r
+
+
+def test_g1_length_longer_than_needed():
+    r = _get_all_paths_lazy(test_graphs['g1'], 0, 3, 4)
+    assert r == {(0, 1, 2, 3),
+                 (0, 4, 2, 3)}
+
+
+def test_g1_length_exact_length():
+    r = _get_all_paths_lazy(test_graphs['g1'], 0, 3, 3)
+    assert r == {(0, 1, 2, 3),
+                 (0, 4, 2, 3)}
+
+
+def test_g1_one_hop():
+    r = _get_all_paths_lazy(test_graphs['g1'], 0, 4, 1)
+    assert len(r) == 1
+    assert _results_are_all_ints(r)
+    assert r == {(0, 4)}
+
+
+def test_g1_zero_length():
+    with pytest.raises(ValueError):
+        _get_all_paths_lazy(test_graphs['g1'], 0, 4, 0)
+
+
+def test_g1_self_edge():
+    with pytest.raises(ValueError):
+        _get_all_paths_lazy(test_graphs['g1'], 0, 0, 1)
+
+
+def test_g1_non_existing_vertex():
+    with pytest.raises(ValueError):
+        _get_all_paths_lazy(test_graphs['g1'], 0, 6, 2)
+
+
+def test_g1_length_2_single_path():
+    r = _get_all_paths_lazy(test_graphs['g1'], 4, 3, 2)
+    assert r == {(4, 2, 3)}
+
+
+def test_g2_length_4():
+    r = _get_all_paths_lazy(test_graphs['g2'], 0, 9, 4)
+    assert r == {(0, 1, 2, 4, 9),
+                 (0, 1, 3, 4, 9),
+                 (0, 5, 6, 8, 9),
+                 (0, 5, 7, 8, 9)}
+
+
+def test_g4_one_hop():
+    r = _get_all_paths_lazy(test_graphs['g4'], 0, 2, 1)
+    assert r == {(0, 2)}
+
+
+def test_g4_three_hop():
+    r = _get_all_paths_lazy(test_graphs['g4'], 0, 3, 3)
+    assert r == {(0, 2, 3),
+                 (0, 1, 2, 3),
+                 (0, 4, 2, 3)}
+
+
+def test_g4_three_hop_inv():
+    r = _get_all_paths_lazy(_invert_graph(test_graphs['g4']), 3, 0, 3)
+    assert r == {(3, 2, 0),
+                 (3, 2, 1, 0),
+                 (3, 2, 4, 0)}
+
+
+def test_bfs_g1_one_hop():
+    g = test_graphs['g1']
+    g_inv = _invert_graph(g)
+    r = findpaths.g_module._bfs_limited_paths(g, g_inv, 0, 1, reverse=False)
+    assert r == {0: {(0,)}, 1: {(0, 1)}, 4: {(0, 4)}}
+
+
+def test_bfs_g1_one_hop_rev_drop_first():
+    g = test_graphs['g1']
+    g_inv = _invert_graph(g)
+    r = findpaths.g_module._bfs_limited_paths(g_inv, g, 0, 1, reverse=True)
+    assert r == {0: {(0,)}, 1: {(1, 0)}, 4: {(4, 0)}}
+
+
+def test_g5_non_simple_path():
+    r = _get_all_paths_lazy(test_graphs['g5'], 0, 3, 4)
+    assert r == {(0, 1, 3)}
+
+
+def test_g6_five_hop_self_loop():
+    r = _get_all_paths_lazy(test_graphs['g6'], 0, 5, 5)
+    assert r == {(0, 1, 3, 4, 5),
+                 (0, 2, 1, 3, 4, 5)}
+
+
+def test_g2_partitioned_border_nodes(lang):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    r = _convert_paths_from_np_to_ragged_list(
+        findpaths.g_module._get_all_paths_np_cached_graph(0, 9, 4, False))
+    r_parts = [_convert_paths_from_np_to_ragged_list(
+        findpaths.g_module._get_all_paths_np_cached_graph(0, 9, 4, False,
+                                                          part, 3))
+               for part in range(3)]
+    assert set().union(*r_parts) == r
+
+
+def test_cancelled_query_raises(lang):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    cancel_token = _make_cancel_token()
+    cancel_token.cancel()
+    with pytest.raises(Exception, match="cancelled"):
+        findpaths.g_module._get_all_paths_np_cached_graph(0, 9, 4, False, 0,
+                                                          1, cancel_token)
+
+
+def test_async_path_finder_matches_sync(lang):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    job_data = ((0, 9, 4), (1, 4, 2), (0, 8, 3))
+
+    async def _run():
+        async with AsyncPathFinder(max_workers=2, max_pending=2) as finder:
+            return (await finder.get_all_paths(0, 9, 4),
+                    await finder.get_all_paths_batch(job_data),
+                    await finder.count_paths(0, 9, 4))
+    r, r_batch, count = asyncio.run(_run())
+    assert count == r.shape[0]
+    assert _convert_paths_from_np_to_ragged_list(r) == \
+        _convert_paths_from_np_to_ragged_list(get_all_paths(0, 9, 4))
+    assert list(map(_convert_paths_from_np_to_ragged_list, r_batch)) == \
+        [_convert_paths_from_np_to_ragged_list(get_all_paths(s, t, n))
+         for s, t, n in job_data]
+
+
+def test_async_path_finder_cancellation(lang):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+
+    async def _run():
+        async with AsyncPathFinder(max_workers=1, max_pending=1) as finder:
+            task = asyncio.create_task(finder.get_all_paths(0, 9, 4))
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # the slot is given back once the cancelled query has stopped:
+            return await finder.get_all_paths(0, 9, 4)
+    assert asyncio.run(_run()).shape == (4, 5)
+
+
+def test_plan_batch_tasks_splits_heavy_job(monkeypatch):
+    monkeypatch.setattr(findpaths, 'g_out_degree', None)
+    monkeypatch.setattr(findpaths, 'g_in_degree', None)
+    job_data = ((0, 1, 3), (2, 3, 3), (4, 5, 3))
+    tasks = _plan_batch_tasks(job_data, [100.0, 1.0, 1.0], 4)
+    items = [item for task in tasks for item in task]
+    assert tasks[0][0][0] == 0
+    assert sorted(item[4] for item in items if item[0] == 0) == [0, 1, 2, 3]
+    assert [task for task in tasks if len(task) > 1] == [[(1, 2, 3, 3, 0, 1),
+                                                          (2, 4, 5, 3, 0, 1)]]
+    # every part of a split job runs both of the searches, so a job whose
+    # cost is mostly that of the searches isn't split:
+    monkeypatch.setattr(findpaths, 'g_out_degree', np.full(6, 99))
+    monkeypatch.setattr(findpaths, 'g_in_degree', np.full(6, 99))
+    tasks = _plan_batch_tasks(((0, 1, 1), (2, 3, 1), (4, 5, 1)),
+                              [100.0, 1.0, 1.0], 4)
+    assert [item for task in tasks for item in task if item[0] == 0] == \
+        [(0, 0, 1, 1, 0, 1)]
+
+
+def test_batch_matches_single_queries(lang):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    job_data = ((0, 9, 4), (1, 4, 2), (0, 8, 3), (5, 0, 3))
+    r = get_all_paths_batch(job_data, debug=False, num_workers=2)
+    assert list(map(_convert_paths_from_np_to_ragged_list, r)) == \
+        [_convert_paths_from_np_to_ragged_list(get_all_paths(s, t, n))
+         for s, t, n in job_data]
+
+
+def test_batch_job_file_formats(lang, tmp_path, monkeypatch):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    ids = tuple(f"A:{i}" for i in range(len(g)))
+    records = [{'start': 'A:0', 'end': 'A:9', 'max-hops': 4},
+               {'start': 'A:0', 'end': 'A:9', 'max-hops': 4,
+                'exclude': ['A:3'], 'output': 'count'},
+               {'start': 'A:0', 'end': 'A:9', 'limit': 1},
+               {'start': 'A:5', 'end': 'A:0', 'direction': 'undirected'}]
+    tsv_file = tmp_path / "jobs.tsv"
+    tsv_file.write_text(
+        "start\tend\tmax-hops\tdirection\texclude\tlimit\toutput\n" +
+        "".join(f"{r['start']}\t{r['end']}\t{r.get('max-hops', '')}\t"
+                f"{r.get('direction', '')}\t{','.join(r.get('exclude', ()))}"
+                f"\t{r.get('limit', '')}\t{r.get('output', '')}\n"
+                for r in records))
+    jsonl_file = tmp_path / "jobs.jsonl"
+    jsonl_file.write_text("".join(json.dumps(r) + "\n" for r in records))
+    filenames = [str(tsv_file), str(jsonl_file)]
+    if importlib.util.find_spec('pyarrow') is not None:
+        import pyarrow
+        import pyarrow.parquet
+        filenames.append(str(tmp_path / "jobs.parquet"))
+        columns = ('start', 'end', 'max-hops', 'direction', 'exclude',
+                   'limit', 'output')
+        pyarrow.parquet.write_table(
+            pyarrow.table({key: [r.get(key) for r in records]
+                           for key in columns}),
+            filenames[-1])
+    jobs = list(iter_batch_jobs(filenames[0], default_cutoff=3))
+    assert jobs[2] == {'start': 'A:0', 'end': 'A:9', 'max_hops': 3,
+                       'undirected': False, 'exclude': (), 'limit': 1,
+                       'output': 'paths'}
+    for filename in filenames[1:]:
+        assert list(iter_batch_jobs(filename, default_cutoff=3)) == jobs
+    # the jobs are run a chunk at a time, and a chunk's directed and
+    # undirected jobs separately:
+    monkeypatch.setattr(findpaths, 'g_batch_job_chunk_size', 3)
+    res = {i: (paths_np, num_paths)
+           for i, _, paths_np, num_paths, _ in iter_batch_job_paths(
+                   jobs, ids, num_workers=2)}
+    paths_0_9 = get_all_paths(0, 9, 4)
+    assert np.array_equal(res[0][0], paths_0_9)
+    # (a 'count' job only gets the number of its paths, and the excluded
+    # nodes are left out of its search)
+    assert res[1] == (None, (~(paths_0_9 == 3).any(axis=1)).sum())
+    assert np.array_equal(get_all_paths(0, 9, 4, exclude=[3]),
+                          paths_0_9[~(paths_0_9 == 3).any(axis=1)])
+    assert np.array_equal(res[2][0], get_all_paths(0, 9, 3)[:1])
+    assert np.array_equal(res[3][0],
+                          get_all_paths(5, 0, 3, undirected=True))
+    bad_file = tmp_path / "bad.tsv"
+    bad_file.write_text("start\tend\tdirection\nA:0\tA:1\tsideways\n")
+    with pytest.raises(ValueError, match="line 2: invalid direction"):
+        list(iter_batch_jobs(str(bad_file), 3))
+    with pytest.raises(ValueError, match="no max-hops"):
+        list(iter_batch_jobs(str(jsonl_file)))
+    # a job with an unknown CURIE fails on its own, without stopping the
+    # other jobs:
+    res_bad = list(iter_batch_job_paths([dict(jobs[0], exclude=('A:99',)),
+                                         jobs[2]], ids))
+    assert res_bad[0][1:] == \
+        (dict(jobs[0], exclude=('A:99',)), None, -1,
+         "unable to get integer node ID for CURIE A:99")
+    assert res_bad[1][0] == 1 and res_bad[1][4] is None
+
+
+def test_random_graphs_match_dfs_oracle(lang):
+    try:
+        for test_lang in _get_available_languages():
+            set_language(test_lang)
+            for g, g_inv, g_undirected, job_data in \
+                    _iter_random_test_graphs():
+                expected = [_get_all_paths_dfs(g, s, t, n)
+                            for s, t, n in job_data]
+                expected_undirected = [_get_all_paths_dfs(g_undirected,
+                                                          s, t, n)
+                                       for s, t, n in job_data]
+
+                def _check(paths_np: np.ndarray, paths: set, job: tuple):
+                    assert paths_np.shape[0] == len(paths), \
+                        (test_lang, g, job)
+                    assert _convert_paths_from_np_to_ragged_list(
+                        paths_np) == paths, (test_lang, g, job)
+                for job, paths, paths_undirected in \
+                        zip(job_data, expected, expected_undirected):
+                    _check(findpaths.g_module._get_all_paths_np(g, g_inv,
+                                                                *job, False),
+                           paths, job)
+                    stats = make_query_stats()
+                    _check(get_all_paths(*job, stats=stats), paths, job)
+                    assert stats['paths'] == len(paths)
+                    _check(get_all_paths(*job, undirected=True),
+                           paths_undirected, job)
+                    excluded = set(range(0, len(g), 3))
+                    _check(get_all_paths(*job, exclude=excluded),
+                           {path for path in paths
+                            if excluded.isdisjoint(path)}, job)
+                    _check(np.concatenate([
+                        findpaths.g_module._get_all_paths_np_cached_graph(
+                            *job, False, part, 3)
+                        for part in range(3)]), paths, job)
+                for job, paths_np in iter_all_paths_batch(job_data, False,
+                                                          num_workers=2):
+                    _check(paths_np, expected[job], job_data[job])
+                for job, paths_np in enumerate(get_all_paths_batch(
+                        job_data, False, num_workers=2, undirected=True)):
+                    _check(paths_np, expected_undirected[job], job_data[job])
+    finally:
+        set_language(lang)
+
+
+def test_shortest_paths_match_dfs_oracle(lang):
+    for g, _, g_undirected, queries in _iter_random_test_graphs(
+            lambda rng, num_nodes: (*rng.sample(range(num_nodes), 2),
+                                    rng.randint(1, 12), rng.randint(1, 5))):
+        for s, t, k, max_n in queries:
+            for undirected in (False, True):
+                # all of the simple paths, shortest first, then in order node
+                # by node
+                paths = sorted(_get_all_paths_dfs(
+                    g_undirected if undirected else g, s, t, max_n),
+                    key=lambda path: (len(path), path))
+                shortest = get_shortest_paths(s, t, max_n,
+                                              undirected=undirected)
+                assert shortest.shape[1] == max_n + 1
+                assert _convert_paths_from_np_to_ragged_list(shortest) == \
+                    {path for path in paths if len(path) == len(paths[0])}
+                k_shortest = get_k_shortest_simple_paths(
+                    s, t, k, max_n, undirected=undirected)
+                assert k_shortest.shape[1] == max_n + 1
+                assert [tuple(v for v in path if v >= 0)
+                        for path in k_shortest.tolist()] == paths[:k]
+    with pytest.raises(ValueError):
+        get_k_shortest_simple_paths(0, 1, 0, 3)
+    with pytest.raises(ValueError):
+        get_shortest_paths(0, 0, 3)
+
+
+def test_factored_paths_match_dfs_oracle(lang):
+    for g, _, _, job_data in _iter_random_test_graphs():
+        def _check(factored: dict, job: tuple):
+            paths_np = expand_factored_paths(factored)
+            paths = _get_all_paths_dfs(g, *job)
+            assert paths_np.shape == (len(paths), job[2] + 1), (g, job)
+            assert _convert_paths_from_np_to_ragged_list(paths_np) == paths
+            assert list(factored['border_nodes']) == \
+                sorted(factored['border_nodes'])
+        for job in job_data:
+            factored = get_all_paths_factored(*job)
+            _check(factored, job)
+            paths_np = expand_factored_paths(factored)
+            assert np.array_equal(
+                np.concatenate([paths_np[:0],
+                                *iter_factored_paths(factored, 1)]),
+                paths_np)
+            _check(_concatenate_factored_paths([
+                findpaths.g_module._get_all_paths_factored_cached_graph(
+                    *job, False, part, 3) for part in range(3)]), job)
+        for job, factored in iter_all_paths_batch(job_data, False,
+                                                  num_workers=2,
+                                                  factored=True):
+            _check(factored, job_data[job])
+
+
+def test_path_server_localhost(lang):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    ids = tuple(f"N:{i}" for i in range(len(g)))
+    expected = sorted([ids[i] for i in path]
+                      for path in get_all_paths(0, 9, 4).tolist())
+
+    async def _run():
+        async with AsyncPathFinder(max_workers=2, max_pending=2) as finder:
+            server = await PathServer(ids, finder).start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                requests = [{'id': 1, 'start': 'N:0', 'end': 'N:9',
+                             'cutoff': 4},
+                            {'id': 2, 'op': 'count', 'start': 0, 'end': 9,
+                             'cutoff': 4},
+                            {'id': 3, 'op': 'batch', 'count': True,
+                             'jobs': [['N:0', 'N:9', 4], ['N:1', 'X:1', 2],
+                                      ['N:0', 'N:9', 3]]}]
+                writer.write(b"".join(json.dumps(r).encode() + b"\n"
+                                      for r in requests))
+                writer.write_eof()
+                responses = [json.loads(line)
+                             for line in (await reader.read()).splitlines()]
+                writer.close()
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                writer.write(b"GET /health HTTP/1.1\r\nHost: x\r\n\r\n")
+                health = await reader.read()
+                writer.close()
+                bad_requests = []
+                for request in (b"POST /query HTTP/1.1\r\n"
+                                b"Content-Length: abc\r\n\r\n",
+                                b"GET \r\n\r\n"):
+                    reader, writer = await asyncio.open_connection(
+                        '127.0.0.1', port)
+                    writer.write(request)
+                    bad_requests.append(await reader.read())
+                    writer.close()
+            return responses, health, bad_requests
+    responses, health, bad_requests = asyncio.run(_run())
+    by_id = defaultdict(list)
+    for response in responses:
+        by_id[response['id']].append(response)
+    assert sorted(by_id[1][0]['paths']) == expected
+    assert by_id[2] == [{'id': 2, 'count': 4}]
+    assert sorted(by_id[3][:3], key=lambda r: r['job']) == \
+        [{'id': 3, 'job': 0, 'count': 4},
+         {'id': 3, 'job': 1,
+          'error': 'unable to get integer node ID for CURIE X:1'},
+         {'id': 3, 'job': 2, 'count': get_all_paths(0, 9, 3).shape[0]}]
+    assert by_id[3][3] == {'id': 3, 'done': True}
+    assert health.startswith(b"HTTP/1.1 200 OK")
+    assert json.loads(health.split(b"\r\n\r\n", 1)[1])['num_nodes'] == 10
+    assert all(r.startswith(b"HTTP/1.1 400 Bad Request")
+               for r in bad_requests)
+
+
+def test_batch_coordinator_localhost(lang, tmp_path, monkeypatch):
+    monkeypatch.setattr(findpaths, 'g_batch_worker_poll_seconds',
+                        0.05)
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    ids = tuple(f"N:{i}" for i in range(len(g)))
+    job_data = ((0, 9, 4), (1, 4, 2), (0, 8, 3), (5, 0, 3), (0, 9, 3))
+    # the last job fails, because of its unknown CURIE, but the other job in
+    # its shard is kept:
+    jobs = [_make_batch_job({'start': ids[s], 'end': ids[t], 'max-hops': n},
+                            "test")
+            for s, t, n in job_data] + \
+        [_make_batch_job({'start': 'N:0', 'end': 'X:1'}, "test", 2)]
+    output_dir = str(tmp_path / "shards")
+
+    def _coordinate(num_workers: int) -> tuple[dict, list]:
+        async def _run():
+            coordinator = BatchCoordinator(jobs, output_dir, shard_size=2)
+            server = await coordinator.start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                # a worker that goes away without sending back its shard:
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                writer.write(b'{"op": "lease"}\n')
+                await reader.readline()
+                writer.close()
+                await writer.wait_closed()
+                workers = [multiprocess.Process(
+                    target=run_batch_worker, args=('127.0.0.1', port, ids),
+                    kwargs={'num_workers': 1}) for _ in range(num_workers)]
+                for worker in workers:
+                    worker.start()
+                summary = await coordinator.wait()
+            for worker in workers:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, worker.join)
+            return summary, [worker.exitcode for worker in workers]
+        return asyncio.run(_run())
+    summary, exit_codes = _coordinate(3)
+    assert exit_codes == [0, 0, 0]
+    assert summary == {'num_jobs': 6, 'num_shards': 3, 'shard_size': 2,
+                       'failed_shards': {},
+                       'failed_jobs': {'5': 'unable to get integer node ID '
+                                       'for CURIE X:1'}}
+    expected = [get_all_paths(s, t, n) for s, t, n in job_data]
+    res = list(iter_sharded_paths(output_dir))
+    assert [i for i, _ in res] == [0, 1, 2, 3, 4]
+    assert all(np.array_equal(paths_np, expected[i]) for i, paths_np in res)
+    # a restarted coordinator only hands out the shards that aren't done:
+    shard_file = os.path.join(output_dir, "shard-000001.bin")
+    mtime = os.stat(os.path.join(output_dir, "shard-000000.bin")).st_mtime_ns
+    os.remove(shard_file)
+    summary_again, exit_codes = _coordinate(1)
+    assert (summary_again, exit_codes) == (summary, [0])
+    assert os.stat(os.path.join(output_dir,
+                                "shard-000000.bin")).st_mtime_ns == mtime
+    assert np.array_equal(read_paths_batch(shard_file)[1], expected[3])
+    with pytest.raises(ValueError, match="shards of 2 jobs"):
+        BatchCoordinator(jobs, output_dir, shard_size=3)
+
+    # a malformed job row stops the batch, rather than cutting it short:
+    def _iter_bad_jobs():
+        yield from jobs[:3]
+        raise ValueError("test: line 4: invalid direction: 'sideways'")
+
+    async def _run_bad():
+        coordinator = BatchCoordinator(_iter_bad_jobs(),
+                                       str(tmp_path / "bad"), shard_size=2)
+        server = await coordinator.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            leases = []
+            for _ in range(2):
+                writer.write(b'{"op": "lease"}\n')
+                leases.append(json.loads(await reader.readline()))
+            writer.close()
+            await writer.wait_closed()
+            with pytest.raises(ValueError, match="line 4"):
+                await coordinator.wait()
+        return leases
+    leases = asyncio.run(_run_bad())
+    assert leases[0]['shard'] == 0 and leases[1] == {'done': True}
+    with open(str(tmp_path / "bad" / "manifest.json")) as manifest_file:
+        assert "line 4" in json.load(manifest_file)['error']
+
+
+@pytest.mark.parametrize('compression', [None, 'zstd', 'lz4'])
+def test_paths_batch_file_round_trip(tmp_path, compression):
+    if compression is not None:
+        pytest.importorskip({'zstd': 'zstandard', 'lz4': 'lz4'}[compression])
+    paths_all = [np.array([[0, 1, 2, -1], [0, 3, 4, 2]]),
+                 np.zeros(shape=(0, 3), dtype=int),
+                 np.array([[5, 6]])]
+    filename = str(tmp_path / "paths.bin")
+    with PathsBatchWriter(filename, compression) as writer:
+        # jobs can finish, and be written, in any order:
+        for i in (2, 0, 1):
+            writer.write(i, paths_all[i])
+    reader = read_paths_batch(filename)
+    assert reader.compression == compression
+    assert len(reader) == 3
+    for paths_np, paths_np_read in zip(paths_all, reader):
+        assert paths_np_read.dtype == np.int32
+        assert np.array_equal(paths_np, paths_np_read)
+
+
+@pytest.mark.parametrize('compression', [None, 'zstd', 'lz4'])
+def test_paths_batch_resume(tmp_path, compression):
+    if compression is not None:
+        pytest.importorskip({'zstd': 'zstandard', 'lz4': 'lz4'}[compression])
+    paths_all = [np.array([[0, 1, 2, -1], [0, 3, 4, 2]]),
+                 np.array([[5, 6]]),
+                 np.zeros(shape=(0, 3), dtype=int),
+                 np.array([[7, 8, 9]])]
+    filename = str(tmp_path / "paths.bin")
+    writer = PathsBatchWriter(filename, compression, journal=True)
+    writer.write(2, paths_all[2])
+    writer.write_count(3, 1)
+    writer.write(0, paths_all[0])
+    # (a job that failed is journalled, so that it isn't run again)
+    writer.write_count(4, -1, "unable to get integer node ID for CURIE X:1")
+    # the process dies partway through writing job 1, before the index is
+    # written:
+    writer._file.write(b"\0" * 5)
+    writer._file.close()
+    assert writer._journal is not None
+    writer._journal.write('{"job": 1, "off')
+    writer._journal.close()
+    with PathsBatchWriter(filename, compression, resume=True) as writer:
+        assert writer.done_jobs == {0, 2, 3, 4}
+        writer.write(1, paths_all[1])
+    reader = read_paths_batch(filename)
+    # (jobs 3 and 4 have no paths, so the file has paths for jobs 0 to 2)
+    assert len(reader) == 3
+    for i in range(3):
+        assert np.array_equal(reader[i], paths_all[i])
+    # a file that was closed can be resumed too, but only with the same
+    # compression:
+    with PathsBatchWriter(filename, compression, resume=True) as writer:
+        assert writer.done_jobs == {0, 1, 2, 3, 4}
+    assert np.array_equal(read_paths_batch(filename)[1], paths_all[1])
+    with pytest.raises(ValueError, match="cannot resume"):
+        PathsBatchWriter(filename, 'lz4' if compression is None else None,
+                         resume=True)
+
+
+def test_format_batch_progress():
+    assert _format_batch_progress(150, 1000, 100, 5000, 10.0) == \
+        "Done 150 of 1000 jobs (15.0%), 10.0 jobs/sec, 500 paths/sec, " \
+        "ETA 0:01:25"
+    assert _format_batch_progress(7, None, 7, 0, 2.0) == \
+        "Done 7 jobs, 3.5 jobs/sec, 0 paths/sec"
+
+
+def test_paths_batch_parquet(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    filename = str(tmp_path / "paths.parquet")
+    write_paths_batch(filename,
+                      [np.array([[0, 1, 2, -1], [0, 3, 4, 2]]),
+                       np.array([[2, 1]])],
+                      ids=('A:0', 'A:1', 'A:2', 'A:3', 'A:4'))
+    assert pq.read_table(filename).to_pylist() == \
+        [{'job': 0, 'path': ['A:0', 'A:1', 'A:2']},
+         {'job': 0, 'path': ['A:0', 'A:3', 'A:4', 'A:2']},
+         {'job': 1, 'path': ['A:2', 'A:1']}]
+
+
+def test_paths_to_curies():
+    nodes = ({'id': 'A:0', 'name': 'zero', 'category': 'Gene'},
+             {'id': 'A:1', 'category': 'Disease'},
+             {'id': 'A:2', 'name': 'two', 'category': 'Gene'})
+    node_table = make_node_table(tuple(n['id'] for n in nodes), nodes)
+    paths_np = np.array([[0, 1, 2], [2, 0, -1]])
+    assert paths_to_curies(paths_np, node_table).tolist() == \
+        [['A:0', 'A:1', 'A:2'], ['A:2', 'A:0', '']]
+    assert paths_to_curies(paths_np, node_table, 'name').tolist() == \
+        [['zero', '', 'two'], ['two', 'zero', '']]
+    assert paths_to_curies(paths_np, node_table, 'category').tolist() == \
+        [['Gene', 'Disease', 'Gene'], ['Gene', 'Gene', '']]
+    assert np.array_equal(paths_to_curies(paths_np, ('A:0', 'A:1', 'A:2')),
+                          paths_to_curies(paths_np, node_table))
+    with pytest.raises(ValueError):
+        paths_to_curies(paths_np, ('A:0', 'A:1', 'A:2'), 'name')
+
+
+def _make_test_kg(edges: tuple[tuple[str, str], ...]) -> tuple[tuple, tuple]:
+    curies = sorted({curie for edge in edges for curie in edge})
+    return (tuple({'id': curie,
+                   'name': curie.lower(),
+                   'category': 'biolink:Gene'} for curie in curies),
+            tuple({'subject': s, 'object': t} for s, t in edges))
+
+
+def test_graph_delta_matches_rebuild():
+    g_dict = _make_graph_edgelist(*_make_test_kg((('A:0', 'A:1'),
+                                                  ('A:1', 'A:2'),
+                                                  ('A:2', 'A:0'))))
+    g_before = tuple(map(set, g_dict['g']))
+    nodes, edges = _make_test_kg((('A:0', 'A:1'),
+                                  ('A:1', 'A:3'),
+                                  ('A:3', 'A:2'),
+                                  ('A:2', 'A:0')))
+    delta = make_graph_delta(g_dict, nodes, edges)
+    assert delta['added_edges'].tolist() == [[1, 3], [3, 2]]
+    assert delta['removed_edges'].tolist() == [[1, 2]]
+    g_dict_new = apply_graph_delta(g_dict, delta)
+    g_dict_rebuilt = _make_graph_edgelist(nodes, edges)
+    assert g_dict_new['ids'] == g_dict_rebuilt['ids']
+    assert g_dict_new['g'] == g_dict_rebuilt['g']
+    assert g_dict_new['g_inv'] == g_dict_rebuilt['g_inv']
+    assert paths_to_curies(np.array([[3, -1]]), g_dict_new['node_table'],
+                           'name').tolist() == [['a:3', '']]
+    # the previous version is unchanged, and the nodes that the delta doesn't
+    # touch share their adjacency sets with it:
+    assert g_dict['g'] == g_before
+    assert g_dict_new['g'][2] is g_dict['g'][2]
+    with pytest.raises(ValueError):
+        apply_graph_delta(g_dict_new, delta)
+
+
+@pytest.mark.parametrize('compaction_fraction', [0.0, 10.0])
+def test_pickled_graph_update(tmp_path, monkeypatch, compaction_fraction):
+    monkeypatch.setattr(findpaths, 'g_delta_compaction_fraction',
+                        compaction_fraction)
+    filebase = str(tmp_path / "kg")
+    nodes, edges = _make_test_kg((('A:0', 'A:1'), ('A:1', 'A:2')))
+    _write_pickled_graph(_make_graph_edgelist(nodes, edges), filebase)
+    updates = ((('A:0', 'A:1'), ('A:1', 'A:2'), ('A:2', 'A:3')),
+               (('A:0', 'A:1'), ('A:2', 'A:3'), ('A:3', 'A:4')))
+    for edges in updates:
+        nodes, edges = _make_test_kg(edges)
+        with gzip.open(filebase + "-new-nodes.jsonl.gz", 'wt') as fh:
+            fh.writelines(json.dumps(node) + "\n" for node in nodes)
+        with gzip.open(filebase + "-new-edges.jsonl.gz", 'wt') as fh:
+            fh.writelines(json.dumps(edge) + "\n" for edge in edges)
+        _update_pickled_graph(filebase, _read_pickled_graph(filebase),
+                              filebase + "-new")
+    assert os.path.exists(filebase + "-delta.pkl") == \
+        (compaction_fraction > 1.0)
+    g_dict = _read_pickled_graph(filebase)
+    assert g_dict['version'] == 2
+    assert g_dict['g'] == _make_graph_edgelist(nodes, edges)['g']
+
+
+def test_undirected_queries(lang):
+    g = test_graphs['g2']
+    g_inv = _invert_graph(g)
+    set_graph(g, g_inv)
+    g_undirected = tuple(g[v] | g_inv[v] for v in range(len(g)))
+    job_data = ((0, 9, 4), (9, 0, 3), (4, 1, 2))
+    expected = [_get_all_paths_ret_set(g_undirected, g_undirected, s, t, n)
+                for s, t, n in job_data]
+    assert [_convert_paths_from_np_to_ragged_list(
+        get_all_paths(s, t, n, undirected=True))
+            for s, t, n in job_data] == expected
+    assert list(map(_convert_paths_from_np_to_ragged_list,
+                    get_all_paths_batch(job_data, debug=False, num_workers=2,
+                                        undirected=True))) == expected
+    # the directed graph is still there for directed queries:
+    assert _convert_paths_from_np_to_ragged_list(get_all_paths(4, 1, 2)) == \
+        set() != expected[2]
+
+
+def test_metapath(lang, tmp_path):
+    names = ('Disease', 'Gene', 'Protein')
+
+    def _make_query(rng: random.Random, num_nodes: int) -> tuple:
+        n = rng.randint(1, 5)
+        metapath = [rng.choice((None, rng.choice(names),
+                                rng.sample(names, 2)))
+                    for _ in range(n + 1)]
+        return (*rng.sample(range(num_nodes), 2), n, metapath)
+
+    def _make_node_categories(rng: random.Random, num_nodes: int) -> dict:
+        return {'codes': np.array([rng.randrange(len(names))
+                                   for _ in range(num_nodes)],
+                                  dtype=np.int32),
+                'names': names}
+    for g, _, g_undirected, queries in _iter_random_test_graphs(
+            _make_query, _make_node_categories):
+        assert findpaths.g_node_categories is not None
+        category = findpaths.g_node_categories['codes']
+        for s, t, n, metapath in queries:
+            allowed = [set(names) if step is None else
+                       {step} if isinstance(step, str) else set(step)
+                       for step in metapath]
+            for undirected in (False, True):
+                expected = {
+                    path for path in _get_all_paths_dfs(
+                        g_undirected if undirected else g, s, t, n)
+                    if len(path) == n + 1 and
+                    all(names[category[v]] in categories
+                        for v, categories in zip(path, allowed))}
+                assert _convert_paths_from_np_to_ragged_list(
+                    get_all_paths(s, t, n, undirected=undirected,
+                                  metapath=metapath)) == expected
+
+    # the category codes are kept with a pickled graph and in a graph store
+    nodes, edges = _make_test_kg((('A:0', 'A:1'), ('A:1', 'A:2'),
+                                  ('A:0', 'A:3'), ('A:3', 'A:2'),
+                                  ('A:2', 'A:4'), ('A:1', 'A:4')))
+    categories = ('Gene', 'Protein', 'Disease', 'ChemicalEntity',
+                  'PhenotypicFeature')
+    nodes = tuple(dict(node, category=category)
+                  for node, category in zip(nodes, categories))
+    g_dict = _make_graph_edgelist(nodes, edges)
+    metapaths = {(('A:0', 'A:1', 'A:2', 'A:4'), ('A:0', 'A:3', 'A:2', 'A:4')):
+                 ('Gene', ('Protein', 'ChemicalEntity'), 'Disease',
+                  'PhenotypicFeature'),
+                 (('A:0', 'A:1', 'A:2', 'A:4'),):
+                 ('biolink:Gene', 'Protein', None, None),
+                 (): ('Gene', 'Gene', None, None)}
+    write_graph_store(g_dict, str(tmp_path / "written"), node_order='degree')
+    build_graph_store(g_dict['ids'], *_make_edge_arrays(nodes, edges),
+                      str(tmp_path / "built"), g_dict['node_table'],
+                      node_order='bfs')
+    for graph in (g_dict, read_graph_store(str(tmp_path / "written")),
+                  read_graph_store(str(tmp_path / "built"))):
+        _set_graph_from_dict(graph, False)
+        ids = graph['ids']
+        for expected, metapath in metapaths.items():
+            paths_np = get_all_paths(ids.index('A:0'), ids.index('A:4'), 3,
+                                     metapath=metapath)
+            assert set(map(tuple, paths_to_curies(
+                paths_np, graph['node_table']).tolist())) == set(expected)
+    with pytest.raises(ValueError):
+        get_all_paths(0, 4, 2, metapath=('Gene', None, None, None))
+    with pytest.raises(ValueError):
+        get_all_paths(0, 4, 3, metapath=('Gene', 'Drug', None, None))
+    set_graph(g_dict['g'], g_dict['g_inv'])
+    with pytest.raises(ValueError):
+        get_all_paths(0, 4, 3, metapath=(None, None, None, None))
+
+
+def test_graph_store_round_trip(lang, tmp_path):
+    g = test_graphs['g2']
+    g_inv = _invert_graph(g)
+    path = str(tmp_path / "g2-store")
+    write_graph_store({'ids': tuple(f"N:{i}" for i in range(len(g))),
+                       'g': g,
+                       'g_inv': g_inv}, path)
+    g_dict = read_graph_store(path)
+    assert isinstance(g_dict['g'], _CSRAdjacency)
+    assert g_dict['g'][0] == sorted(g[0])
+    assert g_dict['g_undirected'][9] == sorted(g[9] | g_inv[9])
+    assert g_dict['node_table']['id'][9] == 'N:9'
+    set_graph(g, g_inv)
+    expected = [get_all_paths(0, 9, 4), get_all_paths(0, 9, 4,
+                                                      undirected=True)]
+    set_graph(g_dict['g'], g_dict['g_inv'], g_dict['g_undirected'])
+    assert np.array_equal(get_all_paths(0, 9, 4), expected[0])
+    assert np.array_equal(get_all_paths(0, 9, 4, undirected=True),
+                          expected[1])
+
+
+def test_build_graph_store_from_edges(lang, tmp_path):
+    g = test_graphs['g6']
+    ids = tuple(f"N:{i}" for i in range(len(g)))
+    edges = [(s, t) for s in range(len(g)) for t in sorted(g[s])]
+    edges += edges[:3]
+    subjects, objects = np.array(edges, dtype=np.int32).T
+    write_graph_store({'ids': ids, 'g': g, 'g_inv': _invert_graph(g)},
+                      str(tmp_path / "expected"))
+    build_graph_store(ids, subjects, objects, str(tmp_path / "built"))
+    expected = read_graph_store(str(tmp_path / "expected"))
+    g_dict = read_graph_store(str(tmp_path / "built"))
+    for key in g_graph_store_adjacencies:
+        assert np.array_equal(g_dict[key].indptr, expected[key].indptr)
+        assert np.array_equal(g_dict[key].indices, expected[key].indices)
+    assert g_dict['ids'] == ids
+    with pytest.raises(ValueError):
+        build_graph_store(ids, subjects, objects + len(g),
+                          str(tmp_path / "bad"))
+
+
+def test_path_edges(lang, tmp_path):
+    nodes, edges = _make_test_kg((('A:0', 'A:1'), ('A:0', 'A:1'),
+                                  ('A:1', 'A:2'), ('A:0', 'A:2'),
+                                  ('A:2', 'A:3'), ('A:3', 'A:2'),
+                                  ('A:2', 'A:3'), ('A:1', 'A:3')))
+    predicates = ('p:a', 'p:b', 'p:a', 'p:c', 'p:b', 'p:a', 'p:c', 'p:a')
+    edges = tuple(dict(e, predicate=p) for e, p in zip(edges, predicates))
+    g_dict = _make_graph_edgelist(nodes, edges)
+
+    # the edges along each hop, by brute force, as (edge ID, reversed)
+    def _expected(paths_np: np.ndarray,
+                  undirected: bool) -> list[list[list[tuple[int, bool]]]]:
+        ids = g_dict['ids']
+        return [[[(i, reverse) for reverse in (False, True)
+                  for i, e in enumerate(edges)
+                  if (e['subject'], e['object']) ==
+                  ((ids[s], ids[t]) if not reverse else (ids[t], ids[s]))
+                  and (undirected or not reverse)]
+                 for s, t in zip(path[:-1], path[1:]) if t >= 0]
+                for path in paths_np.tolist()]
+    for undirected in (False, True):
+        set_graph(g_dict['g'], g_dict['g_inv'])
+        paths_np = get_all_paths(0, 3, 3, undirected=undirected)
+        expected = _expected(paths_np, undirected)
+        res = get_path_edges(g_dict['edge_table'], paths_np, 'count',
+                             undirected)
+        for i, path_edges in enumerate(expected):
+            num_hops = len(path_edges)
+            assert res['num_edges'][i, :num_hops].tolist() == \
+                list(map(len, path_edges))
+            assert list(zip(res['edge_id'][i, :num_hops].tolist(),
+                            res['reversed'][i, :num_hops].tolist())) == \
+                [hop_edges[0] for hop_edges in path_edges]
+            assert (res['edge_id'][i, num_hops:] == -1).all()
+        res = get_path_edges(g_dict['edge_table'], paths_np, 'expand',
+                             undirected)
+        rows = [(i, list(zip(edge_ids[:len(expected[i])],
+                             reverse[:len(expected[i])])))
+                for i, edge_ids, reverse in zip(res['path_index'].tolist(),
+                                                res['edge_id'].tolist(),
+                                                res['reversed'].tolist())]
+        assert rows == [(i, list(combination))
+                        for i, path_edges in enumerate(expected)
+                        for combination in it.product(*path_edges)]
+        found = res['edge_id'] >= 0
+        assert g_dict['edge_table']['predicate_names'][
+            res['predicate'][found]].tolist() == \
+            [predicates[edge_id] for edge_id in res['edge_id'][found].tolist()]
+
+    # a graph store keeps the edge table, and renumbers it with the nodes:
+    def _path_edge_rows(edge_table: dict[str, np.ndarray],
+                        paths_np: np.ndarray,
+                        node_order=None) -> list[tuple]:
+        res = get_path_edges(edge_table, paths_np, 'expand')
+        if node_order is not None:
+            paths_np = paths_to_original_node_ids(paths_np, node_order)
+        return sorted(
+            (tuple(paths_np[i].tolist()), tuple(edge_ids),
+             tuple(edge_table['predicate_names'][predicates].tolist()))
+            for i, edge_ids, predicates in zip(res['path_index'].tolist(),
+                                               res['edge_id'].tolist(),
+                                               res['predicate']))
+    set_graph(g_dict['g'], g_dict['g_inv'])
+    expected_rows = _path_edge_rows(g_dict['edge_table'],
+                                    get_all_paths(0, 3, 3))
+    for build in (False, True):
+        path = str(tmp_path / f"store-{build}")
+        if build:
+            build_graph_store(g_dict['ids'], *_make_edge_arrays(nodes, edges),
+                              path, node_order='degree',
+                              predicates=_make_predicate_codes(edges)[0],
+                              predicate_names=('p:a', 'p:b', 'p:c'))
+        else:
+            write_graph_store(g_dict, path, node_order='degree')
+        store = read_graph_store(path)
+        new_index = _invert_node_order(np.asarray(store['node_order']))
+        set_graph(store['g'], store['g_inv'])
+        assert _path_edge_rows(
+            store['edge_table'],
+            get_all_paths(int(new_index[0]), int(new_index[3]), 3),
+            store['node_order']) == expected_rows
+    with pytest.raises(ValueError):
+        get_path_edges(g_dict['edge_table'], paths_np, 'all')
+
+    # the Parquet output has a list with an entry per hop for each row
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    set_graph(g_dict['g'], g_dict['g_inv'])
+    paths_np = get_all_paths(0, 3, 3)
+    for parallel_edges in g_parallel_edges_modes:
+        file_name = str(tmp_path / f"edges-{parallel_edges}.parquet")
+        with ParquetPathEdgesWriter(file_name, g_dict['edge_table'],
+                                    parallel_edges) as writer:
+            writer.write(7, paths_np)
+        res = get_path_edges(g_dict['edge_table'], paths_np, parallel_edges)
+        table = pyarrow.parquet.read_table(file_name).to_pylist()
+        assert [row['job'] for row in table] == [7] * len(table)
+        assert [row['path'] for row in table] == \
+            res.get('path_index', np.arange(len(paths_np))).tolist()
+        assert [row['edge_id'] for row in table] == \
+            [[e for e in edge_ids if e >= 0]
+             for edge_ids in res['edge_id'].tolist()]
+        assert [row['predicate'] for row in table] == \
+            [[predicates[e] for e in row['edge_id']] for row in table]
+        assert ('num_edges' in table[0]) == (parallel_edges == 'count')
+
+    # a hop with no edge along it gets -1 (and no predicate), and the path
+    # is still reported, in either mode
+    ids = g_dict['ids']
+    paths_np = np.array([[ids.index('A:2'), ids.index('A:3'),
+                          ids.index('A:1'), -1]])
+    for parallel_edges in g_parallel_edges_modes:
+        res = get_path_edges(g_dict['edge_table'], paths_np, parallel_edges)
+        assert res['edge_id'][:, :2].tolist() == \
+            ([[4, -1]] if parallel_edges == 'count' else [[4, -1], [6, -1]])
+        assert (res['predicate'][:, 1:] == -1).all()
+        assert not res['reversed'].any()
+        file_name = str(tmp_path / f"missing-{parallel_edges}.parquet")
+        with ParquetPathEdgesWriter(file_name, g_dict['edge_table'],
+                                    parallel_edges) as writer:
+            writer.write(0, paths_np)
+        table = pyarrow.parquet.read_table(file_name).to_pylist()
+        assert [row['predicate'] for row in table] == \
+            [[predicates[row['edge_id'][0]], ''] for row in table]
+        assert len(table) == (1 if parallel_edges == 'count' else 2)
+
+
+def test_node_order(lang, tmp_path):
+    rng = random.Random(g_differential_test_seed)
+    g = _make_random_test_graph(rng, 30)
+    g_inv = _invert_graph(g)
+    ids = tuple(f"N:{i}" for i in range(len(g)))
+    subjects, objects = np.array([(s, t) for s in range(len(g))
+                                  for t in g[s]], dtype=np.int32).T
+    job_data = [(*rng.sample(range(len(g)), 2), 4) for _ in range(10)]
+    set_graph(g, g_inv)
+    expected = [get_all_paths(*job) for job in job_data]
+    for node_order in g_node_orders:
+        path = str(tmp_path / node_order)
+        write_graph_store({'ids': ids, 'g': g, 'g_inv': g_inv}, path,
+                          node_order=node_order)
+        g_dict = read_graph_store(path)
+        order = np.asarray(g_dict['node_order'])
+        assert sorted(order.tolist()) == list(range(len(g)))
+        assert g_dict['ids'] == tuple(ids[i] for i in order)
+        build_graph_store(ids, subjects, objects, path + "-built",
+                          node_order=node_order)
+        built = read_graph_store(path + "-built")
+        assert np.array_equal(built['node_order'], order)
+        for key in g_graph_store_adjacencies:
+            assert np.array_equal(built[key].indices, g_dict[key].indices)
+        set_graph(g_dict['g'], g_dict['g_inv'], g_dict['g_undirected'])
+        new_index = _invert_node_order(order)
+        for (s, t, n), paths_np in zip(job_data, expected):
+            relabeled = get_all_paths(new_index[s], new_index[t], n)
+            assert _convert_paths_from_np_to_ragged_list(
+                paths_to_original_node_ids(relabeled, order)) == \
+                _convert_paths_from_np_to_ragged_list(paths_np)
+            assert set(map(tuple, paths_to_curies(
+                relabeled, g_dict['node_table']).tolist())) == \
+                set(map(tuple, paths_to_curies(paths_np, ids).tolist()))
+    write_graph_store({'ids': ids, 'g': g, 'g_inv': g_inv}, path)
+    assert 'node_order' not in read_graph_store(path)
+    # in reverse Cuthill-McKee order, the nodes of a path graph are numbered
+    # along the path, whatever their original numbering:
+    chain = rng.sample(range(len(g)), len(g))
+    g_chain = _CSRAdjacency.from_edges(np.array(chain[:-1] + chain[1:]),
+                                       np.array(chain[1:] + chain[:-1]),
+                                       len(g))
+    new_index = _invert_node_order(make_node_order(g_chain, 'bfs'))
+    assert all(abs(new_index[u] - new_index[v]) == 1
+               for u, v in zip(chain, chain[1:]))
+    with pytest.raises(ValueError):
+        make_node_order(g_chain, 'random')
+
+
+def test_landmark_index(lang):
+    g = test_graphs['g2']
+    g_inv = _invert_graph(g)
+    landmark_index = build_landmark_index(g, g_inv, 3)
+    assert landmark_index['forward'].shape == (len(g), 3)
+    for s in range(len(g)):
+        dist = _bfs_distances(_CSRAdjacency.from_sets(g), s)
+        for t in range(len(g)):
+            assert _distance_lower_bound(landmark_index, s, t) <= dist[t]
+    set_graph(g, g_inv)
+    expected = [(s, t, get_all_paths(s, t, n))
+                for s in range(len(g)) for t in range(len(g)) if s != t
+                for n in range(1, 4)]
+    set_graph(g, g_inv, landmark_index=landmark_index)
+    assert any(_query_is_impossible(s, t, paths.shape[1] - 1, False)
+               for s, t, paths in expected)
+    for s, t, paths in expected:
+        assert np.array_equal(get_all_paths(s, t, paths.shape[1] - 1), paths)
+    batch = get_all_paths_batch([(s, t, paths.shape[1] - 1)
+                                 for s, t, paths in expected], False)
+    assert all(np.array_equal(paths, expected[i][2])
+               for i, paths in enumerate(batch))
+    set_graph(g, g_inv)
+
+
+def test_query_stats(lang):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    stats = make_query_stats()
+    paths = get_all_paths(0, 9, 4, stats=stats)
+    assert stats['num_queries'] == 1
+    assert stats['paths'] == paths.shape[0] == 4
+    assert stats['forward_frontier_sizes'] == [2, 4]
+    assert stats['reverse_frontier_sizes'] == [2, 4]
+    assert stats['candidate_paths'] >= stats['paths']
+    assert stats['border_nodes'] > 0
+    assert stats['bytes_allocated'] >= paths.nbytes
+    assert json.loads(query_stats_to_json(stats)) == stats
+    assert "findpaths_query_paths_total 4\n" in \
+        query_stats_to_prometheus(stats)
+    assert 'findpaths_query_forward_frontier_sizes_total{layer="2"} 4' in \
+        query_stats_to_prometheus(stats)
+    get_all_paths(0, 9, 4, stats=stats)
+    assert stats['num_queries'] == 2
+    assert stats['forward_frontier_sizes'] == [4, 8]
+    job_data = ((0, 9, 4), (1, 8, 4), (2, 3, 3))
+    batch_stats = make_query_stats()
+    paths_all = get_all_paths_batch(job_data, False, stats=batch_stats)
+    assert batch_stats['num_queries'] == len(job_data)
+    assert batch_stats['paths'] == sum(p.shape[0] for p in paths_all)
+    if lang == 'cxx':
+        assert stats['arena_blocks'] > 0
+        arena_stats = get_arena_stats()
+        assert arena_stats['blocks_allocated'] >= stats['arena_blocks']
+        # (the arenas are freed when the queries end)
+        assert arena_stats['live_bytes'] == 0
+        assert arena_stats['peak_live_bytes'] > 0
+        # (the BFS scratch arrays are kept for the next query)
+        assert arena_stats['node_scratch_bytes'] >= \
+            arena_stats['node_scratch_pooled_bytes'] > 0
+
+
+def test_profiler(lang, tmp_path):
+    g = test_graphs['g2']
+    set_graph(g, _invert_graph(g))
+    native_functions = dict(vars(findpaths.g_module))
+    with _Profiler(interval=0.0001) as profiler:
+        start = timeit.default_timer()
+        while timeit.default_timer() - start < 0.2:
+            get_all_paths(0, 9, 4)
+    # (the C++ functions are put back when the profiler is done)
+    assert dict(vars(findpaths.g_module)) == native_functions
+    assert any("get_all_paths" in stack for stack in profiler.samples)
+    file_names = profiler.write(str(tmp_path / "test"))
+    assert len(file_names) == (1 if _using_cxx() else 2)
+    with open(file_names[0]) as folded_file:
+        assert all(line.rsplit(" ", 1)[1].strip().isdigit()
+                   for line in folded_file)
+
+
+def test_memory_limit(lang, tmp_path):
+    usage = get_memory_usage()
+    assert 0 < usage['rss_bytes'] <= usage['peak_rss_bytes']
+    g = test_graphs['g2']
+    g_inv = _invert_graph(g)
+    path = str(tmp_path / "g2-store")
+    write_graph_store({'ids': tuple(f"N:{i}" for i in range(len(g))),
+                       'g': g,
+                       'g_inv': g_inv}, path)
+    assert estimate_graph_store_bytes(path) == \
+        sum(os.path.getsize(os.path.join(path, name))
+            for name in os.listdir(path))
+    set_graph(g, g_inv)
+    job_data = ((0, 9, 4), (1, 8, 4))
+    set_memory_limit(1)
+    try:
+        with pytest.raises(MemoryError):
+            get_all_paths_batch(job_data, False)
+        # (the streaming version doesn't hold on to the paths, so it isn't
+        # limited)
+        assert len(list(iter_all_paths_batch(job_data, False))) == 2
+    finally:
+        set_memory_limit(None)
+    assert len(get_all_paths_batch(job_data, False)) == 2